@@ -0,0 +1,62 @@
+import hmac
+from functools import wraps
+from importlib import import_module
+
+from django.conf import settings
+from django.http import JsonResponse
+
+# Conversaciones que recuerda cada sesión; las más antiguas dejan de ser
+# visibles desde el navegador (siguen en la base de datos)
+SESSION_KEY = 'chatbot_conversations'
+MAX_SESSION_CONVERSATIONS = 500
+
+
+def is_operator(request):
+    # Personal del sitio (con el admin activo) o quien presenta el token de
+    # operador, p. ej. Prometheus con "Authorization: Bearer <token>"
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_active and user.is_staff:
+        return True
+    token = settings.CHATBOT_OPERATOR_TOKEN
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    return bool(token) and hmac.compare_digest(header.encode(), f'Bearer {token}'.encode())
+
+
+def operator_required(view):
+    # Estadísticas y métricas internas: solo para operadores
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not is_operator(request):
+            return JsonResponse({'error': 'Forbidden'}, status=403)
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def _remember(session, conversation_id):
+    conversations = [c for c in session.get(SESSION_KEY, []) if c != conversation_id]
+    conversations.append(conversation_id)
+    session[SESSION_KEY] = conversations[-MAX_SESSION_CONVERSATIONS:]
+
+
+def remember_conversation(request, conversation_id):
+    # Apunta en la sesión del navegador una conversación que acaba de crear
+    session = getattr(request, 'session', None)
+    if session is not None:
+        _remember(session, conversation_id)
+
+
+def remember_conversation_in_session(session_key, conversation_id):
+    # Lo mismo desde el canal WebSocket, que solo tiene la cookie de sesión
+    session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    _remember(session, conversation_id)
+    # Una clave caducada o inventada no crea una sesión nueva
+    if session.session_key is not None:
+        session.save()
+
+
+def visible_conversations(request):
+    # Ids de conversación que puede leer la petición; None si puede leerlas todas
+    if is_operator(request):
+        return None
+    session = getattr(request, 'session', None)
+    return set(session.get(SESSION_KEY, [])) if session is not None else set()
@@ -0,0 +1,131 @@
+import json
+import os
+import platform
+import threading
+
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+
+try:
+    import resource
+except ImportError:  # Windows: sin /proc ni getrusage no se mide la memoria
+    resource = None
+
+# Métricas de una ejecución en las que un valor mayor es peor; el rendimiento
+# (req/s) es la excepción y se compara al revés
+LOWER_IS_BETTER = ('p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request', 'rss_mb')
+HIGHER_IS_BETTER = ('throughput',)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+# Cuenta las consultas SQL de todas las conexiones (una por hilo, incluidas
+# las de sync_to_async y el hilo de write-behind) con un execute_wrapper
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def _attach(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        connection_created.connect(self._attach)
+        for existing in connections.all():
+            self._attach(existing)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self._attach)
+        for existing in connections.all(initialized_only=True):
+            if self in existing.execute_wrappers:
+                existing.execute_wrappers.remove(self)
+
+
+def rss_bytes():
+    # Memoria residente actual del proceso (Linux); si no hay /proc, el pico;
+    # None si tampoco hay getrusage
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        if resource is None:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def private_bytes():
+    # Memoria anónima (propia) del proceso: sin las páginas de ficheros mapeados,
+    # que comparte el page cache entre procesos
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return rss_bytes()
+
+
+def summarize(elapsed, results, queries, rss):
+    # results: [(segundos, status)] de cada petición
+    latencies = [latency for latency, _ in results]
+    return {
+        'requests': len(results),
+        'errors': sum(1 for _, status in results if status != 200),
+        'throughput': round(len(results) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'queries_per_request': round(queries / len(results), 2),
+        'rss_mb': round(rss / 2**20, 1) if rss is not None else None,
+    }
+
+
+def save_baseline(path, options, results):
+    data = {
+        'options': options,
+        'environment': {
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+    with open(path, 'w', encoding='utf-8') as baseline_file:
+        json.dump(data, baseline_file, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path, encoding='utf-8') as baseline_file:
+        return json.load(baseline_file)
+
+
+def regressions(results, baseline_results, tolerance):
+    # Lista de textos con lo que empeoró más que tolerance (0.2 = 20%)
+    found = []
+    for mode, current in results.items():
+        previous = baseline_results.get(mode)
+        if previous is None:
+            continue
+        for metric in LOWER_IS_BETTER:
+            if current.get(metric) is None or previous.get(metric) is None:
+                continue
+            if current[metric] > previous[metric] * (1 + tolerance):
+                found.append(f"{mode} {metric}: {previous[metric]} -> {current[metric]}")
+        for metric in HIGHER_IS_BETTER:
+            if metric in previous and current[metric] < previous[metric] * (1 - tolerance):
+                found.append(f"{mode} {metric}: {previous[metric]} -> {current[metric]}")
+        if current['errors'] > previous.get('errors', 0):
+            found.append(f"{mode} errors: {previous.get('errors', 0)} -> {current['errors']}")
+    return found
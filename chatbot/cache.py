@@ -0,0 +1,184 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+# Campos del payload que no cambian el texto generado
+IGNORED_FIELDS = ('stream', 'stream_options')
+
+
+def _normalize_content(content):
+    return ' '.join(content.split()) if isinstance(content, str) else content
+
+
+def payload_key(payload):
+    # Hash estable del payload: claves ordenadas y espacios normalizados en los mensajes
+    normalized = {k: v for k, v in payload.items() if k not in IGNORED_FIELDS}
+    normalized['messages'] = [
+        {**message, 'content': _normalize_content(message.get('content'))}
+        for message in payload.get('messages', [])
+    ]
+    data = json.dumps(normalized, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+# Caché de respuestas del LLM en dos niveles: un LRU en memoria del proceso
+# y, opcionalmente, un backend de caché de Django compartido entre workers
+class CompletionCache:
+    def __init__(self, max_entries=1000, ttl=3600, backend=None, max_temperature=1.0, key_prefix='chatbot:completion:'):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = caches[backend] if backend else None
+        self.max_temperature = max_temperature
+        self.key_prefix = key_prefix
+        self._entries = OrderedDict()  # key -> (expira, texto)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def cacheable(self, payload):
+        # Con temperaturas altas o varias respuestas por petición no se reutiliza nada
+        return payload.get('temperature', 1.0) <= self.max_temperature and payload.get('n', 1) == 1
+
+    def _count(self, attribute):
+        with self._lock:
+            setattr(self, attribute, getattr(self, attribute) + 1)
+
+    def _local_get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _local_set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _lookup(self, payload):
+        # Devuelve (clave, valor local); clave None si el payload no es cacheable
+        if not self.cacheable(payload):
+            self._count('bypassed')
+            return None, None
+        key = payload_key(payload)
+        return key, self._local_get(key)
+
+    def _record(self, key, value, shared=False):
+        # Solo lo que llega del backend compartido se copia al LRU: repetir el
+        # _local_set en cada acierto local renovaría el TTL y nunca caducaría
+        if value is None:
+            self._count('misses')
+        else:
+            if shared:
+                self._local_set(key, value)
+            self._count('hits')
+        return value
+
+    def get(self, payload):
+        key, value = self._lookup(payload)
+        if key is None:
+            return None
+        if value is None and self.backend is not None:
+            return self._record(key, self.backend.get(self.key_prefix + key), shared=True)
+        return self._record(key, value)
+
+    async def aget(self, payload):
+        key, value = self._lookup(payload)
+        if key is None:
+            return None
+        if value is None and self.backend is not None:
+            return self._record(key, await self.backend.aget(self.key_prefix + key), shared=True)
+        return self._record(key, value)
+
+    def set(self, payload, value):
+        if not self.cacheable(payload):
+            return
+        key = payload_key(payload)
+        self._local_set(key, value)
+        if self.backend is not None:
+            self.backend.set(self.key_prefix + key, value, self.ttl)
+
+    async def aset(self, payload, value):
+        if not self.cacheable(payload):
+            return
+        key = payload_key(payload)
+        self._local_set(key, value)
+        if self.backend is not None:
+            await self.backend.aset(self.key_prefix + key, value, self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'bypassed': self.bypassed,
+                'entries': len(self._entries),
+            }
+
+
+# Sustituto cuando la caché está desactivada
+class NullCache:
+    def get(self, payload):
+        return None
+
+    async def aget(self, payload):
+        return None
+
+    def set(self, payload, value):
+        pass
+
+    async def aset(self, payload, value):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+_completion_cache = None
+_completion_cache_lock = threading.Lock()
+
+
+def get_completion_cache():
+    global _completion_cache
+    if _completion_cache is None:
+        with _completion_cache_lock:
+            if _completion_cache is None:
+                if settings.CHATBOT_CACHE_ENABLED:
+                    _completion_cache = CompletionCache(
+                        max_entries=settings.CHATBOT_CACHE_MAX_ENTRIES,
+                        ttl=settings.CHATBOT_CACHE_TTL,
+                        backend=settings.CHATBOT_CACHE_BACKEND or None,
+                        max_temperature=settings.CHATBOT_CACHE_MAX_TEMPERATURE,
+                    )
+                else:
+                    _completion_cache = NullCache()
+    return _completion_cache
+
+
+@receiver(setting_changed)
+def _reset_completion_cache(setting, **kwargs):
+    global _completion_cache
+    if setting.startswith('CHATBOT_CACHE_'):
+        _completion_cache = None
@@ -0,0 +1,206 @@
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+try:
+    import fcntl
+except ImportError:  # Windows: solo se agrupan las peticiones del mismo proceso
+    fcntl = None
+
+# Los ficheros de resultados más viejos que esto ya no sirven a nadie
+RESULT_MAX_AGE = 300
+
+
+# Una llamada en curso al LLM a la que se suman las peticiones idénticas
+class Flight:
+    def __init__(self, group, key):
+        self.group = group
+        self.key = key
+        self.result = None
+        self.error = None
+        self.started = time.monotonic()
+        self._event = threading.Event()
+        self._lock_file = None
+
+    def wait(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise TimeoutError("La petición agrupada no terminó a tiempo")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def resolve(self, result):
+        self.group._finish(self, result, None)
+
+    def fail(self, error):
+        self.group._finish(self, None, error)
+
+
+# Single-flight: las peticiones concurrentes con el mismo payload esperan a una
+# sola llamada. Entre hilos del mismo worker se usa un diccionario en memoria y
+# entre workers de gunicorn un flock por clave más un fichero con el resultado.
+class SingleFlight:
+    def __init__(self, directory=None, wait_timeout=60):
+        self.directory = directory if fcntl is not None else None
+        self.wait_timeout = wait_timeout
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def join(self, key):
+        # Devuelve (flight, leader). Quien no es líder llama a flight.wait();
+        # el líder hace la llamada y termina siempre con resolve() o fail().
+        with self._lock:
+            flight = self._flights.get(key)
+            # Un líder que no terminó a tiempo (p. ej. un stream que nunca se
+            # llegó a consumir) no debe retener a las peticiones siguientes
+            if flight is not None and time.monotonic() - flight.started < self.wait_timeout:
+                self.coalesced += 1
+                return flight, False
+            flight = Flight(self, key)
+            self._flights[key] = flight
+
+        if self.directory:
+            started = time.time()
+            flight._lock_file = self._acquire(key)
+            result = self._read_result(key, started)
+            if result is not None:
+                # Otro worker hizo la misma llamada mientras esperábamos el lock
+                with self._lock:
+                    self.coalesced += 1
+                flight.resolve(result)
+                return flight, False
+        return flight, True
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, f"{key}.{suffix}")
+
+    def _acquire(self, key):
+        path = self._path(key, 'lock')
+        lock_file = open(path, 'a+')
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if _same_file(lock_file, path):
+                    return lock_file
+                # _sweep borró el fichero mientras esperábamos: el lock de un
+                # fichero desvinculado no excluye a nadie, se reabre
+                lock_file.close()
+                lock_file = open(path, 'a+')
+                continue
+            except BlockingIOError:
+                if time.monotonic() > deadline:
+                    # El líder de otro worker no termina: seguir sin agrupar
+                    lock_file.close()
+                    return None
+                time.sleep(0.01)
+
+    def _read_result(self, key, since):
+        # Solo vale un resultado producido después de que llegara esta petición
+        path = self._path(key, 'json')
+        try:
+            if os.path.getmtime(path) < since:
+                return None
+            with open(path, encoding='utf-8') as result_file:
+                return json.load(result_file)['result']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_result(self, key, result):
+        path = self._path(key, 'json')
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as result_file:
+            json.dump({'result': result}, result_file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _sweep(self):
+        # Borra de vez en cuando los ficheros de claves que ya nadie usa
+        now = time.time()
+        if now - self._last_sweep < RESULT_MAX_AGE:
+            return
+        self._last_sweep = now
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) <= RESULT_MAX_AGE:
+                    continue
+                if name.endswith('.lock'):
+                    # Nunca se escriben, así que su mtime no dice si están en
+                    # uso: solo se borran si nadie los tiene, y con el lock tomado
+                    self._remove_lock(path)
+                else:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _remove_lock(path):
+        with open(path, 'a+') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            if _same_file(lock_file, path):
+                os.remove(path)
+
+    def _finish(self, flight, result, error):
+        lock_file = flight._lock_file
+        if lock_file is not None:
+            flight._lock_file = None
+            try:
+                if error is None:
+                    self._write_result(flight.key, result)
+                self._sweep()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        flight.result = result
+        flight.error = error
+        flight._event.set()
+
+    def stats(self):
+        with self._lock:
+            return {'coalesced': self.coalesced, 'in_flight': len(self._flights)}
+
+
+def _same_file(open_file, path):
+    # El fichero abierto sigue siendo el que hay en path (no lo borraron ni lo recrearon)
+    try:
+        return os.fstat(open_file.fileno()).st_ino == os.stat(path).st_ino
+    except FileNotFoundError:
+        return False
+
+
+_singleflight = None
+_singleflight_lock = threading.Lock()
+
+
+def get_singleflight():
+    global _singleflight
+    if _singleflight is None:
+        with _singleflight_lock:
+            if _singleflight is None:
+                _singleflight = SingleFlight(
+                    directory=settings.CHATBOT_COALESCE_DIR if settings.CHATBOT_COALESCE_ACROSS_WORKERS else None,
+                    wait_timeout=settings.LLM_READ_TIMEOUT + settings.LLM_CONNECT_TIMEOUT,
+                )
+    return _singleflight
+
+
+@receiver(setting_changed)
+def _reset_singleflight(setting, **kwargs):
+    global _singleflight
+    if setting.startswith('CHATBOT_COALESCE_'):
+        _singleflight = None
@@ -0,0 +1,51 @@
+import re
+import unicodedata
+import zlib
+
+import numpy as np
+
+DIMENSIONS = 256
+
+# Palabras vacías en español que no aportan significado a la pregunta
+STOPWORDS = frozenset("""
+a al algo como con cual cuales cuando de del donde el en es esta este esto
+hay la las le les lo los me mi mis no o para pero por que quien se si sin
+son su sus te tu un una uno unos unas y ya yo
+""".split())
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def normalize(text):
+    # Minúsculas y sin tildes: "atención" y "atencion" cuentan igual
+    text = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+
+def features(text):
+    words = [w for w in _WORD_RE.findall(normalize(text)) if w not in STOPWORDS]
+    for word in words:
+        yield word, 1.0
+        # Trigramas de caracteres para tolerar plurales y errores de escritura
+        padded = f"<{word}>"
+        for i in range(len(padded) - 2):
+            yield padded[i:i + 3], 0.5
+
+
+def embed(text, dimensions=DIMENSIONS):
+    # Vectorizador por hashing: sin modelo ni GPU, determinista entre procesos
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for feature, weight in features(text):
+        h = zlib.crc32(feature.encode('utf-8'))
+        # El bit alto decide el signo y reduce el sesgo de las colisiones
+        vector[h % dimensions] += weight if h & 0x80000000 else -weight
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+
+def fold(vectors, dimensions):
+    # Reduce vectores hasheados a menos dimensiones sumando bloques: equivale a
+    # haber hasheado con ese tamaño, así que sirve como índice aproximado
+    return vectors.reshape(*vectors.shape[:-1], -1, dimensions).sum(axis=-2)
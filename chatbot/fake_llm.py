@@ -0,0 +1,166 @@
+"""
+Servidor local que imita la API de chat completions de DeepSeek.
+
+Sirve para benchmarks y pruebas sin red: responde con un texto fijo tras una
+latencia configurable, con o sin streaming (server-sent events). También
+puede inyectar errores (429/5xx con Retry-After) para probar el governor.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = "Hola, soy un asistente de prueba. ¿En qué puedo ayudarte hoy?"
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Permite conexiones keep-alive
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        server.record_request()
+        try:
+            self._respond(server, payload)
+        finally:
+            server.record_done()
+
+    def _respond(self, server, payload):
+        time.sleep(server.latency)
+
+        error = server.next_error()
+        if error is not None:
+            status, retry_after = error
+            self._send_json(status, {"error": {"message": "fake upstream error", "code": status}},
+                            {'Retry-After': str(retry_after)} if retry_after is not None else None)
+        elif payload.get('stream'):
+            include_usage = (payload.get('stream_options') or {}).get('include_usage')
+            try:
+                self._send_stream(server, self._usage(server, payload) if include_usage else None)
+            except (BrokenPipeError, ConnectionResetError):
+                # El cliente cortó el stream (p. ej. una respuesta cancelada)
+                server.record_disconnect()
+                self.close_connection = True
+        else:
+            self._send_json(200, {
+                "id": "fake",
+                "object": "chat.completion",
+                "model": payload.get('model', 'deepseek-chat'),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": server.reply},
+                    "finish_reason": "stop"
+                }],
+                "usage": self._usage(server, payload)
+            })
+
+    def _usage(self, server, payload):
+        prompt_tokens = sum(len(m.get('content', '').split()) for m in payload.get('messages', []))
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(server.tokens),
+            "total_tokens": prompt_tokens + len(server.tokens)
+        }
+
+    def _send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_stream(self, server, usage=None):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for token in server.tokens:
+            if server.token_delay:
+                time.sleep(server.token_delay)
+            chunk = {"choices": [{"index": 0, "delta": {"content": token}}]}
+            self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+        if usage is not None:
+            # Como la API real con stream_options.include_usage: un fragmento final sin choices
+            self._write_chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode('utf-8'))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0, tokens_per_second=0, reply=DEFAULT_REPLY,
+                 error_rate=0.0, error_status=503, retry_after=None):
+        super().__init__(address, FakeLLMHandler)
+        self.latency = latency
+        self.token_delay = 1.0 / tokens_per_second if tokens_per_second else 0
+        self.reply = reply
+        # Conserva los espacios para que el texto reconstruido sea idéntico
+        self.tokens = [word + ' ' for word in reply.split(' ')]
+        self.tokens[-1] = self.tokens[-1].rstrip(' ')
+        # Errores aleatorios (error_rate) y programados (fail_next)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self._scripted_errors = []
+        self._random = random.Random(0)
+        self.requests_served = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.disconnects = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def record_request(self):
+        with self._lock:
+            self.requests_served += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def record_done(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def record_disconnect(self):
+        with self._lock:
+            self.disconnects += 1
+
+    def fail_next(self, count, status=503, retry_after=None):
+        # Las próximas count peticiones fallan con este status
+        with self._lock:
+            self._scripted_errors.extend([(status, retry_after)] * count)
+
+    def next_error(self):
+        with self._lock:
+            if self._scripted_errors:
+                return self._scripted_errors.pop(0)
+            if self.error_rate and self._random.random() < self.error_rate:
+                return self.error_status, self.retry_after
+        return None
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
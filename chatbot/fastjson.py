@@ -0,0 +1,78 @@
+import json
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse
+
+try:
+    import orjson
+except ImportError:  # orjson es opcional: sin él se usa el módulo json
+    orjson = None
+
+# JSON de las peticiones y respuestas del chat y del tráfico con el LLM.
+# dumps devuelve bytes UTF-8 (sin escapar los acentos, como ensure_ascii=False)
+# listos para el cuerpo HTTP; loads acepta bytes o str. Las fechas, Decimal y
+# UUID se serializan igual que con JsonResponse (DjangoJSONEncoder).
+
+_encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+def _json_dumps(obj):
+    return _encoder.encode(obj).encode('utf-8')
+
+
+BACKENDS = {'json': (json.loads, _json_dumps)}
+
+if orjson is not None:
+    _default = DjangoJSONEncoder().default
+
+    def _orjson_dumps(obj):
+        # OPT_PASSTHROUGH_DATETIME: las fechas pasan por DjangoJSONEncoder y
+        # salen con el mismo formato que antes (milisegundos, "Z" en UTC)
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+    BACKENDS['orjson'] = (orjson.loads, _orjson_dumps)
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    # (loads, dumps) según CHATBOT_JSON_BACKEND: 'auto' elige orjson si está instalado
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = settings.CHATBOT_JSON_BACKEND
+                if name == 'auto':
+                    name = 'orjson' if 'orjson' in BACKENDS else 'json'
+                if name not in BACKENDS:
+                    raise ImproperlyConfigured(f"CHATBOT_JSON_BACKEND={name!r} no está disponible")
+                _backend = BACKENDS[name]
+    return _backend
+
+
+@receiver(setting_changed)
+def _reset_backend(setting, **kwargs):
+    global _backend
+    if setting == 'CHATBOT_JSON_BACKEND':
+        _backend = None
+
+
+def loads(data):
+    return get_backend()[0](data)
+
+
+def dumps(obj):
+    return get_backend()[1](obj)
+
+
+class JsonResponse(HttpResponse):
+    # Como django.http.JsonResponse, serializado con el backend rápido
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=dumps(data), **kwargs)
@@ -0,0 +1,459 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows: el límite de concurrencia es solo por proceso
+    fcntl = None
+
+# Respuestas de DeepSeek que merece la pena reintentar
+RETRYABLE_STATUS = frozenset({429, 500, 502, 503, 504})
+
+
+class UpstreamError(Exception):
+    # DeepSeek no devolvió una respuesta válida. retry_after (segundos) indica
+    # cuándo tiene sentido volver a intentarlo, si se sabe.
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+class _Waiter:
+    __slots__ = ('event', 'loop', 'future', 'granted')
+
+    def __init__(self, event=None, loop=None, future=None):
+        self.event = event
+        self.loop = loop
+        self.future = future
+        self.granted = False
+
+
+# Límite de llamadas simultáneas al LLM dentro del proceso, compartido entre
+# hilos (WSGI) y corrutinas (ASGI). Al liberar, el hueco pasa directamente al
+# primero de la cola, así nadie se cuela.
+class ConcurrencyLimiter:
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._waiters = deque()
+
+    def _try_acquire(self):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        return False
+
+    def _give_up(self, waiter):
+        # Devuelve True si el hueco llegó a concederse mientras se abandonaba
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+            self.rejected += 1
+            return False
+
+    def acquire(self, timeout):
+        with self._lock:
+            if self._try_acquire():
+                return
+            waiter = _Waiter(event=threading.Event())
+            self._waiters.append(waiter)
+        if waiter.event.wait(timeout) or self._give_up(waiter):
+            return
+        raise UpstreamError("Demasiadas peticiones en curso al LLM", 503, retry_after=1)
+
+    async def aacquire(self, timeout):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._try_acquire():
+                return
+            waiter = _Waiter(loop=loop, future=loop.create_future())
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+            return
+        except asyncio.TimeoutError:
+            if self._give_up(waiter):
+                return
+        except asyncio.CancelledError:
+            if self._give_up(waiter):
+                self.release()
+            raise
+        raise UpstreamError("Demasiadas peticiones en curso al LLM", 503, retry_after=1)
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                self.active -= 1
+                return
+            # El hueco queda asignado ya; quien espera despierta en su hilo o loop
+            waiter = self._waiters.popleft()
+            waiter.granted = True
+        if waiter.event is not None:
+            waiter.event.set()
+        else:
+            waiter.loop.call_soon_threadsafe(_grant, waiter.future)
+
+    def stats(self):
+        with self._lock:
+            return {'active': self.active, 'waiting': len(self._waiters), 'limit': self.limit, 'rejected': self.rejected}
+
+
+def _grant(future):
+    if not future.done():
+        future.set_result(True)
+
+
+# Límite opcional entre workers de gunicorn: un flock por hueco en el directorio
+class FileSlots:
+    def __init__(self, directory, limit):
+        self.directory = directory
+        self.limit = limit
+        os.makedirs(directory, exist_ok=True)
+
+    def _try_acquire(self):
+        for slot in random.sample(range(self.limit), self.limit):
+            lock_file = open(os.path.join(self.directory, f"slot-{slot}.lock"), 'a+')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_file
+            except BlockingIOError:
+                lock_file.close()
+        return None
+
+    def acquire(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            lock_file = self._try_acquire()
+            if lock_file is not None:
+                return lock_file
+            if time.monotonic() > deadline:
+                raise UpstreamError("Demasiadas peticiones en curso al LLM", 503, retry_after=1)
+            time.sleep(0.01)
+
+    async def aacquire(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            lock_file = self._try_acquire()
+            if lock_file is not None:
+                return lock_file
+            if time.monotonic() > deadline:
+                raise UpstreamError("Demasiadas peticiones en curso al LLM", 503, retry_after=1)
+            await asyncio.sleep(0.01)
+
+    @staticmethod
+    def release(lock_file):
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+# Token bucket: rate fichas por segundo con ráfagas de hasta burst. reserve()
+# descuenta por adelantado y devuelve cuánto esperar, así las peticiones que
+# llegan juntas quedan espaciadas en lugar de reintentar a la vez.
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1, max_wait=float('inf')):
+        # Devuelve (concedido, espera). Si no se concede, espera es cuánto
+        # faltaría para poder concederlo (útil como Retry-After).
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = max(0.0, (tokens - self.tokens) / self.rate)
+            if wait > max_wait:
+                return False, wait
+            self.tokens -= tokens
+            return True, wait
+
+    def refund(self, tokens=1):
+        # Devuelve una reserva que no llegó a usarse
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + tokens)
+
+
+# Circuit breaker: tras threshold fallos seguidos de DeepSeek deja de llamarlo
+# durante reset_timeout segundos y falla al instante; después deja pasar una
+# sola petición de prueba (half-open) que decide si vuelve a cerrarse.
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.short_circuited = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        # Devuelve True si esta llamada es la prueba del half-open: quien la
+        # recibe debe cerrarla con record_success/record_failure o release_probe
+        with self._lock:
+            if self.state == self.CLOSED:
+                return False
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if self.state == self.OPEN and remaining <= 0:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.short_circuited += 1
+            raise CircuitOpenError("DeepSeek no está disponible", 503, retry_after=max(1, round(remaining)))
+
+    def is_open(self):
+        # Abierto y sin haber cumplido aún reset_timeout
+        with self._lock:
+            return self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+    def release_probe(self):
+        # La prueba terminó sin veredicto (p. ej. un 429): otra puede probar
+        with self._lock:
+            self._probing = False
+
+    def stats(self):
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures, 'short_circuited': self.short_circuited}
+
+
+def retry_after_seconds(headers):
+    # Retry-After puede venir en segundos o como fecha HTTP
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class Governor:
+    # Envuelve cada llamada al LLM: circuit breaker, token bucket, límite de
+    # concurrencia y reintentos con backoff exponencial con jitter completo
+    def __init__(self, max_concurrency=16, queue_timeout=10, rate=0, burst=10, max_retries=2,
+                 base_delay=0.5, max_delay=8, breaker_threshold=5, breaker_reset=30, slots_dir=None):
+        self.limiter = ConcurrencyLimiter(max_concurrency)
+        self.slots = FileSlots(slots_dir, max_concurrency) if slots_dir and fcntl is not None else None
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+
+    @classmethod
+    def from_settings(cls, name):
+        # Un governor por proveedor; el límite entre workers usa un subdirectorio propio
+        return cls(
+            max_concurrency=settings.LLM_MAX_CONCURRENCY,
+            queue_timeout=settings.LLM_QUEUE_TIMEOUT,
+            rate=settings.LLM_RATE_LIMIT,
+            burst=settings.LLM_RATE_BURST,
+            max_retries=settings.LLM_MAX_RETRIES,
+            base_delay=settings.LLM_RETRY_BASE_DELAY,
+            max_delay=settings.LLM_RETRY_MAX_DELAY,
+            breaker_threshold=settings.LLM_BREAKER_THRESHOLD,
+            breaker_reset=settings.LLM_BREAKER_RESET,
+            slots_dir=os.path.join(settings.LLM_CONCURRENCY_DIR, name) if settings.LLM_CONCURRENCY_DIR else None,
+        )
+
+    def backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after or 0)
+
+    def _rate_wait(self):
+        if self.bucket is None:
+            return 0.0
+        granted, wait = self.bucket.reserve(max_wait=self.queue_timeout)
+        if not granted:
+            raise UpstreamError("Cuota de peticiones al LLM agotada", 429, retry_after=wait)
+        return wait
+
+    def _refund_rate(self):
+        if self.bucket is not None:
+            self.bucket.refund()
+
+    def _acquire_slot(self):
+        # Devuelve la función que libera el hueco; se puede llamar varias veces
+        self.limiter.acquire(self.queue_timeout)
+        lock_file = None
+        if self.slots is not None:
+            try:
+                lock_file = self.slots.acquire(self.queue_timeout)
+            except BaseException:
+                self.limiter.release()
+                raise
+        return _release_once(self.limiter, self.slots, lock_file)
+
+    async def _aacquire_slot(self):
+        await self.limiter.aacquire(self.queue_timeout)
+        lock_file = None
+        if self.slots is not None:
+            try:
+                lock_file = await self.slots.aacquire(self.queue_timeout)
+            except BaseException:
+                self.limiter.release()
+                raise
+        return _release_once(self.limiter, self.slots, lock_file)
+
+    def _outcome(self, response, error, attempt):
+        # Decide tras cada intento: devuelve el retraso antes de reintentar o
+        # lanza UpstreamError si no quedan intentos o no merece la pena
+        if error is None and response.status_code not in RETRYABLE_STATUS:
+            if response.status_code == 200:
+                self.breaker.record_success()
+            else:
+                self.breaker.release_probe()
+            return None
+        status = None if error is not None else response.status_code
+        retry_after = None if error is not None else retry_after_seconds(response.headers)
+        if status == 429:
+            # Límite de cuota, no una caída: no abre el circuito
+            self.breaker.release_probe()
+        else:
+            self.breaker.record_failure()
+        delay = self.backoff(attempt, retry_after)
+        if attempt >= self.max_retries or delay > self.max_delay:
+            raise UpstreamError("Error en la API de Deepseek", status, retry_after=delay)
+        self.retries += 1
+        return delay
+
+    def call(self, send, transport_errors=()):
+        # send() hace la petición y devuelve la respuesta (requests). Devuelve
+        # (respuesta, release): release() libera el hueco de concurrencia y hay
+        # que llamarlo al terminar de leer la respuesta (streams incluidos).
+        attempt = 0
+        while True:
+            probe = self.breaker.before_call()
+            release = None
+            response = None
+            try:
+                wait = self._rate_wait()
+                try:
+                    if wait:
+                        time.sleep(wait)
+                    release = self._acquire_slot()
+                except BaseException:
+                    # La petición no llega a salir: su ficha vuelve al bucket
+                    self._refund_rate()
+                    raise
+                try:
+                    response, error = send(), None
+                except transport_errors as e:
+                    error = e
+                delay = self._outcome(response, error, attempt)
+            except BaseException:
+                # Cualquier salida sin veredicto (sin hueco, cancelación...)
+                # devuelve la prueba del half-open; si no, el circuito no se cerraría nunca
+                if response is not None:
+                    response.close()
+                if probe:
+                    self.breaker.release_probe()
+                if release is not None:
+                    release()
+                raise
+            if delay is None:
+                return response, release
+            if response is not None:
+                response.close()
+            release()
+            time.sleep(delay)
+            attempt += 1
+
+    async def acall(self, send, transport_errors=()):
+        # Versión asíncrona de call() para httpx
+        attempt = 0
+        while True:
+            probe = self.breaker.before_call()
+            release = None
+            response = None
+            try:
+                wait = self._rate_wait()
+                try:
+                    if wait:
+                        await asyncio.sleep(wait)
+                    release = await self._aacquire_slot()
+                except BaseException:
+                    self._refund_rate()
+                    raise
+                try:
+                    response, error = await send(), None
+                except transport_errors as e:
+                    error = e
+                delay = self._outcome(response, error, attempt)
+            except BaseException:
+                if probe:
+                    self.breaker.release_probe()
+                if release is not None:
+                    release()
+                if response is not None:
+                    await response.aclose()
+                raise
+            if delay is None:
+                return response, release
+            if response is not None:
+                await response.aclose()
+            release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def stats(self):
+        return {
+            'concurrency': self.limiter.stats(),
+            'breaker': self.breaker.stats(),
+            'retries': self.retries,
+            'rate_tokens': round(self.bucket.tokens, 2) if self.bucket is not None else None,
+        }
+
+
+def _release_once(limiter, slots, lock_file):
+    released = threading.Event()
+
+    def release():
+        if released.is_set():
+            return
+        released.set()
+        if lock_file is not None:
+            slots.release(lock_file)
+        limiter.release()
+    return release
@@ -0,0 +1,59 @@
+from django.conf import settings
+
+from .models import ChatMessage, ConversationSummary
+from .prompt import count_tokens
+
+
+def _history_query(conversation_id, max_messages, after_id=0):
+    # Una sola consulta sobre el índice (conversation_id, timestamp), de la más
+    # reciente hacia atrás y con LIMIT: el coste no depende del largo de la conversación
+    return (
+        ChatMessage.objects
+        .filter(conversation_id=conversation_id, id__gt=after_id)
+        .order_by('-timestamp')
+        .values_list('role', 'content', 'token_count')[:max_messages]
+    )
+
+
+def _fit_budget(rows, token_budget):
+    window = []
+    used = 0
+    for role, content, tokens in rows:
+        # Los mensajes anteriores a token_count (NULL) se cuentan al vuelo
+        tokens = count_tokens(content) if tokens is None else tokens
+        used += tokens
+        if used > token_budget:
+            break
+        window.append({"role": role, "content": content, "tokens": tokens})
+    window.reverse()
+    return window
+
+
+def load_history(conversation_id, token_budget=None, max_messages=None, after_id=0):
+    # Últimos mensajes de la conversación que caben en el presupuesto de tokens,
+    # en orden cronológico, con su recuento de tokens (para PromptBuilder)
+    token_budget = token_budget or settings.CHATBOT_HISTORY_TOKEN_BUDGET
+    max_messages = max_messages or settings.CHATBOT_HISTORY_MAX_MESSAGES
+    return _fit_budget(_history_query(conversation_id, max_messages, after_id), token_budget)
+
+
+async def aload_history(conversation_id, token_budget=None, max_messages=None, after_id=0):
+    token_budget = token_budget or settings.CHATBOT_HISTORY_TOKEN_BUDGET
+    max_messages = max_messages or settings.CHATBOT_HISTORY_MAX_MESSAGES
+    rows = [row async for row in _history_query(conversation_id, max_messages, after_id)]
+    return _fit_budget(rows, token_budget)
+
+
+def _summary_query(conversation_id):
+    return ConversationSummary.objects.filter(pk=conversation_id).values_list('content', 'summarized_through')
+
+
+def load_context(conversation_id):
+    # Resumen de los turnos antiguos + ventana de mensajes posteriores a él
+    summary, summarized_through = _summary_query(conversation_id).first() or ('', 0)
+    return summary, load_history(conversation_id, after_id=summarized_through)
+
+
+async def aload_context(conversation_id):
+    summary, summarized_through = await _summary_query(conversation_id).afirst() or ('', 0)
+    return summary, await aload_history(conversation_id, after_id=summarized_through)
@@ -0,0 +1,235 @@
+import logging
+import os
+import random
+import socket
+import threading
+from datetime import timedelta
+from importlib import import_module
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+
+class Handler:
+    def __init__(self, kind, func, batch_size, max_attempts=None):
+        self.kind = kind
+        self.func = func
+        self.batch_size = batch_size
+        self._max_attempts = max_attempts
+
+    @property
+    def max_attempts(self):
+        return self._max_attempts or settings.CHATBOT_JOB_MAX_ATTEMPTS
+
+
+# kind -> Handler. Los módulos registran sus trabajos con @handler al importarse
+HANDLERS = {}
+# Módulos con handlers que el worker importa al arrancar
+HANDLER_MODULES = ('chatbot.persistence', 'chatbot.titles')
+
+
+def handler(kind, batch_size=1, max_attempts=None):
+    # La función recibe una lista de payloads (hasta batch_size del mismo tipo)
+    # y debe ser idempotente: un lote que falla se repite trabajo a trabajo
+    def register(func):
+        HANDLERS[kind] = Handler(kind, func, batch_size, max_attempts)
+        return func
+    return register
+
+
+def load_handlers():
+    for module in HANDLER_MODULES:
+        import_module(module)
+
+
+def enqueue(kind, payload, delay=0):
+    return Job.objects.create(kind=kind, payload=payload, run_at=timezone.now() + timedelta(seconds=delay))
+
+
+async def aenqueue(kind, payload, delay=0):
+    return await Job.objects.acreate(kind=kind, payload=payload, run_at=timezone.now() + timedelta(seconds=delay))
+
+
+def _ready(kinds, filters):
+    return Job.objects.filter(
+        status=Job.QUEUED, run_at__lte=timezone.now(), kind__in=kinds, **filters
+    ).order_by('run_at', 'id')
+
+
+def _mark_running(jobs, worker):
+    for job in jobs:
+        job.attempts += 1
+    return {
+        'status': Job.RUNNING,
+        'locked_at': timezone.now(),
+        'locked_by': worker,
+        'attempts': F('attempts') + 1,
+    }
+
+
+def claim(worker, kinds=None, **filters):
+    # Reserva el trabajo listo más antiguo y, en el mismo lote, hasta
+    # batch_size - 1 más de su mismo tipo. Devuelve (handler, trabajos).
+    kinds = [kind for kind in (kinds or HANDLERS) if kind in HANDLERS]
+    if not kinds:
+        return None, []
+    if connection.features.has_select_for_update_skip_locked:
+        # PostgreSQL: cada worker se salta las filas que otro ya tiene bloqueadas
+        with transaction.atomic():
+            head = _ready(kinds, filters).select_for_update(skip_locked=True).first()
+            if head is None:
+                return None, []
+            job_handler = HANDLERS[head.kind]
+            jobs = [head] + list(
+                _ready([head.kind], filters).exclude(pk=head.pk)
+                .select_for_update(skip_locked=True)[:job_handler.batch_size - 1]
+            )
+            Job.objects.filter(pk__in=[job.pk for job in jobs]).update(**_mark_running(jobs, worker))
+        return job_handler, jobs
+
+    # Sin SKIP LOCKED (SQLite): cada fila se reclama con un UPDATE condicional,
+    # que solo gana un worker; si otro se llevó todo el lote, se prueba otra vez
+    while True:
+        head = _ready(kinds, filters).first()
+        if head is None:
+            return None, []
+        job_handler = HANDLERS[head.kind]
+        jobs = []
+        for job in [head] + list(_ready([head.kind], filters).exclude(pk=head.pk)[:job_handler.batch_size - 1]):
+            if Job.objects.filter(pk=job.pk, status=Job.QUEUED).update(**_mark_running([job], worker)):
+                jobs.append(job)
+            else:
+                job.attempts -= 1
+        if jobs:
+            return job_handler, jobs
+
+
+def _retry_delay(attempts):
+    # Backoff exponencial con jitter para no reintentar todos a la vez
+    delay = min(settings.CHATBOT_JOB_RETRY_MAX_DELAY, settings.CHATBOT_JOB_RETRY_DELAY * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _fail(job_handler, job, error):
+    message = f"{type(error).__name__}: {error}"
+    if job.attempts >= job_handler.max_attempts:
+        logger.error("Trabajo %s #%s descartado tras %s intentos: %s", job.kind, job.pk, job.attempts, message)
+        Job.objects.filter(pk=job.pk).update(status=Job.DEAD, locked_at=None, last_error=message)
+        return
+    Job.objects.filter(pk=job.pk).update(
+        status=Job.QUEUED, locked_at=None, locked_by='', last_error=message,
+        run_at=timezone.now() + timedelta(seconds=_retry_delay(job.attempts))
+    )
+
+
+def run(job_handler, jobs):
+    # Ejecuta un lote reclamado; devuelve cuántos trabajos terminaron bien
+    try:
+        job_handler.func([job.payload for job in jobs])
+    except Exception as error:
+        if len(jobs) == 1:
+            logger.warning("Falló el trabajo %s #%s", jobs[0].kind, jobs[0].pk, exc_info=True)
+            _fail(job_handler, jobs[0], error)
+            return 0
+        # Un trabajo defectuoso no debe arrastrar al resto del lote
+        return sum(run(job_handler, [job]) for job in jobs)
+    Job.objects.filter(pk__in=[job.pk for job in jobs]).delete()
+    return len(jobs)
+
+
+def run_pending(kind, **filters):
+    # Ejecuta ya, en este proceso, los trabajos en cola que cumplan los filtros
+    # (p. ej. los mensajes pendientes de una conversación antes de leerla)
+    done = 0
+    while True:
+        job_handler, jobs = claim(f"inline-{os.getpid()}", [kind], **filters)
+        if not jobs:
+            return done
+        done += run(job_handler, jobs)
+
+
+def requeue_stale():
+    # Trabajos 'running' de un worker que murió: vuelven a la cola (o a dead si
+    # ya agotaron sus intentos, que se cuentan al reclamarlos)
+    cutoff = timezone.now() - timedelta(seconds=settings.CHATBOT_JOB_VISIBILITY_TIMEOUT)
+    stale = Job.objects.filter(status=Job.RUNNING, locked_at__lt=cutoff)
+    # Mismo límite que al fallar: el max_attempts de cada handler
+    exhausted = Q(attempts__gte=settings.CHATBOT_JOB_MAX_ATTEMPTS) & ~Q(kind__in=list(HANDLERS))
+    for kind, job_handler in HANDLERS.items():
+        exhausted |= Q(kind=kind, attempts__gte=job_handler.max_attempts)
+    dead = stale.filter(exhausted).update(
+        status=Job.DEAD, locked_at=None, last_error="Sin terminar dentro del plazo de visibilidad"
+    )
+    return dead + stale.update(status=Job.QUEUED, locked_at=None, locked_by='')
+
+
+def stats():
+    counts = Job.objects.values('kind', 'status').annotate(count=Count('id')).order_by()
+    return {f"{row['kind']}:{row['status']}": row['count'] for row in counts}
+
+
+# Pool de hilos que consumen la cola. Los trabajos esperan sobre todo al LLM
+# o a la base de datos, así que basta con hilos en un proceso; para más
+# paralelismo se lanzan varios procesos run_workers
+class WorkerPool:
+    def __init__(self, size, kinds=None, poll_interval=1.0):
+        self.size = size
+        self.kinds = kinds
+        self.poll_interval = poll_interval
+        self.processed = 0
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._name = f"{socket.gethostname()}-{os.getpid()}"
+
+    def stop(self):
+        self._stop.set()
+
+    def _work(self, index, once):
+        worker = f"{self._name}-{index}"
+        while not self._stop.is_set():
+            try:
+                job_handler, jobs = claim(worker, self.kinds)
+                if jobs:
+                    done = run(job_handler, jobs)
+                    with self._lock:
+                        self.processed += done
+            except Exception:
+                logger.exception("Error en el worker %s", worker)
+                jobs = None
+            finally:
+                close_old_connections()
+            if not jobs:
+                if once:
+                    return
+                self._stop.wait(self.poll_interval)
+
+    def _requeue_stale(self):
+        try:
+            requeue_stale()
+        except Exception:
+            logger.exception("No se pudieron recuperar los trabajos abandonados")
+        finally:
+            close_old_connections()
+
+    def run(self, once=False):
+        # once=True: vacía la cola y termina (útil en cron y en pruebas)
+        self._requeue_stale()
+        threads = [
+            threading.Thread(target=self._work, args=(index, once), name=f'chatbot-job-{index}', daemon=True)
+            for index in range(self.size)
+        ]
+        for thread in threads:
+            thread.start()
+        # El hilo principal solo vigila los trabajos abandonados por otros workers
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(min(settings.CHATBOT_JOB_VISIBILITY_TIMEOUT / 2, 30))
+            if not self._stop.is_set():
+                self._requeue_stale()
+        return self.processed
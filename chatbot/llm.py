@@ -0,0 +1,319 @@
+import asyncio
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from . import fastjson, metrics
+from .governor import UpstreamError  # noqa: F401 (llm.UpstreamError en las vistas)
+
+# Sesión síncrona compartida por todo el proceso: reutiliza las conexiones
+# keep-alive en lugar de pagar DNS + TCP + TLS en cada mensaje
+_session = None
+_session_lock = threading.Lock()
+
+# Un cliente asíncrono por event loop: bajo ASGI hay un único loop por proceso,
+# así que todas las peticiones comparten el mismo pool de conexiones keep-alive
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def build_payload(messages_for_api, stream=False):
+    payload = {
+        "model": "deepseek-chat",
+        "messages": messages_for_api,
+        "temperature": 0.7,
+        "max_tokens": 2000,
+        "top_p": 0.95,
+        "stream": stream,
+        "presence_penalty": 0,
+        "frequency_penalty": 0
+    }
+    if stream:
+        # El último fragmento trae el campo usage con los tokens consumidos
+        payload["stream_options"] = {"include_usage": True}
+    return payload
+
+
+def _parse_sse_line(line, provider=None):
+    # DeepSeek envía líneas "data: {...}" y termina con "data: [DONE]".
+    # Devuelve None si la línea no trae contenido y False al terminar.
+    if not line.startswith(b'data:'):
+        return None
+    chunk = line[5:].strip()
+    if chunk == b'[DONE]':
+        return False
+    data = fastjson.loads(chunk)
+    metrics.record_tokens(provider, data.get('usage'))
+    if not data.get('choices'):
+        return None
+    return data['choices'][0].get('delta', {}).get('content')
+
+
+def iter_deltas(response):
+    # Fragmentos de texto de una respuesta en streaming de requests
+    provider = getattr(response, 'provider', None)
+    for line in response.iter_lines():
+        delta = _parse_sse_line(line, provider)
+        if delta is False:
+            break
+        if delta:
+            yield delta
+
+
+async def aiter_deltas(response):
+    # Igual que iter_deltas, para una respuesta en streaming de httpx
+    provider = getattr(response, 'provider', None)
+    async for line in response.aiter_lines():
+        delta = _parse_sse_line(line.encode('utf-8'), provider)
+        if delta is False:
+            break
+        if delta:
+            yield delta
+
+
+def timeouts():
+    # (connect, read) por separado: fallar rápido si no hay conexión, pero
+    # dar margen a DeepSeek para generar la respuesta
+    return settings.LLM_CONNECT_TIMEOUT, settings.LLM_READ_TIMEOUT
+
+
+# Conexiones de urllib3 que anotan cuánto tarda abrirlas (TCP + TLS) en la
+# fase upstream_connect de la petición en curso
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        metrics.record_phase('upstream_connect', time.perf_counter() - started)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        metrics.record_phase('upstream_connect', time.perf_counter() - started)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
+
+
+def upstream_trace():
+    # Callback de trace de httpcore para una petición asíncrona: anota la
+    # conexión (TCP + TLS) y el tiempo hasta recibir las cabeceras
+    started = time.perf_counter()
+    marks = {}
+
+    async def trace(event, info):
+        if event.endswith('.started'):
+            marks[event[:-len('.started')]] = time.perf_counter()
+        elif event in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+            step = event[:-len('.complete')]
+            metrics.record_phase('upstream_connect', time.perf_counter() - marks.get(step, started))
+        elif event.endswith('receive_response_headers.complete'):
+            metrics.record_phase('upstream_ttfb', time.perf_counter() - started)
+    return trace
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                adapter = _TimedHTTPAdapter(
+                    pool_connections=settings.LLM_POOL_HOSTS,
+                    pool_maxsize=settings.LLM_MAX_CONNECTIONS_PER_HOST,
+                    pool_block=True,  # Nunca abrir más conexiones que el límite por host
+                    max_retries=0
+                )
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+class GovernedStream:
+    # Respuesta en streaming que devuelve su hueco del governor al cerrarse y
+    # anota la duración total (upstream_total) desde started
+    def __init__(self, response, release, provider=None, started=None):
+        self.response = response
+        self.release = release
+        self.provider = provider
+        self.started = started
+
+    def _record_total(self):
+        if self.started is not None:
+            metrics.record_phase('upstream_total', time.perf_counter() - self.started)
+            self.started = None
+
+    def iter_lines(self):
+        return self.response.iter_lines()
+
+    def aiter_lines(self):
+        return self.response.aiter_lines()
+
+    def close(self):
+        try:
+            self.response.close()
+        finally:
+            self._record_total()
+            self.release()
+
+    async def aclose(self):
+        try:
+            await self.response.aclose()
+        finally:
+            self._record_total()
+            self.release()
+
+
+def _router():
+    # Importación diferida: providers usa el transporte HTTP de este módulo
+    from .providers import get_router
+    return get_router()
+
+
+def is_configured():
+    # Hay al menos un proveedor con clave (o uno local que no la necesita)
+    return _router().configured
+
+
+def open_stream(payload):
+    return _router().open_stream(payload)
+
+
+def complete_payload(payload):
+    return _router().complete(payload)
+
+
+def complete(messages_for_api, **options):
+    # Petición simple sin streaming; devuelve el texto de la respuesta
+    payload = build_payload(messages_for_api)
+    payload.update(options)
+    return complete_payload(payload)
+
+
+def pool_stats():
+    # Estado de los pools de conexiones: el síncrono de requests, por host, y
+    # el de httpx de cada event loop (uno por proceso bajo ASGI), por host
+    return {
+        'sync': _sync_pool_stats(),
+        'async': {
+            f"loop-{id(loop):x}": client._transport.stats()
+            for loop, client in list(_async_clients.items())
+        },
+    }
+
+
+def _sync_pool_stats():
+    if _session is None:
+        return {}
+    stats = {}
+    for adapter in set(_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            queue = pool.pool
+            stats[f"{key.key_scheme}://{key.key_host}:{key.key_port or ''}".rstrip(':')] = {
+                # Cada conexión prestada saca un hueco de la cola hasta que se devuelve
+                'in_use': queue.maxsize - queue.qsize(),
+                'idle': sum(1 for conn in list(queue.queue) if conn is not None),
+                'max_size': queue.maxsize,
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+                'reuses': max(0, pool.num_requests - pool.num_connections),
+            }
+    return stats
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+# Transporte de httpx que cuenta peticiones y conexiones abiertas por host: el
+# pool de httpcore solo conoce las conexiones que tiene en este momento
+class _CountingAsyncTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, max_connections):
+        super().__init__(limits=httpx.Limits(
+            max_connections=max_connections, max_keepalive_connections=max_connections,
+        ))
+        self.max_connections = max_connections
+        self.counters = {}
+
+    @staticmethod
+    def _host(scheme, host, port):
+        return f"{scheme}://{host}:{port or DEFAULT_PORTS.get(scheme, '')}"
+
+    async def handle_async_request(self, request):
+        counters = self.counters.setdefault(
+            self._host(request.url.scheme, request.url.host, request.url.port),
+            {'requests': 0, 'connections_opened': 0},
+        )
+        counters['requests'] += 1
+        inner = request.extensions.get('trace')
+
+        async def trace(event, info):
+            if event == 'connection.connect_tcp.complete':
+                counters['connections_opened'] += 1
+            if inner is not None:
+                await inner(event, info)
+        request.extensions = {**request.extensions, 'trace': trace}
+        return await super().handle_async_request(request)
+
+    def stats(self):
+        stats = {}
+        for connection in self._pool.connections:
+            origin = connection._origin
+            host = self._host(origin.scheme.decode(), origin.host.decode(), origin.port)
+            entry = stats.setdefault(host, {'in_use': 0, 'idle': 0})
+            if connection.is_closed():
+                continue
+            entry['idle' if connection.is_idle() else 'in_use'] += 1
+        for host, counters in list(self.counters.items()):
+            entry = stats.setdefault(host, {'in_use': 0, 'idle': 0})
+            entry.update(
+                max_size=self.max_connections,
+                **counters,
+                reuses=max(0, counters['requests'] - counters['connections_opened']),
+            )
+        return stats
+
+
+def get_async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.LLM_READ_TIMEOUT, connect=settings.LLM_CONNECT_TIMEOUT),
+            transport=_CountingAsyncTransport(settings.LLM_MAX_CONNECTIONS),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def aopen_stream(payload):
+    return await _router().aopen_stream(payload)
+
+
+async def acomplete_payload(payload):
+    return await _router().acomplete(payload)
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chatbot import retention
+
+
+class Command(BaseCommand):
+    help = "Archiva y elimina los meses de mensajes caducados, aplica el TTL por conversación y crea particiones futuras"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-days', type=int, default=settings.CHATBOT_MESSAGE_RETENTION_DAYS)
+        parser.add_argument('--archive-dir', default=settings.CHATBOT_ARCHIVE_DIR)
+        parser.add_argument('--months-ahead', type=int, default=settings.CHATBOT_PARTITION_MONTHS_AHEAD)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--dry-run', action='store_true', help="Solo informa de lo que se haría")
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        if not dry_run:
+            for name in retention.ensure_future_partitions(options['months_ahead']):
+                self.stdout.write(f"Partición creada: {name}")
+
+        cutoff = retention.retention_cutoff(options['retention_days'])
+        archived = retention.archive_expired(
+            cutoff, options['archive_dir'], dry_run=dry_run, batch_size=options['batch_size']
+        )
+        for name, rows in archived:
+            verb = "Se archivaría" if dry_run else "Archivado"
+            self.stdout.write(f"{verb} {name}: {rows} mensajes")
+
+        deleted = retention.sweep_conversation_ttl(dry_run=dry_run)
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(archived)} meses anteriores a {cutoff:%Y-%m-%d}; "
+            f"{deleted} mensajes {'caducarían' if dry_run else 'borrados'} por TTL de conversación"
+        ))
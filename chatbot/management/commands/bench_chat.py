@@ -0,0 +1,178 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import AsyncClient, Client, override_settings
+
+from chatbot import persistence
+from chatbot.benchmark import QueryCounter, load_baseline, regressions, rss_bytes, save_baseline, summarize
+from chatbot.cache import get_completion_cache
+from chatbot.fake_llm import FakeLLMServer
+from chatbot.models import Conversation
+
+# Opciones que definen la carga; una línea base solo es comparable con las mismas
+WORKLOAD_OPTIONS = ('requests', 'concurrency', 'sync_workers', 'latency', 'token_rate', 'error_rate', 'stream', 'turns')
+
+
+def _stream_conversation_id(body):
+    # El primer evento del stream (start) trae el conversation_id
+    for line in body.decode('utf-8').splitlines():
+        if line.startswith('data: '):
+            return json.loads(line[6:]).get('conversation_id')
+    return None
+
+
+class Command(BaseCommand):
+    help = "Compara el rendimiento concurrente del endpoint síncrono y el asíncrono contra un DeepSeek falso local"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="Peticiones por modo")
+        parser.add_argument('--concurrency', type=int, default=100, help="Peticiones simultáneas en el modo asíncrono")
+        parser.add_argument('--sync-workers', type=int, default=4,
+                            help="Hilos del modo síncrono (equivale a los workers sync de gunicorn)")
+        parser.add_argument('--latency', type=float, default=0.5, help="Latencia simulada de DeepSeek en segundos")
+        parser.add_argument('--token-rate', type=float, default=0,
+                            help="Tokens por segundo del stream simulado (0 = todos de golpe)")
+        parser.add_argument('--error-rate', type=float, default=0,
+                            help="Fracción de peticiones a las que DeepSeek responde 503")
+        parser.add_argument('--stream', action='store_true', help="Pedir las respuestas en streaming")
+        parser.add_argument('--turns', type=int, default=1,
+                            help="Mensajes seguidos por conversación (los siguientes cargan el historial)")
+        parser.add_argument('--mode', choices=['sync', 'async', 'both'], default='both')
+        parser.add_argument('--keep-debug', action='store_true',
+                            help="Respetar el DEBUG del perfil de settings (por defecto se fuerza DEBUG=False)")
+        parser.add_argument('--save-baseline', metavar='PATH', help="Guardar los resultados como línea base JSON")
+        parser.add_argument('--baseline', metavar='PATH', help="Fallar si empeora respecto a esta línea base")
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help="Empeoramiento admitido frente a la línea base (0.2 = 20%%)")
+
+    def handle(self, *args, **options):
+        os.environ.setdefault('DEEPSEEK_API_KEY', 'bench')
+        server = FakeLLMServer(
+            latency=options['latency'], tokens_per_second=options['token_rate'], error_rate=options['error_rate']
+        ).start()
+        # Etiqueta de la ejecución en los mensajes: ni la caché de respuestas ni
+        # la semántica deben servir lo que respondió otro modo u otra ejecución.
+        # También marca el título de las conversaciones que crea el benchmark
+        run = uuid.uuid4().hex[:8]
+        modes = ['sync', 'async'] if options['mode'] == 'both' else [options['mode']]
+        results = {}
+        try:
+            overrides = {} if options['keep_debug'] else {'DEBUG': False}
+            with override_settings(ALLOWED_HOSTS=['*'], DEEPSEEK_API_URL=server.url, CHATBOT_THROTTLE_ENABLED=False,
+                                   CHATBOT_LLM_TITLES=False,
+                                   **overrides), \
+                    QueryCounter() as queries:
+                for mode in modes:
+                    get_completion_cache().clear()
+                    results[mode] = self._measure(mode, f"{run}-{mode}", options, queries)
+                    self._report(mode, results[mode])
+        finally:
+            server.stop()
+            # Borrar solo las conversaciones del benchmark (su título empieza por
+            # el primer mensaje, con la etiqueta): nunca las de usuarios reales
+            Conversation.objects.filter(title__startswith=f"Hola {run}-").delete()
+
+        workload = {name: options[name] for name in WORKLOAD_OPTIONS}
+        if options['save_baseline']:
+            save_baseline(options['save_baseline'], workload, results)
+            self.stdout.write(f"Línea base guardada en {options['save_baseline']}")
+        if options['baseline']:
+            self._check_baseline(options['baseline'], workload, results, options['tolerance'])
+
+    def _measure(self, mode, tag, options, queries):
+        before = queries.count
+        run = self._run_sync if mode == 'sync' else self._run_async
+        elapsed, results = run(tag, options)
+        # Con write-behind, las inserciones pendientes también son consultas de estas peticiones
+        if persistence._buffer is not None:
+            persistence._buffer.flush()
+        return summarize(elapsed, results, queries.count - before, rss_bytes())
+
+    def _conversations(self, options):
+        # Usuarios virtuales: cada uno envía turns mensajes seguidos en su conversación
+        return range(-(-options['requests'] // options['turns']))
+
+    def _run_sync(self, tag, options):
+        def one_user(user):
+            try:
+                return user_turns(user)
+            finally:
+                # El cliente de pruebas no cierra la conexión de cada hilo al acabar
+                connections.close_all()
+
+        def user_turns(user):
+            client = Client(HTTP_HOST='localhost')
+            results, conversation_id = [], None
+            for turn in range(options['turns']):
+                data = {'message': f'Hola {tag} {user}.{turn}', 'stream': options['stream']}
+                if conversation_id is not None:
+                    data['conversation_id'] = conversation_id
+                start = time.perf_counter()
+                response = client.post('/', data, content_type='application/json')
+                if response.streaming:
+                    body = b''.join(response.streaming_content)
+                    conversation_id = _stream_conversation_id(body)
+                elif response.status_code == 200:
+                    conversation_id = response.json()['conversation_id']
+                results.append((time.perf_counter() - start, response.status_code))
+            return results
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['sync_workers']) as pool:
+            per_user = list(pool.map(one_user, self._conversations(options)))
+        return time.perf_counter() - start, [result for results in per_user for result in results]
+
+    def _run_async(self, tag, options):
+        async def run():
+            client = AsyncClient(HTTP_HOST='localhost')
+            semaphore = asyncio.Semaphore(options['concurrency'])
+
+            async def one_user(user):
+                results, conversation_id = [], None
+                for turn in range(options['turns']):
+                    data = {'message': f'Hola {tag} {user}.{turn}', 'stream': options['stream']}
+                    if conversation_id is not None:
+                        data['conversation_id'] = conversation_id
+                    async with semaphore:
+                        start = time.perf_counter()
+                        response = await client.post('/async/', data, content_type='application/json')
+                        if response.streaming:
+                            body = b''.join([chunk async for chunk in response.streaming_content])
+                            conversation_id = _stream_conversation_id(body)
+                        elif response.status_code == 200:
+                            conversation_id = response.json()['conversation_id']
+                        results.append((time.perf_counter() - start, response.status_code))
+                return results
+
+            start = time.perf_counter()
+            per_user = await asyncio.gather(*(one_user(user) for user in self._conversations(options)))
+            elapsed = time.perf_counter() - start
+            # Conexiones del hilo en el que sync_to_async ejecutó las consultas
+            await sync_to_async(connections.close_all)()
+            return elapsed, [result for results in per_user for result in results]
+
+        return asyncio.run(run())
+
+    def _report(self, mode, summary):
+        self.stdout.write(
+            f"{mode:>5}: {summary['requests']} peticiones -> {summary['throughput']} req/s | "
+            f"p50 {summary['p50_ms']:.0f} ms, p95 {summary['p95_ms']:.0f} ms, p99 {summary['p99_ms']:.0f} ms | "
+            f"{summary['queries_per_request']} consultas/petición | RSS {'n/d' if summary['rss_mb'] is None else summary['rss_mb']} MB | "
+            f"errores {summary['errors']}"
+        )
+
+    def _check_baseline(self, path, workload, results, tolerance):
+        baseline = load_baseline(path)
+        if baseline['options'] != workload:
+            self.stderr.write("Aviso: la línea base se midió con otra carga; la comparación es orientativa")
+        found = regressions(results, baseline['results'], tolerance)
+        if found:
+            raise CommandError("Regresión frente a la línea base:\n  " + "\n  ".join(found))
+        self.stdout.write(f"Sin regresiones frente a {path} (tolerancia {tolerance:.0%})")
@@ -0,0 +1,84 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.fastjson import BACKENDS
+from chatbot.llm import build_payload
+
+WORDS = ("información", "matrícula", "becas", "¿cuándo", "empieza", "el", "plazo", "de", "solicitud?",
+         "según", "la", "normativa", "del", "año", "pasado", "también", "había", "que", "presentar",
+         "título", "académico", "compañía", "año", "después", "ñandú", "acción", "pregunta", "respuesta")
+
+
+def _text(rng, size):
+    # Texto en español de unos size bytes (UTF-8), con acentos y eñes
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word.encode('utf-8')) + 1
+    return ' '.join(words)
+
+
+def _turn(loads, dumps, body, history, chunks, reply):
+    # El JSON de un turno del chat en streaming: cuerpo de la petición, payload
+    # para el LLM, fragmentos SSE de la respuesta y eventos hacia el navegador
+    data = loads(body)
+    messages = history + [{"role": "user", "content": data['message']}]
+    dumps(build_payload(messages, stream=True))
+    for chunk in chunks:
+        loads(chunk)
+        dumps({'content': reply})
+    dumps({'response': reply, 'conversation_id': data['conversation_id']})
+
+
+class Command(BaseCommand):
+    help = "Mide el tiempo de CPU por petición del JSON del chat con cada backend de chatbot.fastjson"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=2000, help="Turnos por backend")
+        parser.add_argument('--message-kb', type=float, default=8, help="Tamaño de cada mensaje en KB")
+        parser.add_argument('--history', type=int, default=10, help="Mensajes de historial en el payload")
+        parser.add_argument('--chunks', type=int, default=50, help="Fragmentos SSE por respuesta")
+        parser.add_argument('--min-speedup', type=float, default=0,
+                            help="Fallar si orjson no es al menos este número de veces más rápido")
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        size = int(options['message_kb'] * 1024)
+        message = _text(rng, size)
+        body = BACKENDS['json'][1]({'message': message, 'conversation_id': 42, 'stream': True})
+        history = [{"role": 'user' if index % 2 == 0 else 'assistant', "content": _text(rng, size)}
+                   for index in range(options['history'])]
+        reply = _text(rng, max(size // options['chunks'], 1))
+        chunks = [
+            b'{"choices":[{"index":0,"delta":{"content":' + BACKENDS['json'][1](reply) + b'}}]}'
+        ] * options['chunks']
+
+        iterations = options['iterations']
+        results = {}
+        for name, (loads, dumps) in BACKENDS.items():
+            _turn(loads, dumps, body, history, chunks, reply)
+            start = time.process_time()
+            for _ in range(iterations):
+                _turn(loads, dumps, body, history, chunks, reply)
+            results[name] = (time.process_time() - start) / iterations
+            self.stdout.write(f"{name:>6}: {results[name] * 1e6:8.1f} µs de CPU por turno")
+
+        # Lo que costaba la ida y vuelta a UTF-8 de ChatMessage.save (dos mensajes por turno)
+        start = time.process_time()
+        for _ in range(iterations):
+            message.encode('utf-8').decode('utf-8')
+            reply.encode('utf-8').decode('utf-8')
+        self.stdout.write(f"ida y vuelta UTF-8 eliminada: {(time.process_time() - start) / iterations * 1e6:.1f} µs por turno")
+
+        if 'orjson' not in results:
+            self.stdout.write("orjson no está instalado: el chat usa la biblioteca estándar")
+            return
+        speedup = results['json'] / results['orjson']
+        self.stdout.write(f"orjson es {speedup:.1f}x más rápido ({size / 1024:.0f} KB por mensaje, "
+                          f"{options['history']} de historial, {options['chunks']} fragmentos)")
+        if speedup < options['min_speedup']:
+            raise CommandError(f"orjson por debajo de {options['min_speedup']}x")
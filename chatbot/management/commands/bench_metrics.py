@@ -0,0 +1,85 @@
+import os
+import time
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+
+from chatbot import metrics
+from chatbot.fake_llm import FakeLLMServer
+from chatbot.models import Conversation
+
+# Fases que anota una petición de chat sin streaming
+PHASES = ('parse', 'db', 'retrieve', 'prompt', 'cache', 'db', 'serialize')
+UPSTREAM_PHASES = ('upstream_connect', 'upstream_ttfb', 'upstream_total')
+
+
+class Command(BaseCommand):
+    help = "Mide el coste de la instrumentación de métricas frente al tiempo de una petición de chat"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=100_000,
+                            help="Peticiones simuladas para medir la instrumentación")
+        parser.add_argument('--requests', type=int, default=200,
+                            help="Peticiones reales al endpoint de chat (DeepSeek falso, sin latencia)")
+        parser.add_argument('--max-overhead', type=float, default=1.0,
+                            help="Porcentaje máximo admitido del tiempo de la petición")
+
+    def handle(self, *args, **options):
+        per_request = self._instrumentation_cost(options['iterations'])
+        request_time = self._request_time(options['requests'])
+        overhead = per_request / request_time * 100
+        self.stdout.write(
+            f"instrumentación {per_request * 1e6:.1f} µs/petición | "
+            f"petición de chat p50 {request_time * 1000:.2f} ms | sobrecoste {overhead:.2f}%"
+        )
+        if overhead > options['max_overhead']:
+            raise CommandError(f"La instrumentación supera el {options['max_overhead']}% del tiempo de petición")
+
+    def _instrumentation_cost(self, iterations):
+        request = SimpleNamespace(resolver_match=SimpleNamespace(url_name='bench_metrics'), method='POST')
+        response = SimpleNamespace(status_code=200)
+
+        def instrumented():
+            timer, token = metrics.start_request()
+            for name in PHASES:
+                with metrics.phase(name):
+                    pass
+            for name in UPSTREAM_PHASES:
+                metrics.record_phase(name, 0.001)
+            metrics.finish_request(request, response, timer, token)
+
+        def bare():
+            for name in PHASES:
+                pass
+            for name in UPSTREAM_PHASES:
+                pass
+
+        timings = {}
+        for label, body in (('bare', bare), ('instrumented', instrumented)):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                body()
+            timings[label] = time.perf_counter() - start
+        return max(0.0, timings['instrumented'] - timings['bare']) / iterations
+
+    def _request_time(self, requests):
+        os.environ.setdefault('DEEPSEEK_API_KEY', 'bench')
+        server = FakeLLMServer().start()
+        last_id = Conversation.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        try:
+            with override_settings(DEBUG=False, ALLOWED_HOSTS=['*'], DEEPSEEK_API_URL=server.url,
+                                   CHATBOT_THROTTLE_ENABLED=False):
+                client = Client(HTTP_HOST='localhost')
+                timings = []
+                for i in range(requests):
+                    start = time.perf_counter()
+                    response = client.post('/', {'message': f'Hola {i}'}, content_type='application/json')
+                    timings.append(time.perf_counter() - start)
+                    if response.status_code != 200:
+                        raise CommandError(f"El endpoint de chat respondió {response.status_code}")
+        finally:
+            server.stop()
+            Conversation.objects.filter(id__gt=last_id).delete()
+        timings.sort()
+        return timings[len(timings) // 2]
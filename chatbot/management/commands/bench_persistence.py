@@ -0,0 +1,48 @@
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from chatbot.models import ChatMessage, Conversation
+from chatbot.persistence import WriteBehindBuffer
+
+
+class Command(BaseCommand):
+    help = "Compara filas/s de ChatMessage.objects.create por fila frente al buffer write-behind"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=5000)
+        parser.add_argument('--batch-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        conversation = Conversation.objects.create(title="bench_persistence")
+        try:
+            start = time.perf_counter()
+            for i in range(rows):
+                ChatMessage.objects.create(conversation=conversation, role='user', content=f"mensaje {i}")
+            per_row = time.perf_counter() - start
+
+            with tempfile.TemporaryDirectory() as directory:
+                buffer = WriteBehindBuffer(directory, batch_size=options['batch_size'], flush_interval=0.05)
+                start = time.perf_counter()
+                for i in range(rows):
+                    buffer.add(conversation.id, 'user', f"mensaje {i}")
+                enqueue = time.perf_counter() - start
+                # Esperar a que el hilo vacíe el buffer para medir el rendimiento real
+                while buffer.stats()['pending'] or buffer.flushed < rows:
+                    buffer.flush()
+                    time.sleep(0.001)
+                write_behind = time.perf_counter() - start
+                batches = buffer.batches
+
+            stored = ChatMessage.objects.filter(conversation=conversation).count()
+        finally:
+            conversation.delete()
+
+        self.stdout.write(
+            f"create por fila: {rows / per_row:,.0f} filas/s ({per_row / rows * 1e6:.0f} µs por mensaje en la petición)\n"
+            f"write-behind:    {rows / write_behind:,.0f} filas/s en {batches} lotes "
+            f"({enqueue / rows * 1e6:.0f} µs por mensaje en la petición)\n"
+            f"filas guardadas: {stored} de {rows * 2}"
+        )
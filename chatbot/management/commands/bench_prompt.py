@@ -0,0 +1,62 @@
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.prompt import PromptBuilder, count_tokens
+
+WORDS = ("hola", "conversación", "¿qué", "tal?", "necesito", "ayuda", "con", "una", "consulta", "sobre",
+         "Django", "PostgreSQL", "rendimiento", "de", "la", "base", "datos", "gracias", "ejemplo:", "código")
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+class Command(BaseCommand):
+    help = "Mide cuántos prompts por segundo ensambla PromptBuilder con recuentos de tokens guardados"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50_000, help="Prompts a ensamblar")
+        parser.add_argument('--history', type=int, default=20, help="Mensajes de historial por prompt")
+        parser.add_argument('--words', type=int, default=60, help="Palabras por mensaje del historial")
+        parser.add_argument('--budget', type=int, default=settings.CHATBOT_PROMPT_TOKEN_BUDGET,
+                            help="Presupuesto de tokens del prompt")
+        parser.add_argument('--min-rate', type=float, default=20_000,
+                            help="Fallar por debajo de estos prompts por segundo")
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        builder = PromptBuilder(settings.CHATBOT_SYSTEM_PROMPT, options['budget'])
+        history = []
+        for index in range(options['history']):
+            content = _text(rng, options['words'])
+            history.append({"role": 'user' if index % 2 == 0 else 'assistant', "content": content,
+                            "tokens": count_tokens(content)})
+        summary = _text(rng, 200)
+        message = _text(rng, 30)
+        message_tokens = count_tokens(message)
+        messages, tokens = builder.build(summary, history, message, message_tokens)
+
+        iterations = options['iterations']
+        start = time.perf_counter()
+        for _ in range(iterations):
+            builder.build(summary, history, message, message_tokens)
+        elapsed = time.perf_counter() - start
+        rate = iterations / elapsed
+
+        # Lo que costaría volver a contar el historial en cada turno
+        start = time.perf_counter()
+        for _ in range(max(iterations // 100, 1)):
+            for turn in history:
+                count_tokens(turn['content'])
+        recount = (time.perf_counter() - start) / max(iterations // 100, 1)
+
+        self.stdout.write(
+            f"{rate:,.0f} prompts/s ({elapsed / iterations * 1e6:.1f} µs/prompt) | "
+            f"{len(messages)} mensajes, ~{tokens} tokens | "
+            f"recontar el historial costaría {recount * 1e6:.1f} µs/prompt"
+        )
+        if rate < options['min_rate']:
+            raise CommandError(f"PromptBuilder por debajo de {options['min_rate']:,.0f} prompts/s")
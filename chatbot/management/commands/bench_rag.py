@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot import rag
+from chatbot.benchmark import percentile, private_bytes, rss_bytes
+from chatbot.embeddings import DIMENSIONS
+
+
+def _growth(before, after):
+    # Sin /proc ni getrusage (Windows) no hay medida de memoria
+    if before is None or after is None:
+        return "n/d"
+    return f"+{(after - before) / 2 ** 20:.0f} MB"
+
+TERMS_PER_CHUNK = 24
+VOCABULARY = 50_000
+TOPICS = 4096
+
+
+class Command(BaseCommand):
+    help = "Mide la latencia de recuperación de chatbot.rag sobre un índice sintético de N fragmentos"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunks', type=int, default=1_000_000, help="Fragmentos del índice sintético")
+        parser.add_argument('--queries', type=int, default=200, help="Consultas a medir")
+        parser.add_argument('--index-dir', help="Reutilizar (o crear y conservar) el índice en este directorio")
+        parser.add_argument('--probes', type=int, default=8, help="Listas IVF recorridas por consulta")
+        parser.add_argument('--max-ms', type=float, default=20, help="Fallar si el p95 supera estos milisegundos")
+
+    def handle(self, *args, **options):
+        directory = options['index_dir'] or tempfile.mkdtemp(prefix='bench-rag-')
+        vocabulary = [f"termino{i}" for i in range(VOCABULARY)]
+        try:
+            if not os.path.exists(os.path.join(directory, rag.MANIFEST)):
+                start = time.perf_counter()
+                self._build(directory, vocabulary, options['chunks'])
+                self.stdout.write(f"Índice de {options['chunks']:,} fragmentos creado en {time.perf_counter() - start:.0f} s")
+            self._measure(directory, vocabulary, options)
+        finally:
+            if not options['index_dir']:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def _build(self, directory, vocabulary, size):
+        # Vectores agrupados en temas (como documentos reales) y términos con
+        # distribución de Zipf: unos pocos aparecen en muchísimos fragmentos
+        rng = np.random.default_rng(0)
+        topics = rng.standard_normal((TOPICS, DIMENSIONS)).astype(np.float32)
+        vectors = np.empty((size, DIMENSIONS), dtype=np.float32)
+        for start in range(0, size, 65536):
+            end = min(start + 65536, size)
+            batch = topics[rng.integers(0, TOPICS, end - start)]
+            batch += rng.standard_normal(batch.shape, dtype=np.float32)
+            vectors[start:end] = batch / np.linalg.norm(batch, axis=1, keepdims=True)
+
+        terms = (rng.zipf(1.3, size=(size, TERMS_PER_CHUNK)) - 1) % len(vocabulary)
+        buckets = np.array([rag.bucket(word) for word in vocabulary], dtype=np.int64)
+        chunk_postings = (
+            np.repeat(np.arange(size, dtype=np.int32), TERMS_PER_CHUNK),
+            buckets[terms.ravel()],
+            np.ones(size * TERMS_PER_CHUNK, dtype=np.float32),
+        )
+        lengths = np.full(size, TERMS_PER_CHUNK, dtype=np.float32)
+        records = (
+            {'source': f"sintetico/{chunk_id // 50}.txt",
+             'text': ' '.join(vocabulary[term] for term in terms[chunk_id]),
+             'tokens': 3 * TERMS_PER_CHUNK}
+            for chunk_id in range(size)
+        )
+        os.makedirs(directory, exist_ok=True)
+        rag.write_segment(os.path.join(directory, 'seg-000001'), records, vectors, chunk_postings, lengths)
+        rag._write_json(os.path.join(directory, rag.MANIFEST),
+                        {'generation': 1, 'segments': [{'name': 'seg-000001', 'deleted': []}]})
+
+    def _measure(self, directory, vocabulary, options):
+        rng = np.random.default_rng(1)
+        private_before, rss_before = private_bytes(), rss_bytes()
+        index = rag.RagIndex(directory, probes=options['probes'])
+        queries = [
+            ' '.join(vocabulary[term] for term in (rng.zipf(1.3, size=rng.integers(3, 8)) - 1) % len(vocabulary))
+            for _ in range(options['queries'] + 20)
+        ]
+        for query in queries[:20]:
+            index.search(query)
+        latencies = []
+        for query in queries[20:]:
+            start = time.perf_counter()
+            index.search(query)
+            latencies.append(time.perf_counter() - start)
+
+        index_bytes = sum(
+            os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names
+        )
+        p95 = percentile(latencies, 95) * 1000
+        self.stdout.write(
+            f"{index.stats()['chunks']:,} fragmentos ({index_bytes / 2 ** 20:,.0f} MB en disco) | "
+            f"p50 {percentile(latencies, 50) * 1000:.1f} ms, p95 {p95:.1f} ms, "
+            f"p99 {percentile(latencies, 99) * 1000:.1f} ms | "
+            f"memoria propia {_growth(private_before, private_bytes())}, "
+            f"RSS con páginas mapeadas {_growth(rss_before, rss_bytes())}"
+        )
+        if p95 > options['max_ms']:
+            raise CommandError(f"La recuperación supera {options['max_ms']} ms en el p95")
@@ -0,0 +1,53 @@
+import random
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from chatbot.embeddings import DIMENSIONS, embed
+from chatbot.semantic_cache import SemanticCache
+
+WORDS = (
+    "horario atención biblioteca matrícula curso inscripción beca examen nota "
+    "profesor aula sede pago certificado título práctica laboratorio calendario "
+    "secretaría trámite plazo requisito carrera asignatura campus correo"
+).split()
+
+
+class Command(BaseCommand):
+    help = "Mide la búsqueda en la caché semántica con muchas entradas"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--entries', type=int, default=100_000)
+        parser.add_argument('--queries', type=int, default=500)
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        with tempfile.TemporaryDirectory() as directory:
+            # Escribe los ficheros directamente: añadir 100k entradas una a una es lento
+            questions = [' '.join(rng.sample(WORDS, 4)) for _ in range(options['entries'])]
+            vectors = np.stack([embed(q) for q in questions]).astype(np.float32)
+            vectors.tofile(f"{directory}/vectors.f32")
+            with open(f"{directory}/entries.jsonl", 'w', encoding='utf-8') as entries_file:
+                for i in range(len(questions)):
+                    entries_file.write(f'{{"question": "", "answer": "respuesta {i}"}}\n')
+
+            start = time.perf_counter()
+            cache = SemanticCache(directory, max_entries=options['entries'] + 1)
+            load_time = time.perf_counter() - start
+
+            timings = []
+            for _ in range(options['queries']):
+                question = ' '.join(rng.sample(WORDS, 4))
+                start = time.perf_counter()
+                cache.lookup(question)
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+
+        self.stdout.write(
+            f"{len(cache)} entradas ({DIMENSIONS} dimensiones), carga {load_time:.2f}s | "
+            f"lookup p50 {timings[len(timings) // 2] * 1000:.2f} ms, "
+            f"p99 {timings[int(len(timings) * 0.99)] * 1000:.2f} ms | "
+            f"aciertos {cache.hits}/{options['queries']}"
+        )
@@ -0,0 +1,117 @@
+import random
+import re
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from chatbot.models import ChatMessage, Conversation
+
+SEED_TITLE = "explain_queries seed"
+
+# Nodos del plan de PostgreSQL que indican un recorrido completo o una ordenación extra
+POSTGRES_WARNING_RE = re.compile(r'Seq Scan|^\s*(->\s*)?Sort\s+\(')
+
+
+def _hot_queries(conversation_id, summarized_through, retention_cutoff):
+    # Las consultas que el chat ejecuta en cada petición o en cada barrido
+    return [
+        ("conversaciones recientes",
+         Conversation.objects.order_by('-last_updated', '-id').values('id', 'title', 'last_updated')[:20]),
+        ("ventana de historial",
+         ChatMessage.objects.filter(conversation_id=conversation_id, id__gt=summarized_through)
+         .order_by('-timestamp').values_list('role', 'content')[:20]),
+        ("página de mensajes (keyset)",
+         ChatMessage.objects.filter(conversation_id=conversation_id, timestamp__lte=retention_cutoff)
+         .filter(Q(timestamp__lt=retention_cutoff) | Q(timestamp=retention_cutoff, id__lt=summarized_through))
+         .order_by('-timestamp', '-id').values('id', 'role', 'content', 'timestamp')[:51]),
+        ("mensajes sin resumir",
+         ChatMessage.objects.filter(conversation_id=conversation_id, id__gt=summarized_through).values('id')),
+        ("actualizar conversación",
+         Conversation.objects.filter(pk=conversation_id).values('id')),
+        ("barrido de retención",
+         ChatMessage.objects.filter(timestamp__lt=retention_cutoff).values_list('id', flat=True)[:1000]),
+    ]
+
+
+def _is_sequential_scan(vendor, line):
+    if vendor == 'sqlite':
+        # "SCAN tabla" sin índice es un recorrido completo; "SEARCH" usa índice
+        step = line.lstrip(' |-`')
+        return (step.startswith('SCAN') and 'INDEX' not in step) or 'USE TEMP B-TREE' in step
+    return bool(POSTGRES_WARNING_RE.search(line))
+
+
+class Command(BaseCommand):
+    help = "Ejecuta EXPLAIN sobre las consultas más frecuentes del chat y señala recorridos secuenciales"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0,
+                            help="Mensajes a generar antes de analizar (p. ej. 2000000)")
+        parser.add_argument('--per-conversation', type=int, default=40)
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--analyze', action='store_true',
+                            help="EXPLAIN ANALYZE en PostgreSQL (ejecuta las consultas)")
+        parser.add_argument('--cleanup', action='store_true', help="Borra los datos generados al terminar")
+        parser.add_argument('--strict', action='store_true', help="Falla si algún plan tiene recorridos secuenciales")
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            self._seed(options['seed'], options['per_conversation'], options['batch_size'])
+
+        conversation_id = Conversation.objects.aggregate(Max('id'))['id__max']
+        if conversation_id is None:
+            raise CommandError("No hay conversaciones: usa --seed para generar datos")
+
+        vendor = connection.vendor
+        explain_options = {'analyze': True} if options['analyze'] and vendor == 'postgresql' else {}
+        flagged = []
+        try:
+            for name, queryset in _hot_queries(conversation_id, 0, timezone.now() - timedelta(days=90)):
+                plan = queryset.explain(**explain_options)
+                problems = [line for line in plan.splitlines() if _is_sequential_scan(vendor, line)]
+                style = self.style.WARNING if problems else self.style.SUCCESS
+                self.stdout.write(style(f"== {name} {'(REVISAR)' if problems else '(ok)'}"))
+                self.stdout.write(plan)
+                if problems:
+                    flagged.append(name)
+        finally:
+            if options['cleanup']:
+                ChatMessage.objects.filter(conversation__title=SEED_TITLE).delete()
+                Conversation.objects.filter(title=SEED_TITLE).delete()
+
+        if flagged and options['strict']:
+            raise CommandError(f"Consultas con recorridos secuenciales: {', '.join(flagged)}")
+
+    def _seed(self, total, per_conversation, batch_size):
+        rng = random.Random(0)
+        now = timezone.now()
+        conversations = Conversation.objects.bulk_create(
+            [Conversation(title=SEED_TITLE) for _ in range(max(1, total // per_conversation))],
+            batch_size=batch_size
+        )
+        start = time.perf_counter()
+        batch = []
+        created = 0
+        for i in range(total):
+            conversation = conversations[i // per_conversation % len(conversations)]
+            batch.append(ChatMessage(
+                conversation_id=conversation.id,
+                role='user' if i % 2 == 0 else 'assistant',
+                content=f"mensaje de prueba {i}",
+                timestamp=now - timedelta(minutes=rng.randrange(0, 60 * 24 * 365)),
+            ))
+            if len(batch) >= batch_size:
+                ChatMessage.objects.bulk_create(batch)
+                created += len(batch)
+                batch = []
+        if batch:
+            ChatMessage.objects.bulk_create(batch)
+            created += len(batch)
+        self.stdout.write(f"{created} mensajes en {len(conversations)} conversaciones ({time.perf_counter() - start:.1f}s)")
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE chatbot_conversation, chatbot_chatmessage")
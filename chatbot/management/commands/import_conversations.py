@@ -0,0 +1,55 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+try:
+    import resource
+except ImportError:  # Windows: el resumen sale sin el pico de memoria
+    resource = None
+
+from chatbot import transcripts
+
+
+class Command(BaseCommand):
+    help = "Importa conversaciones exportadas con export_conversations (ids nuevos; COPY en PostgreSQL)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help="Fichero .jsonl.gz o directorio Parquet")
+        parser.add_argument('--batch-size', type=int, default=5000, help="Mensajes por COPY/bulk_create")
+        parser.add_argument('--resume', action='store_true', help="Salta lo ya importado según el checkpoint")
+
+    def handle(self, *args, **options):
+        source = options['input'].rstrip('/')
+        if not os.path.exists(source):
+            raise CommandError(f"No existe {source}")
+        checkpoint_path = f"{source}.import-checkpoint"
+        state = transcripts.load_checkpoint(checkpoint_path) if options['resume'] else None
+        state = state or {'position': 0, 'conversations': 0, 'messages': 0}
+        base = dict(state)
+
+        def on_batch(position, conversations, messages):
+            state.update(position=position,
+                         conversations=base['conversations'] + conversations,
+                         messages=base['messages'] + messages)
+            transcripts.save_checkpoint(checkpoint_path, state)
+            self.stdout.write(f"{state['conversations']} conversaciones, {state['messages']} mensajes", ending='\r')
+            self.stdout.flush()
+
+        try:
+            records = transcripts.iter_parquet(source) if os.path.isdir(source) else transcripts.iter_jsonl(source)
+            start = time.perf_counter()
+            transcripts.import_records(records, options['batch_size'], skip=base['position'], on_batch=on_batch)
+        except (ImportError, ValueError) as e:
+            raise CommandError(str(e))
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        elapsed = time.perf_counter() - start
+        peak = ''
+        if resource is not None:
+            peak = f", RSS máx. {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB"
+        self.stdout.write(self.style.SUCCESS(
+            f"{state['conversations']} conversaciones y {state['messages']} mensajes importados "
+            f"({elapsed:.1f}s{peak})"
+        ))
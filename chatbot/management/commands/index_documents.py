@@ -0,0 +1,36 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot import rag
+
+
+class Command(BaseCommand):
+    help = "Indexa (de forma incremental) documentos locales para las respuestas con contexto"
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help="Ficheros o directorios (.txt, .md, .rst, .html)")
+        parser.add_argument('--index-dir', default=settings.CHATBOT_RAG_DIR)
+        parser.add_argument('--chunk-tokens', type=int, default=settings.CHATBOT_RAG_CHUNK_TOKENS,
+                            help="Tamaño aproximado de cada fragmento en tokens")
+        parser.add_argument('--overlap', type=int, default=settings.CHATBOT_RAG_CHUNK_OVERLAP,
+                            help="Tokens que se repiten entre fragmentos consecutivos")
+        parser.add_argument('--max-segments', type=int, default=settings.CHATBOT_RAG_MAX_SEGMENTS,
+                            help="Con más segmentos se fusionan en uno")
+        parser.add_argument('--compact', action='store_true', help="Fusionar todos los segmentos en uno")
+
+    def handle(self, *args, **options):
+        if options['overlap'] >= options['chunk_tokens']:
+            raise CommandError("--overlap debe ser menor que --chunk-tokens")
+        start = time.perf_counter()
+        stats = rag.index_documents(
+            options['index_dir'], options['paths'],
+            chunk_tokens=options['chunk_tokens'], overlap=options['overlap'],
+            max_segments=options['max_segments'], compact=options['compact'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"{stats['added']} nuevos, {stats['updated']} modificados, {stats['removed']} eliminados, "
+            f"{stats['unchanged']} sin cambios | {stats['chunks']} fragmentos en {stats['segments']} "
+            f"segmentos | {time.perf_counter() - start:.1f} s"
+        ))
@@ -0,0 +1,39 @@
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot import jobs
+
+
+class Command(BaseCommand):
+    help = "Ejecuta los trabajos en segundo plano de la cola (títulos, persistencia...)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.CHATBOT_WORKERS,
+                            help="Hilos que consumen la cola en este proceso")
+        parser.add_argument('--kinds', nargs='+', metavar='KIND',
+                            help="Tipos de trabajo a atender (por defecto todos)")
+        parser.add_argument('--poll-interval', type=float, default=settings.CHATBOT_WORKER_POLL_INTERVAL,
+                            help="Segundos de espera cuando la cola está vacía")
+        parser.add_argument('--once', action='store_true', help="Vaciar la cola y terminar")
+
+    def handle(self, *args, **options):
+        jobs.load_handlers()
+        unknown = set(options['kinds'] or ()) - set(jobs.HANDLERS)
+        if unknown:
+            raise CommandError(f"Tipos de trabajo desconocidos: {', '.join(sorted(unknown))}")
+        pool = jobs.WorkerPool(options['workers'], options['kinds'], options['poll_interval'])
+
+        # Parada ordenada: los hilos terminan el lote en curso y salen
+        def stop(signum, frame):
+            self.stdout.write("Deteniendo los workers...")
+            pool.stop()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        self.stdout.write(
+            f"{options['workers']} workers atendiendo: {', '.join(options['kinds'] or sorted(jobs.HANDLERS))}"
+        )
+        processed = pool.run(once=options['once'])
+        self.stdout.write(f"Trabajos completados: {processed}")
@@ -0,0 +1,229 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.decorators import sync_and_async_middleware
+
+logger = logging.getLogger('chatbot.requests')
+
+# Cubren desde una escritura en la base de datos hasta una respuesta larga del LLM
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, labels)} {_number(value)}")
+        return lines
+
+
+# Histograma con buckets fijos al estilo de Prometheus: observar es una
+# búsqueda binaria y dos sumas, sin guardar las muestras
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # [cuenta por bucket (el último es +Inf), suma, total]
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            return series[2] if series else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        label_names = self.label_names + ('le',)
+        with self._lock:
+            series = sorted((labels, [list(counts), total, count]) for labels, (counts, total, count) in self._series.items())
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels(label_names, labels + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    'chatbot_request_duration_seconds', "Tiempo hasta tener la respuesta (las cabeceras, en streaming)",
+    ('view', 'method', 'status')
+)
+PHASE_SECONDS = Histogram(
+    'chatbot_request_phase_seconds', "Tiempo por fase de la petición", ('view', 'phase')
+)
+LLM_TOKENS = Counter(
+    'chatbot_llm_tokens_total', "Tokens consumidos según el campo usage del proveedor", ('provider', 'type')
+)
+
+METRICS = [REQUEST_SECONDS, PHASE_SECONDS, LLM_TOKENS]
+
+
+# Tiempos de una petición en curso, por fase. Vive en una ContextVar para que
+# cualquier capa (vista, persistencia, cliente HTTP) anote sin recibirlo
+class RequestTimer:
+    __slots__ = ('started', 'phases')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+_current = ContextVar('chatbot_request_timer', default=None)
+
+
+def record_phase(phase, seconds):
+    # Dentro de una petición se suma a su fase; fuera (p. ej. el final de un
+    # stream, que se consume después de devolver la respuesta) va directo al histograma
+    timer = _current.get()
+    if timer is not None:
+        timer.add(phase, seconds)
+    else:
+        PHASE_SECONDS.observe(seconds, 'background', phase)
+
+
+@contextmanager
+def phase(name):
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - started)
+
+
+def record_tokens(provider, usage):
+    if not usage:
+        return
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        if usage.get(kind):
+            LLM_TOKENS.inc(usage[kind], provider or '', kind.split('_')[0])
+
+
+def start_request():
+    timer = RequestTimer()
+    return timer, _current.set(timer)
+
+
+def finish_request(request, response, timer, token):
+    match = request.resolver_match
+    view = match.url_name if match is not None else 'unmatched'
+    finish(view, request.method, response.status_code, timer, token)
+
+
+def finish(view, method, status, timer, token):
+    # Cierra la medición de una petición (o de un turno del canal WebSocket)
+    _current.reset(token)
+    elapsed = time.perf_counter() - timer.started
+    REQUEST_SECONDS.observe(elapsed, view, method, status)
+    for name, seconds in timer.phases.items():
+        PHASE_SECONDS.observe(seconds, view, name)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({
+            'view': view,
+            'method': method,
+            'status': status,
+            'ms': round(elapsed * 1000, 2),
+            'phases': {name: round(seconds * 1000, 2) for name, seconds in timer.phases.items()},
+        }))
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    # Va el primero en MIDDLEWARE para que el total incluya al resto
+    if not settings.CHATBOT_METRICS_ENABLED:
+        raise MiddlewareNotUsed
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            timer, token = start_request()
+            try:
+                response = await get_response(request)
+            except BaseException:
+                _current.reset(token)
+                raise
+            finish_request(request, response, timer, token)
+            return response
+    else:
+        def middleware(request):
+            timer, token = start_request()
+            try:
+                response = get_response(request)
+            except BaseException:
+                _current.reset(token)
+                raise
+            finish_request(request, response, timer, token)
+            return response
+    return middleware
+
+
+def render(extra=()):
+    # Formato de texto de Prometheus (0.0.4). extra: métricas ya calculadas
+    # como (nombre, tipo, ayuda, [(etiquetas, valor)])
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for name, kind, help_text, samples in extra:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{_labels(tuple(labels), tuple(labels.values()))} {_number(value)}")
+    return '\n'.join(lines) + '\n'
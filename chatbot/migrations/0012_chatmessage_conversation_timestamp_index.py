@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-17 19:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0011_remove_chatmessage_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['conversation', 'timestamp'], name='chatmessage_conv_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2 on 2026-10-17 19:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0013_conversationsummary'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='chatmessage',
+            options={},
+        ),
+        migrations.AlterModelOptions(
+            name='conversation',
+            options={},
+        ),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='conversation',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chatbot.conversation'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['timestamp'], name='chatmessage_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['-last_updated', '-id'], name='conversation_recent_idx'),
+        ),
+    ]
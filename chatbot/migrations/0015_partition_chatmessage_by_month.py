@@ -0,0 +1,122 @@
+# Generated by Django 4.2 on 2026-10-17 21:10
+
+from datetime import datetime, timezone
+
+from django.db import migrations, models
+
+TABLE = 'chatbot_chatmessage'
+# Particiones que se crean por adelantado; después las mantiene archive_messages
+MONTHS_AHEAD = 3
+
+
+def _next_month(value):
+    return datetime(value.year + value.month // 12, value.month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def _create_indexes(cursor):
+    cursor.execute(f'CREATE INDEX chatmessage_conv_ts_idx ON {TABLE} (conversation_id, "timestamp")')
+    cursor.execute(f'CREATE INDEX chatmessage_ts_idx ON {TABLE} ("timestamp")')
+
+
+def partition_messages(apps, schema_editor):
+    # Solo PostgreSQL: en SQLite la tabla sigue siendo normal
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {TABLE} RENAME TO {TABLE}_unpartitioned')
+        cursor.execute(f'ALTER TABLE {TABLE}_unpartitioned RENAME CONSTRAINT {TABLE}_pkey TO {TABLE}_unpartitioned_pkey')
+        cursor.execute(f'ALTER TABLE {TABLE}_unpartitioned ALTER COLUMN id DROP IDENTITY IF EXISTS')
+        cursor.execute(f'ALTER TABLE {TABLE}_unpartitioned ALTER COLUMN id DROP DEFAULT')
+        cursor.execute(f'DROP SEQUENCE IF EXISTS {TABLE}_id_seq')
+        cursor.execute('DROP INDEX IF EXISTS chatmessage_conv_ts_idx, chatmessage_ts_idx')
+
+        # Las columnas identity no se admiten en tablas particionadas hasta
+        # PostgreSQL 17, así que el id sale de una secuencia propia. La clave
+        # primaria tiene que incluir la columna de partición.
+        cursor.execute(f'CREATE SEQUENCE {TABLE}_id_seq')
+        cursor.execute(f"""
+            CREATE TABLE {TABLE} (
+                id bigint NOT NULL DEFAULT nextval('{TABLE}_id_seq'),
+                role varchar(50) NOT NULL,
+                content text NOT NULL,
+                "timestamp" timestamp with time zone NOT NULL,
+                conversation_id bigint NULL
+                    REFERENCES chatbot_conversation (id) DEFERRABLE INITIALLY DEFERRED,
+                PRIMARY KEY (id, "timestamp")
+            ) PARTITION BY RANGE ("timestamp")
+        """)
+        cursor.execute(f'ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id')
+
+        cursor.execute(f'SELECT min("timestamp"), max(id) FROM {TABLE}_unpartitioned')
+        first, last_id = cursor.fetchone()
+        now = datetime.now(timezone.utc)
+        month = datetime((first or now).year, (first or now).month, 1, tzinfo=timezone.utc)
+        until = now
+        for _ in range(MONTHS_AHEAD):
+            until = _next_month(until)
+        while month <= until:
+            cursor.execute(
+                f'CREATE TABLE {TABLE}_p{month:%Y%m} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)',
+                [month, _next_month(month)]
+            )
+            month = _next_month(month)
+        # Red de seguridad para fechas fuera de las particiones creadas
+        cursor.execute(f'CREATE TABLE {TABLE}_default PARTITION OF {TABLE} DEFAULT')
+
+        cursor.execute(f"""
+            INSERT INTO {TABLE} (id, role, content, "timestamp", conversation_id)
+            SELECT id, role, content, "timestamp", conversation_id FROM {TABLE}_unpartitioned
+        """)
+        # Comprobar ya la clave ajena diferida de las filas copiadas: con eventos
+        # de trigger pendientes PostgreSQL no deja crear los índices
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        cursor.execute(f"SELECT setval('{TABLE}_id_seq', %s, false)", [(last_id or 0) + 1])
+        cursor.execute(f'DROP TABLE {TABLE}_unpartitioned')
+        # Índices sobre la tabla padre: PostgreSQL los crea en cada partición
+        _create_indexes(cursor)
+
+
+def unpartition_messages(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {TABLE} RENAME TO {TABLE}_partitioned')
+        cursor.execute(f'ALTER TABLE {TABLE}_partitioned RENAME CONSTRAINT {TABLE}_pkey TO {TABLE}_partitioned_pkey')
+        cursor.execute('DROP INDEX IF EXISTS chatmessage_conv_ts_idx, chatmessage_ts_idx')
+        cursor.execute(f'ALTER SEQUENCE {TABLE}_id_seq RENAME TO {TABLE}_partitioned_id_seq')
+        cursor.execute(f"""
+            CREATE TABLE {TABLE} (
+                id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+                role varchar(50) NOT NULL,
+                content text NOT NULL,
+                "timestamp" timestamp with time zone NOT NULL,
+                conversation_id bigint NULL
+                    REFERENCES chatbot_conversation (id) DEFERRABLE INITIALLY DEFERRED
+            )
+        """)
+        cursor.execute(f"""
+            INSERT INTO {TABLE} (id, role, content, "timestamp", conversation_id)
+            SELECT id, role, content, "timestamp", conversation_id FROM {TABLE}_partitioned
+        """)
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence('{TABLE}', 'id'), coalesce(max(id), 0) + 1, false) FROM {TABLE}"
+        )
+        cursor.execute(f'DROP TABLE {TABLE}_partitioned CASCADE')
+        _create_indexes(cursor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0014_indexes_for_access_patterns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(partition_messages, unpartition_messages),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2 on 2026-10-17 21:40
+
+from django.db import migrations
+
+TABLE = 'chatbot_chatmessage'
+
+
+def add_search_vector(apps, schema_editor):
+    # Solo PostgreSQL; en SQLite busca el índice invertido de chatbot.search.
+    # La columna generada se mantiene sola en cada INSERT/UPDATE (también en
+    # COPY) y, al ser una tabla particionada, el GIN se crea en cada partición.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"""
+            ALTER TABLE {TABLE} ADD COLUMN search_vector tsvector
+            GENERATED ALWAYS AS (to_tsvector('spanish'::regconfig, coalesce(content, ''))) STORED
+        """)
+        cursor.execute(f'CREATE INDEX chatmessage_search_idx ON {TABLE} USING gin (search_vector)')
+
+
+def remove_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('DROP INDEX IF EXISTS chatmessage_search_idx')
+        cursor.execute(f'ALTER TABLE {TABLE} DROP COLUMN IF EXISTS search_vector')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0015_partition_chatmessage_by_month'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_search_vector, remove_search_vector),
+    ]
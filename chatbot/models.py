@@ -1,17 +1,26 @@
 from django.db import models
 from django.utils import timezone
 
+from .prompt import count_tokens
+
 # Modelo para representar una conversación
 class Conversation(models.Model):
     title = models.CharField(max_length=200)
     created_at = models.DateTimeField(auto_now_add=True)
     last_updated = models.DateTimeField(auto_now=True)
+    # Días que se conservan sus mensajes; vacío = la retención global
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.title}"
 
     class Meta:
-        ordering = ['-last_updated']
+        # Sin ordering por defecto: cada consulta ordena explícitamente solo
+        # cuando lo necesita, en lugar de pagar un ORDER BY en todas
+        indexes = [
+            # Lista de conversaciones recientes (keyset por last_updated, id)
+            models.Index(fields=['-last_updated', '-id'], name='conversation_recent_idx'),
+        ]
 
 # Modelo para representar los mensajes en la conversación
 class ChatMessage(models.Model):
@@ -20,20 +29,77 @@ class ChatMessage(models.Model):
         ('user', 'User'),
     ]
     
-    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages', null=True)  # Relaciona solo con la conversación
+    # Relaciona solo con la conversación. Sin índice propio: el índice
+    # (conversation, timestamp) ya empieza por conversation_id
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages', null=True, db_index=False)
     role = models.CharField(max_length=50, choices=ROLE_CHOICES)
     content = models.TextField()
     timestamp = models.DateTimeField(default=timezone.now)
+    # Tokens del contenido (chatbot.prompt.count_tokens), calculados una vez al
+    # guardar; NULL en los mensajes anteriores a este campo
+    token_count = models.PositiveIntegerField(null=True, blank=True)
 
     class Meta:
+        # En PostgreSQL es una tabla particionada por mes de timestamp
+        # (migración 0015); la clave primaria real es (id, timestamp)
         db_table = 'chatbot_chatmessage'
-        ordering = ['timestamp']
+        indexes = [
+            # Ventana de historial: últimos mensajes de una conversación
+            models.Index(fields=['conversation', 'timestamp'], name='chatmessage_conv_ts_idx'),
+            # Barridos de retención por antigüedad
+            models.Index(fields=['timestamp'], name='chatmessage_ts_idx'),
+        ]
 
     def save(self, *args, **kwargs):
-        # Asegurarse de que el contenido sea UTF-8
-        if isinstance(self.content, str):
-            self.content = self.content.encode('utf-8').decode('utf-8')
+        if self.token_count is None:
+            self.token_count = count_tokens(self.content)
         super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.role}: {self.content[:50]}..."
+
+# Resumen acumulado de los mensajes antiguos de una conversación
+class ConversationSummary(models.Model):
+    conversation = models.OneToOneField(Conversation, on_delete=models.CASCADE, related_name='summary', primary_key=True)
+    content = models.TextField(blank=True)
+    # id del último ChatMessage incluido en el resumen
+    summarized_through = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Resumen de {self.conversation_id}: {self.content[:50]}..."
+
+
+# Trabajo pendiente de la cola en base de datos (chatbot.jobs). Los que
+# terminan bien se borran; los que agotan sus intentos quedan como 'dead'
+class Job(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DEAD = 'dead'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DEAD, 'Dead'),
+    ]
+
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    # No se ejecuta antes de esta hora (reintentos con espera)
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=100, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Siguiente trabajo listo: índice parcial, solo los que están en cola
+            models.Index(fields=['run_at', 'id'], condition=models.Q(status='queued'), name='job_ready_idx'),
+            # Trabajos de un worker que murió sin terminarlos
+            models.Index(fields=['locked_at'], condition=models.Q(status='running'), name='job_running_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.status})"
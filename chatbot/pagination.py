@@ -0,0 +1,54 @@
+import base64
+import json
+
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+# Cursores keyset opacos: la posición del último elemento devuelto (p. ej.
+# [rank, id] o [last_updated, id]) serializada en base64 para la URL
+def encode_cursor(values):
+    # Fechas con isoformat completo: truncar microsegundos saltaría filas
+    raw = json.dumps(values, separators=(',', ':'), default=lambda value: value.isoformat()).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        raise InvalidCursor("Cursor no válido")
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidCursor("Cursor no válido")
+    return values
+
+
+def page_size(value, default=20, maximum=100):
+    # Tamaño de página pedido por el cliente, acotado a [1, maximum]
+    if value in (None, ''):
+        return default
+    return max(1, min(int(value), maximum))
+
+
+def keyset_page(queryset, fields, after, limit):
+    # Página ordenada de forma descendente por fields (el último debe ser
+    # único, p. ej. id). En lugar de OFFSET filtra por la posición del último
+    # elemento de la página anterior, así que cualquier página cuesta lo mismo
+    # que la primera. Devuelve (filas, posición para la siguiente página).
+    if after is not None:
+        condition = Q()
+        for i, field in enumerate(fields):
+            equal = {name: value for name, value in zip(fields[:i], after)}
+            condition |= Q(**equal, **{f"{field}__lt": after[i]})
+        # La cota redundante sobre el primer campo permite buscar en el índice
+        # por rango; el OR solo se evalúa como filtro sobre los empates
+        queryset = queryset.filter(condition, **{f"{fields[0]}__lte": after[0]})
+    rows = list(queryset.order_by(*[f"-{field}" for field in fields])[:limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, [rows[-1][field] for field in fields]
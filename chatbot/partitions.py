@@ -0,0 +1,133 @@
+import logging
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+TABLE = 'chatbot_chatmessage'
+PARTITION_PREFIX = f'{TABLE}_p'
+DEFAULT_PARTITION = f'{TABLE}_default'
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1, tzinfo=dt_timezone.utc)
+
+
+def next_month(value):
+    return datetime(value.year + value.month // 12, value.month % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def partition_name(month):
+    return f"{PARTITION_PREFIX}{month:%Y%m}"
+
+
+def is_partitioned(using=connection):
+    # Solo PostgreSQL particiona; SQLite (pruebas) usa la tabla normal
+    if using.vendor != 'postgresql':
+        return False
+    with using.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = %s",
+            [TABLE]
+        )
+        return cursor.fetchone() is not None
+
+
+def list_partitions(using=connection):
+    # [(nombre, inicio del mes)] de las particiones mensuales, de la más antigua a la más nueva
+    with using.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = %s
+            """,
+            [TABLE]
+        )
+        names = [row[0] for row in cursor.fetchall()]
+    months = []
+    for name in names:
+        suffix = name[len(PARTITION_PREFIX):]
+        if name.startswith(PARTITION_PREFIX) and suffix.isdigit():
+            months.append((name, datetime.strptime(suffix, '%Y%m').replace(tzinfo=dt_timezone.utc)))
+    return sorted(months, key=lambda item: item[1])
+
+
+def default_partition_first(using=connection):
+    # Fecha más antigua de la partición por defecto: filas fuera de las
+    # particiones mensuales (p. ej. importadas con fechas anteriores)
+    with using.cursor() as cursor:
+        cursor.execute(f'SELECT min("timestamp") FROM "{DEFAULT_PARTITION}"')
+        return cursor.fetchone()[0]
+
+
+def create_partition(cursor, month):
+    cursor.execute(
+        f'CREATE TABLE IF NOT EXISTS "{partition_name(month)}" PARTITION OF "{TABLE}" '
+        f"FOR VALUES FROM (%s) TO (%s)",
+        [month, next_month(month)]
+    )
+
+
+def _default_has_rows(cursor, month):
+    cursor.execute(
+        f'SELECT 1 FROM "{DEFAULT_PARTITION}" WHERE "timestamp" >= %s AND "timestamp" < %s LIMIT 1',
+        [month, next_month(month)]
+    )
+    return cursor.fetchone() is not None
+
+
+def _split_from_default(cursor, month):
+    # PostgreSQL no deja crear la partición de un mes que ya tiene filas en la
+    # de por defecto: se desengancha, se crea la del mes, se mueven las filas
+    # y se vuelve a enganchar. Las columnas generadas (search_vector) se recalculan
+    cursor.execute(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_name = %s AND is_generated = 'NEVER' ORDER BY ordinal_position",
+        [TABLE]
+    )
+    columns = ', '.join(f'"{row[0]}"' for row in cursor.fetchall())
+    bounds = [month, next_month(month)]
+    # Sin eventos de trigger pendientes: PostgreSQL no deja alterar la tabla con ellos
+    cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+    cursor.execute(f'ALTER TABLE "{TABLE}" DETACH PARTITION "{DEFAULT_PARTITION}"')
+    create_partition(cursor, month)
+    cursor.execute(
+        f'INSERT INTO "{TABLE}" ({columns}) SELECT {columns} FROM "{DEFAULT_PARTITION}" '
+        f'WHERE "timestamp" >= %s AND "timestamp" < %s',
+        bounds
+    )
+    moved = cursor.rowcount
+    cursor.execute(f'DELETE FROM "{DEFAULT_PARTITION}" WHERE "timestamp" >= %s AND "timestamp" < %s', bounds)
+    cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+    cursor.execute(f'ALTER TABLE "{TABLE}" ATTACH PARTITION "{DEFAULT_PARTITION}" DEFAULT')
+    logger.warning("%d mensajes movidos de %s a %s", moved, DEFAULT_PARTITION, partition_name(month))
+
+
+def ensure_partitions(until, using=connection):
+    # Crea por adelantado las particiones de los próximos meses, para que la
+    # partición por defecto quede vacía y no haya que revisarla al crear nuevas.
+    # Si ya tiene filas de un mes (el cron no corrió a tiempo, una importación
+    # con fechas futuras), se pasan a la partición nueva
+    created = []
+    existing = {name for name, _ in list_partitions(using)}
+    month = month_start(datetime.now(dt_timezone.utc))
+    with transaction.atomic(using=using.alias), using.cursor() as cursor:
+        while month <= until:
+            if partition_name(month) not in existing:
+                if _default_has_rows(cursor, month):
+                    _split_from_default(cursor, month)
+                else:
+                    create_partition(cursor, month)
+                created.append(partition_name(month))
+            month = next_month(month)
+    return created
+
+
+def drop_partition(name, using=connection):
+    # Quitar una partición es O(1): no hay DELETE fila a fila ni VACUUM posterior
+    with using.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE "{TABLE}" DETACH PARTITION "{name}"')
+        cursor.execute(f'DROP TABLE "{name}"')
@@ -0,0 +1,363 @@
+import asyncio
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DataError, IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+from . import jobs
+from .models import ChatMessage, Conversation
+from .prompt import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Cada cuánto se mira si otro worker ya confirmó su journal
+JOURNAL_POLL_INTERVAL = 0.01
+
+
+# Persistencia write-behind de mensajes: la petición solo anota el mensaje en
+# un journal en disco y en memoria; un hilo los inserta por lotes con
+# bulk_create, una transacción por lote. Si el proceso muere, el journal se
+# vuelve a aplicar al arrancar.
+class WriteBehindBuffer:
+    def __init__(self, directory, batch_size=200, flush_interval=0.2, fsync=False):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.flushed = 0
+        self.batches = 0
+        self.dead = 0
+        self._pending = []
+        # Hay registros de un lote que falló: pudieron quedar insertados en parte
+        self._retrying = False
+        self._closed_paths = []
+        self._segment = 0
+        self._journal = None
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _journal_path(self, segment):
+        return os.path.join(self.directory, f"journal-{os.getpid()}-{segment}.jsonl")
+
+    def _open_journal(self):
+        self._segment += 1
+        self._journal = open(self._journal_path(self._segment), 'ab')
+
+    def _ensure_started(self):
+        # Tras un fork (workers de gunicorn) el hilo no existe en el hijo
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._pending = []
+        self._closed_paths = []
+        self._segment = 0
+        self._open_journal()
+        self._thread = threading.Thread(target=self._run, name='chatbot-write-behind', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def add(self, conversation_id, role, content, timestamp=None, token_count=None):
+        record = _record(conversation_id, role, content, timestamp, token_count)
+        line = json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n'
+        with self._condition:
+            self._ensure_started()
+            self._journal.write(line)
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            self._pending.append(record)
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify()
+
+    def has_pending(self, conversation_id):
+        with self._condition:
+            return any(record['conversation_id'] == conversation_id for record in self._pending)
+
+    def _take_batch(self):
+        # Se lleva todo lo pendiente y rota el journal: el segmento cerrado se
+        # borra solo cuando su lote está confirmado en la base de datos
+        with self._condition:
+            if not self._pending:
+                return []
+            records, self._pending = self._pending, []
+            self._journal.close()
+            self._closed_paths.append(self._journal_path(self._segment))
+            self._open_journal()
+            return records
+
+    def flush(self):
+        with self._flush_lock:
+            records = self._take_batch()
+            if not records:
+                return 0
+            try:
+                inserted, dead = _insert(records, self.directory, dedup=self._retrying)
+            except Exception:
+                # Error transitorio (base de datos caída...): se reintentan en
+                # el siguiente ciclo; los segmentos siguen en disco
+                with self._condition:
+                    self._pending[:0] = records
+                    self._retrying = True
+                raise
+            self._retrying = False
+            for path in self._closed_paths:
+                os.remove(path)
+            self._closed_paths = []
+            self.flushed += inserted
+            self.dead += dead
+            self.batches += 1
+            return inserted
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("No se pudieron guardar los mensajes pendientes")
+            finally:
+                close_old_connections()
+
+    def stats(self):
+        with self._condition:
+            return {'pending': len(self._pending), 'flushed': self.flushed, 'batches': self.batches,
+                    'dead': self.dead}
+
+
+def _record(conversation_id, role, content, timestamp=None, token_count=None):
+    return {
+        'conversation_id': conversation_id,
+        'role': role,
+        'content': content,
+        'timestamp': (timestamp or timezone.now()).isoformat(),
+        'token_count': count_tokens(content) if token_count is None else token_count,
+    }
+
+
+def _to_message(record):
+    return ChatMessage(
+        conversation_id=record['conversation_id'],
+        role=record['role'],
+        content=record['content'],
+        timestamp=datetime.fromisoformat(record['timestamp']),
+        # Los journals anteriores a token_count no lo traen
+        token_count=record.get('token_count'),
+    )
+
+
+def _bulk_insert(records):
+    with transaction.atomic():
+        ChatMessage.objects.bulk_create([_to_message(record) for record in records], batch_size=500)
+
+
+def _alive(records):
+    # Se omiten los mensajes de conversaciones borradas entretanto (retención, admin)
+    alive = set(
+        Conversation.objects.filter(id__in={r['conversation_id'] for r in records}).values_list('id', flat=True)
+    )
+    return [r for r in records if r['conversation_id'] in alive]
+
+
+def _insert(records, directory, dedup=False):
+    # Inserta un lote del write-behind o de un journal reaplicado. Si el lote
+    # falla por registros que no entrarán nunca (IntegrityError, DataError), se
+    # insertan uno a uno y los que fallan se apartan en deadletter.jsonl para
+    # no bloquear a los demás. Devuelve (insertados, apartados); cualquier
+    # otro error se propaga y el lote entero se reintenta (con dedup)
+    records = _alive(records)
+    if dedup:
+        records = _missing(records)
+    try:
+        _bulk_insert(records)
+        return len(records), 0
+    except (IntegrityError, DataError):
+        pass
+    dead = []
+    for record in records:
+        try:
+            _bulk_insert([record])
+        except (IntegrityError, DataError) as error:
+            logger.error("Mensaje de la conversación %s apartado: %s", record['conversation_id'], error)
+            dead.append(record)
+    with open(os.path.join(directory, 'deadletter.jsonl'), 'ab') as dead_letter:
+        for record in dead:
+            dead_letter.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+    return len(records) - len(dead), len(dead)
+
+
+def _missing(records):
+    # Los registros que aún no están en la base de datos (reintentos y journals
+    # reaplicados tras una caída no deben duplicar mensajes)
+    existing = set(
+        ChatMessage.objects
+        .filter(
+            conversation_id__in={r['conversation_id'] for r in records},
+            timestamp__in={datetime.fromisoformat(r['timestamp']) for r in records},
+        )
+        .values_list('conversation_id', 'role', 'timestamp')
+    )
+    return [
+        r for r in records
+        if (r['conversation_id'], r['role'], datetime.fromisoformat(r['timestamp'])) not in existing
+    ]
+
+
+@jobs.handler('save_messages', batch_size=500)
+def save_messages(records):
+    # Persistencia por la cola de trabajos: un worker inserta los mensajes por
+    # lotes; se omiten los de conversaciones borradas entretanto
+    _bulk_insert(_missing(_alive(records)))
+
+
+def replay_journals(directory):
+    # Aplica los journals que dejó un proceso que terminó sin vaciar su buffer.
+    # Se omiten los mensajes que ya llegaron a la base de datos antes de la caída.
+    replayed = 0
+    for path in sorted(glob.glob(os.path.join(directory, 'journal-*.jsonl'))):
+        pid = int(os.path.basename(path).split('-')[1])
+        if pid != os.getpid() and _process_alive(pid):
+            continue
+        # Renombrar reclama el fichero: si varios workers arrancan a la vez,
+        # solo uno lo aplica
+        claimed = f"{path}.replay-{os.getpid()}"
+        try:
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            continue
+        with open(claimed, 'rb') as journal:
+            records = [json.loads(line) for line in journal if line.endswith(b'\n')]
+        if records:
+            replayed += _insert(records, directory, dedup=True)[0]
+        os.remove(claimed)
+    return replayed
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                directory = settings.CHATBOT_WRITE_BEHIND_DIR
+                try:
+                    replay_journals(directory)
+                except Exception:
+                    logger.exception("No se pudieron reaplicar los journals de %s", directory)
+                _buffer = WriteBehindBuffer(
+                    directory,
+                    batch_size=settings.CHATBOT_WRITE_BEHIND_BATCH_SIZE,
+                    flush_interval=settings.CHATBOT_WRITE_BEHIND_INTERVAL,
+                    fsync=settings.CHATBOT_WRITE_BEHIND_FSYNC,
+                )
+    return _buffer
+
+
+def save_message(conversation_id, role, content, token_count=None):
+    # token_count: el recuento que ya hizo el llamador, para no repetirlo
+    if settings.CHATBOT_WRITE_BEHIND:
+        get_buffer().add(conversation_id, role, content, token_count=token_count)
+    elif settings.CHATBOT_PERSIST_WITH_JOBS:
+        jobs.enqueue('save_messages', _record(conversation_id, role, content, token_count=token_count))
+    else:
+        ChatMessage.objects.create(conversation_id=conversation_id, role=role, content=content,
+                                   token_count=token_count)
+
+
+async def asave_message(conversation_id, role, content, token_count=None):
+    if settings.CHATBOT_WRITE_BEHIND:
+        # Solo escribe en el journal local: no hace falta salir del event loop
+        # (salvo la primera vez, que reaplica journals antiguos en la base de datos)
+        buffer = _buffer or await sync_to_async(get_buffer)()
+        buffer.add(conversation_id, role, content, token_count=token_count)
+    elif settings.CHATBOT_PERSIST_WITH_JOBS:
+        await jobs.aenqueue('save_messages', _record(conversation_id, role, content, token_count=token_count))
+    else:
+        await ChatMessage.objects.acreate(conversation_id=conversation_id, role=role, content=content,
+                                          token_count=token_count)
+
+
+def other_journals_with(directory, conversation_id):
+    # Segmentos de journal de otros workers vivos con mensajes de la
+    # conversación. Cada worker borra un segmento cuando su lote está
+    # confirmado, así que mientras exista, el historial puede estar incompleto
+    marker = b'{"conversation_id": %d,' % conversation_id
+    found = []
+    for path in glob.glob(os.path.join(directory, 'journal-*.jsonl')):
+        pid = int(os.path.basename(path).split('-')[1])
+        # Los de un proceso muerto los reaplica el siguiente que arranque
+        if pid == os.getpid() or not _process_alive(pid):
+            continue
+        try:
+            with open(path, 'rb') as journal:
+                if marker in journal.read():
+                    found.append(path)
+        except FileNotFoundError:
+            continue
+    return found
+
+
+def _warn_pending(paths, conversation_id):
+    pending = [path for path in paths if os.path.exists(path)]
+    if pending:
+        logger.warning("El historial de la conversación %s se lee sin los mensajes pendientes de %s",
+                       conversation_id, ', '.join(os.path.basename(path) for path in pending))
+
+
+def flush_conversation(conversation_id):
+    # Antes de leer el historial, guardar lo que este proceso aún tenga en memoria
+    # o lo que siga en la cola de trabajos para esta conversación. Con
+    # write-behind, además se espera a que los otros workers del host confirmen
+    # los mensajes de la conversación que tengan en su journal
+    if settings.CHATBOT_WRITE_BEHIND:
+        if _buffer is not None and _buffer.has_pending(conversation_id):
+            _buffer.flush()
+        paths = other_journals_with(settings.CHATBOT_WRITE_BEHIND_DIR, conversation_id)
+        deadline = time.monotonic() + settings.CHATBOT_WRITE_BEHIND_READ_TIMEOUT
+        while paths and time.monotonic() < deadline:
+            time.sleep(JOURNAL_POLL_INTERVAL)
+            paths = [path for path in paths if os.path.exists(path)]
+        _warn_pending(paths, conversation_id)
+    elif settings.CHATBOT_PERSIST_WITH_JOBS:
+        jobs.run_pending('save_messages', payload__conversation_id=conversation_id)
+
+
+async def aflush_conversation(conversation_id):
+    if settings.CHATBOT_WRITE_BEHIND:
+        if _buffer is not None and _buffer.has_pending(conversation_id):
+            await sync_to_async(_buffer.flush)()
+        # Los journals son ficheros pequeños (se rotan en cada lote): se leen
+        # desde el event loop, como los escribe asave_message
+        paths = other_journals_with(settings.CHATBOT_WRITE_BEHIND_DIR, conversation_id)
+        deadline = time.monotonic() + settings.CHATBOT_WRITE_BEHIND_READ_TIMEOUT
+        while paths and time.monotonic() < deadline:
+            await asyncio.sleep(JOURNAL_POLL_INTERVAL)
+            paths = [path for path in paths if os.path.exists(path)]
+        _warn_pending(paths, conversation_id)
+    elif settings.CHATBOT_PERSIST_WITH_JOBS:
+        await sync_to_async(jobs.run_pending)('save_messages', payload__conversation_id=conversation_id)
@@ -0,0 +1,112 @@
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+# Aproximación local del tokenizer BPE: cada palabra cuenta un token por cada
+# cuatro caracteres y cada signo de puntuación uno; los espacios no cuentan.
+# Un findall sobre una regex compilada, sin vocabulario que cargar.
+_TOKEN_RE = re.compile(r"\w{1,4}|[^\w\s]")
+# Tokens de formato que la plantilla de chat añade por mensaje (rol, separadores)
+MESSAGE_OVERHEAD = 4
+SUMMARY_PREFIX = "Resumen de la conversación hasta ahora: "
+PASSAGES_HEADER = (
+    "Fragmentos de documentos de la institución que pueden ayudar a responder. "
+    "Úsalos solo si son pertinentes y cita la fuente entre corchetes."
+)
+
+
+def count_tokens(text):
+    return len(_TOKEN_RE.findall(text))
+
+
+def truncate_tokens(text, max_tokens):
+    # Corta el texto justo antes del token max_tokens + 1
+    if max_tokens <= 0:
+        return ''
+    for index, match in enumerate(_TOKEN_RE.finditer(text)):
+        if index == max_tokens:
+            return text[:match.start()].rstrip()
+    return text
+
+
+# Los resúmenes se repiten en cada turno hasta la siguiente compactación
+_summary_tokens = lru_cache(maxsize=1024)(count_tokens)
+
+
+class PromptBuilder:
+    # Ensambla los mensajes para la API dentro de un presupuesto de tokens.
+    # Prioridad al recortar: prompt de sistema, mensaje del usuario (se trunca
+    # si él solo no cabe), fragmentos de documentos (chatbot.rag), resumen y,
+    # por último, el historial de más reciente a más antiguo. Los textos fijos
+    # se tokenizan una vez, al crear el builder.
+    def __init__(self, system_prompt, token_budget):
+        self.token_budget = token_budget
+        self.system_messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+        self.system_tokens = sum(count_tokens(m['content']) + MESSAGE_OVERHEAD for m in self.system_messages)
+        self.summary_prefix_tokens = count_tokens(SUMMARY_PREFIX) + MESSAGE_OVERHEAD
+        self.passages_header_tokens = count_tokens(PASSAGES_HEADER) + MESSAGE_OVERHEAD
+
+    def build(self, summary, history, message, message_tokens=None, passages=()):
+        # history: dicts {role, content, tokens} en orden cronológico (load_context);
+        # passages: dicts {source, text, tokens} por relevancia (rag.retrieve).
+        # Devuelve (mensajes, tokens estimados)
+        remaining = self.token_budget - self.system_tokens
+        if message_tokens is None:
+            message_tokens = count_tokens(message)
+        if message_tokens + MESSAGE_OVERHEAD > remaining:
+            message = truncate_tokens(message, remaining - MESSAGE_OVERHEAD)
+            message_tokens = max(remaining - MESSAGE_OVERHEAD, 0)
+        remaining -= message_tokens + MESSAGE_OVERHEAD
+
+        context_messages = []
+        if passages and remaining > self.passages_header_tokens:
+            remaining -= self.passages_header_tokens
+            lines = [PASSAGES_HEADER]
+            for passage in passages:
+                if passage['tokens'] > remaining:
+                    break
+                lines.append(f"[{passage['source']}] {passage['text']}")
+                remaining -= passage['tokens']
+            if len(lines) > 1:
+                context_messages.append({"role": "system", "content": "\n\n".join(lines)})
+            else:
+                remaining += self.passages_header_tokens
+
+        if summary and remaining > self.summary_prefix_tokens:
+            tokens = _summary_tokens(summary)
+            if tokens + self.summary_prefix_tokens > remaining:
+                summary = truncate_tokens(summary, remaining - self.summary_prefix_tokens)
+                tokens = remaining - self.summary_prefix_tokens
+            context_messages.append({"role": "system", "content": SUMMARY_PREFIX + summary})
+            remaining -= tokens + self.summary_prefix_tokens
+
+        start = len(history)
+        while start and history[start - 1]['tokens'] + MESSAGE_OVERHEAD <= remaining:
+            start -= 1
+            remaining -= history[start]['tokens'] + MESSAGE_OVERHEAD
+
+        messages = self.system_messages + context_messages
+        messages.extend({"role": turn['role'], "content": turn['content']} for turn in history[start:])
+        messages.append({"role": "user", "content": message})
+        return messages, self.token_budget - remaining
+
+
+_builder = None
+
+
+def get_prompt_builder():
+    # Sin lock: construirlo es barato y dos instancias iguales son inofensivas
+    global _builder
+    if _builder is None:
+        _builder = PromptBuilder(settings.CHATBOT_SYSTEM_PROMPT, settings.CHATBOT_PROMPT_TOKEN_BUDGET)
+    return _builder
+
+
+@receiver(setting_changed)
+def _reset_builder(setting, **kwargs):
+    global _builder
+    if setting in ('CHATBOT_SYSTEM_PROMPT', 'CHATBOT_PROMPT_TOKEN_BUDGET'):
+        _builder = None
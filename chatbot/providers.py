@@ -0,0 +1,435 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import httpx
+import requests
+from decouple import config
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import fastjson, llm, metrics
+from .governor import Governor, UpstreamError
+
+logger = logging.getLogger(__name__)
+
+# Muestras mínimas antes de fiarse del p95 de un proveedor para lanzar hedging
+HEDGE_MIN_SAMPLES = 20
+# Al ordenar proveedores, cada punto de tasa de error pesa como este tiempo
+ERROR_PENALTY = 1.0
+
+
+# Latencias y errores recientes de un proveedor (ventana deslizante)
+class LatencyTracker:
+    def __init__(self, window=200):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds=None):
+        # seconds=None registra un fallo
+        with self._lock:
+            self.outcomes.append(seconds is not None)
+            if seconds is not None:
+                self.latencies.append(seconds)
+
+    def percentile(self, pct):
+        with self._lock:
+            ordered = sorted(self.latencies)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+    def error_rate(self):
+        with self._lock:
+            if not self.outcomes:
+                return 0.0
+            return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    def samples(self):
+        with self._lock:
+            return len(self.latencies)
+
+
+# Un backend compatible con la API de chat completions de OpenAI: DeepSeek,
+# cualquier endpoint OpenAI-compatible o un servidor local tipo llama.cpp
+# (kind='llamacpp', sin clave). Cada uno tiene su propio governor, así que su
+# circuit breaker indica si está sano.
+class Provider:
+    def __init__(self, name, url, model='deepseek-chat', kind='openai', api_key_env=None, governor=None):
+        self.name = name
+        self.url = url
+        self.model = model
+        self.kind = kind
+        self.api_key_env = api_key_env
+        self.governor = governor or Governor.from_settings(name)
+        self.latency = LatencyTracker()
+
+    @property
+    def api_key(self):
+        return config(self.api_key_env, default='') if self.api_key_env else ''
+
+    @property
+    def configured(self):
+        return self.kind == 'llamacpp' or bool(self.api_key)
+
+    def headers(self, stream=False):
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream" if stream else "application/json"
+        }
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def prepare(self, payload):
+        return {**payload, 'model': self.model}
+
+    def score(self):
+        # Menor es mejor: p50 penalizado por la tasa de errores; los que aún no
+        # tienen muestras puntúan 0 para que reciban tráfico y se midan
+        p50 = self.latency.percentile(50) or 0.0
+        error_rate = self.latency.error_rate()
+        return p50 * (1 + 4 * error_rate) + error_rate * ERROR_PENALTY
+
+    def hedge_delay(self):
+        if self.latency.samples() < HEDGE_MIN_SAMPLES:
+            return None
+        return self.latency.percentile(95)
+
+    def _post(self, payload, stream):
+        response = llm.get_session().post(
+            self.url, headers=self.headers(stream), data=fastjson.dumps(self.prepare(payload)), timeout=llm.timeouts(),
+            stream=stream
+        )
+        # elapsed de requests: desde el envío hasta tener las cabeceras
+        metrics.record_phase('upstream_ttfb', response.elapsed.total_seconds())
+        return response
+
+    def _governed(self, payload, stream):
+        return self.governor.call(
+            lambda: self._post(payload, stream),
+            transport_errors=(requests.ConnectionError, requests.Timeout)
+        )
+
+    def _timed(self, call):
+        # Latencia hasta tener la respuesta (las cabeceras, en streaming)
+        started = time.monotonic()
+        try:
+            result = call()
+        except UpstreamError:
+            self.latency.record(None)
+            raise
+        self.latency.record(time.monotonic() - started)
+        return result
+
+    def _content(self, response):
+        # Un 200 con un cuerpo que no es una respuesta del chat es un fallo del
+        # proveedor: UpstreamError para que cuente en su tasa de error y se pase al siguiente
+        try:
+            data = fastjson.loads(response.content)
+            content = data['choices'][0]['message']['content']
+        except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+            raise UpstreamError(f"Respuesta no válida de {self.name}") from None
+        metrics.record_tokens(self.name, data.get('usage'))
+        return content
+
+    def open_stream(self, payload):
+        def call():
+            started = time.perf_counter()
+            response, release = self._governed(payload, stream=True)
+            if response.status_code != 200:
+                llm.GovernedStream(response, release).close()
+                raise UpstreamError("Error en la API de Deepseek", response.status_code)
+            return llm.GovernedStream(response, release, self.name, started)
+        return self._timed(call)
+
+    def complete(self, payload):
+        def call():
+            started = time.perf_counter()
+            response, release = self._governed(payload, stream=False)
+            try:
+                if response.status_code != 200:
+                    raise UpstreamError("Error en la API de Deepseek", response.status_code)
+                return self._content(response)
+            finally:
+                release()
+                metrics.record_phase('upstream_total', time.perf_counter() - started)
+        return self._timed(call)
+
+    async def _agoverned(self, payload, stream):
+        client = llm.get_async_client()
+        return await self.governor.acall(
+            lambda: client.send(
+                client.build_request('POST', self.url, headers=self.headers(stream),
+                                     content=fastjson.dumps(self.prepare(payload)),
+                                     extensions={'trace': llm.upstream_trace()}),
+                stream=stream
+            ),
+            transport_errors=(httpx.TransportError,)
+        )
+
+    async def _atimed(self, call):
+        started = time.monotonic()
+        try:
+            result = await call()
+        except UpstreamError:
+            self.latency.record(None)
+            raise
+        self.latency.record(time.monotonic() - started)
+        return result
+
+    async def aopen_stream(self, payload):
+        async def call():
+            started = time.perf_counter()
+            response, release = await self._agoverned(payload, stream=True)
+            if response.status_code != 200:
+                await llm.GovernedStream(response, release).aclose()
+                raise UpstreamError("Error en la API de Deepseek", response.status_code)
+            return llm.GovernedStream(response, release, self.name, started)
+        return await self._atimed(call)
+
+    async def acomplete(self, payload):
+        async def call():
+            started = time.perf_counter()
+            response, release = await self._agoverned(payload, stream=False)
+            try:
+                if response.status_code != 200:
+                    raise UpstreamError("Error en la API de Deepseek", response.status_code)
+                return self._content(response)
+            finally:
+                release()
+                metrics.record_phase('upstream_total', time.perf_counter() - started)
+        return await self._atimed(call)
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'model': self.model,
+            'p50_ms': _ms(self.latency.percentile(50)),
+            'p95_ms': _ms(self.latency.percentile(95)),
+            'error_rate': round(self.latency.error_rate(), 3),
+            'governor': self.governor.stats(),
+        }
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+def _discard(future):
+    # El perdedor de un hedge síncrono no se puede cancelar: si llega a abrir
+    # un stream, se cierra en cuanto termina
+    if not future.cancelled() and future.exception() is None and isinstance(future.result(), llm.GovernedStream):
+        future.result().close()
+
+
+# Cierres en curso de los perdedores asíncronos (el bucle solo guarda referencias débiles)
+_closing = set()
+
+
+def _adiscard(task):
+    # El perdedor de un hedge asíncrono que terminó antes de que llegara a
+    # cancelarse (o a la vez que el ganador): su stream se cierra igualmente
+    if not task.cancelled() and task.exception() is None and isinstance(task.result(), llm.GovernedStream):
+        closing = asyncio.ensure_future(task.result().aclose())
+        _closing.add(closing)
+        closing.add_done_callback(_closed)
+
+
+def _closed(closing):
+    _closing.discard(closing)
+    if not closing.cancelled() and closing.exception() is not None:
+        logger.error("No se pudo cerrar el stream de un hedge perdido", exc_info=closing.exception())
+
+
+# Elige el proveedor sano más rápido y, si falla, pasa al siguiente. Con
+# hedging, si el primero tarda más que su p95 lanza la misma petición al
+# segundo y se queda con la primera respuesta que llegue.
+class Router:
+    def __init__(self, providers, hedge=False, hedge_workers=32):
+        self.providers = providers
+        self.hedge = hedge
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        # Con hedging, las llamadas síncronas corren en este pool para poder
+        # esperar al primario con un plazo
+        self._executor = ThreadPoolExecutor(hedge_workers, thread_name_prefix='llm-hedge') if hedge else None
+        self._lock = threading.Lock()
+
+    @property
+    def configured(self):
+        return any(provider.configured for provider in self.providers)
+
+    def ranked(self):
+        # Los de circuito abierto van al final: fallan al instante, pero sirven
+        # de último recurso si ninguno está sano
+        candidates = [p for p in self.providers if p.configured]
+        return sorted(candidates, key=lambda p: (p.governor.breaker.is_open(), p.score()))
+
+    def _count(self, attribute):
+        with self._lock:
+            setattr(self, attribute, getattr(self, attribute) + 1)
+
+    def _call(self, operation, payload):
+        error = None
+        ranked = self.ranked()
+        if not ranked:
+            raise UpstreamError("No hay ningún proveedor de LLM configurado")
+        while ranked:
+            primary = ranked.pop(0)
+            try:
+                if self.hedge and ranked and primary.hedge_delay() is not None:
+                    return self._hedged(operation, payload, primary, ranked)
+                return getattr(primary, operation)(payload)
+            except UpstreamError as e:
+                error = e
+                if ranked:
+                    self._count('failovers')
+        raise error
+
+    def _hedged(self, operation, payload, primary, ranked):
+        # Si el primario falla antes del plazo, _call pasa al siguiente como
+        # en un failover normal; el de respaldo solo se consume si se lanza
+        first = self._executor.submit(getattr(primary, operation), payload)
+        futures = [first]
+        winner = None
+        try:
+            done, _ = wait([first], timeout=primary.hedge_delay())
+            if done:
+                winner = first
+                return first.result()
+            self._count('hedged')
+            backup = ranked.pop(0)
+            second = self._executor.submit(getattr(backup, operation), payload)
+            futures.append(second)
+            pending = {first, second}
+            error = None
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        winner = future
+                        if future is second:
+                            self._count('hedge_wins')
+                        return future.result()
+                    error = future.exception()
+            raise error
+        finally:
+            # Todos los que no ganan, también el que terminó a la vez que el ganador
+            for future in futures:
+                if future is not winner:
+                    future.add_done_callback(_discard)
+
+    async def _acall(self, operation, payload):
+        error = None
+        ranked = self.ranked()
+        if not ranked:
+            raise UpstreamError("No hay ningún proveedor de LLM configurado")
+        while ranked:
+            primary = ranked.pop(0)
+            try:
+                if self.hedge and ranked and primary.hedge_delay() is not None:
+                    return await self._ahedged(operation, payload, primary, ranked)
+                return await getattr(primary, operation)(payload)
+            except UpstreamError as e:
+                error = e
+                if ranked:
+                    self._count('failovers')
+        raise error
+
+    async def _ahedged(self, operation, payload, primary, ranked):
+        first = asyncio.ensure_future(getattr(primary, operation)(payload))
+        tasks = [first]
+        winner = None
+        try:
+            done, _ = await asyncio.wait([first], timeout=primary.hedge_delay())
+            if done:
+                winner = first
+                return first.result()
+            self._count('hedged')
+            backup = ranked.pop(0)
+            second = asyncio.ensure_future(getattr(backup, operation)(payload))
+            tasks.append(second)
+            pending = {first, second}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        if task is second:
+                            self._count('hedge_wins')
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # Los que no ganan (todos si cancelan al que llama) se cancelan y,
+            # si ya habían abierto un stream, se cierra: liberan su hueco del governor
+            for task in tasks:
+                if task is not winner:
+                    task.cancel()
+                    task.add_done_callback(_adiscard)
+
+    def open_stream(self, payload):
+        return self._call('open_stream', payload)
+
+    def complete(self, payload):
+        return self._call('complete', payload)
+
+    async def aopen_stream(self, payload):
+        return await self._acall('aopen_stream', payload)
+
+    async def acomplete(self, payload):
+        return await self._acall('acomplete', payload)
+
+    def stats(self):
+        return {
+            'providers': {provider.name: provider.stats() for provider in self.providers},
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+            'failovers': self.failovers,
+        }
+
+
+def providers_from_settings():
+    # LLM_PROVIDERS vacío = solo DeepSeek con DEEPSEEK_API_URL y DEEPSEEK_API_KEY
+    configured = settings.LLM_PROVIDERS or [{
+        'name': 'deepseek',
+        'url': settings.DEEPSEEK_API_URL,
+        'model': 'deepseek-chat',
+        'kind': 'deepseek',
+        'api_key_env': 'DEEPSEEK_API_KEY',
+    }]
+    return [Provider(**options) for options in configured]
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                providers = providers_from_settings()
+                _router = Router(
+                    providers,
+                    hedge=settings.LLM_HEDGE,
+                    hedge_workers=2 * settings.LLM_MAX_CONCURRENCY * len(providers),
+                )
+    return _router
+
+
+@receiver(setting_changed)
+def _reset_router(setting, **kwargs):
+    # override_settings en pruebas y benchmarks: reconstruir con la nueva configuración
+    global _router
+    if setting == 'DEEPSEEK_API_URL' or setting.startswith('LLM_'):
+        _router = None
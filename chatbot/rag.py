@@ -0,0 +1,578 @@
+import html
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import zlib
+from collections import Counter
+
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .embeddings import DIMENSIONS, embed
+from .prompt import count_tokens
+from .search import tokens
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+# Índice de documentos para respuestas con contexto (RAG). Vive en disco como
+# segmentos inmutables que los workers abren con np.memmap: la memoria la
+# comparte el page cache del sistema y cada proceso solo toca las páginas
+# que lee una consulta. Cada segmento guarda:
+#   - vectors.f32: vectores (embeddings.embed) agrupados por lista IVF, con
+#     centroids.f32 e ivf_offsets.i64; una consulta solo recorre las listas de
+#     los centroides más parecidos, no todos los vectores
+#   - post_*: postings BM25 por término (hasheado en BUCKETS cubos), ordenadas
+#     por impacto para leer solo las MAX_POSTINGS mejores de cada término
+#   - chunks.jsonl + chunk_offsets.i64: texto y fuente de cada fragmento
+# manifest.json enumera los segmentos vivos y los rangos de fragmentos
+# borrados; index_documents añade un segmento por ejecución y lo reescribe.
+
+TEXT_EXTENSIONS = ('.txt', '.md', '.rst', '.html', '.htm')
+BUCKETS = 1 << 20
+K1 = 1.2
+B = 0.75
+MAX_POSTINGS = 10_000
+KMEANS_ITERATIONS = 8
+# Constante de Reciprocal Rank Fusion para combinar la lista densa y la BM25
+RRF_K = 60
+MANIFEST = 'manifest.json'
+DOCUMENTS = 'documents.json'
+
+_PARAGRAPH_RE = re.compile(r"\n\s*\n")
+_TAG_RE = re.compile(r"<(script|style)\b.*?</\1\s*>|<[^>]+>", re.S | re.I)
+
+
+def read_document(path):
+    with open(path, encoding='utf-8', errors='replace') as document:
+        text = document.read()
+    if path.lower().endswith(('.html', '.htm')):
+        text = html.unescape(_TAG_RE.sub(' ', text))
+    return text
+
+
+def _split_long(paragraph, paragraph_tokens, chunk_tokens, overlap):
+    # Ventanas de palabras con solape para párrafos que no caben en un fragmento
+    words = paragraph.split(' ')
+    per_word = paragraph_tokens / len(words)
+    window = max(1, int(chunk_tokens / per_word))
+    stride = max(1, window - int(overlap / per_word))
+    for start in range(0, len(words), stride):
+        yield ' '.join(words[start:start + window])
+        if start + window >= len(words):
+            break
+
+
+def chunk_text(text, chunk_tokens=200, overlap=40):
+    # Fragmentos de hasta ~chunk_tokens tokens que respetan los párrafos; el
+    # último párrafo de un fragmento se repite en el siguiente si es corto
+    pieces = []
+    for paragraph in _PARAGRAPH_RE.split(text):
+        paragraph = ' '.join(paragraph.split())
+        if not paragraph:
+            continue
+        paragraph_tokens = count_tokens(paragraph)
+        if paragraph_tokens <= chunk_tokens:
+            pieces.append((paragraph, paragraph_tokens))
+        else:
+            pieces.extend(
+                (piece, count_tokens(piece))
+                for piece in _split_long(paragraph, paragraph_tokens, chunk_tokens, overlap)
+            )
+
+    chunks, current, size = [], [], 0
+    for piece, piece_tokens in pieces:
+        if current and size + piece_tokens > chunk_tokens:
+            chunks.append('\n\n'.join(current))
+            last, last_tokens = current[-1], count_tokens(current[-1])
+            current, size = ([last], last_tokens) if last_tokens <= overlap else ([], 0)
+        current.append(piece)
+        size += piece_tokens
+    if current:
+        chunks.append('\n\n'.join(current))
+    return [(chunk, count_tokens(chunk)) for chunk in chunks]
+
+
+def bucket(term):
+    return zlib.crc32(term.encode('utf-8')) % BUCKETS
+
+
+def postings(texts):
+    # (ids de fragmento, cubos, frecuencias) y longitud en términos de cada texto
+    chunk_ids, buckets, frequencies, lengths = [], [], [], []
+    for chunk_id, text in enumerate(texts):
+        counts = Counter(bucket(term) for term in tokens(text))
+        chunk_ids.extend([chunk_id] * len(counts))
+        buckets.extend(counts.keys())
+        frequencies.extend(counts.values())
+        lengths.append(sum(counts.values()))
+    return (
+        (np.array(chunk_ids, dtype=np.int32), np.array(buckets, dtype=np.int64),
+         np.array(frequencies, dtype=np.float32)),
+        np.array(lengths, dtype=np.float32),
+    )
+
+
+def _kmeans(vectors, lists, rng):
+    # k-means esférico (similitud coseno) sobre una muestra: solo hace falta
+    # repartir los vectores en listas de tamaño parecido, no una partición óptima
+    sample_size = min(len(vectors), lists * 32)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))])
+    centroids = sample[rng.choice(sample_size, lists, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        empty = ~sums.any(axis=1)
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.where(norms, norms, 1)
+    return centroids.astype(np.float32)
+
+
+def _assign(vectors, centroids, batch=65536):
+    return np.concatenate([
+        np.argmax(vectors[start:start + batch] @ centroids.T, axis=1)
+        for start in range(0, len(vectors), batch)
+    ])
+
+
+def write_segment(path, records, vectors, chunk_postings, lengths):
+    # records: dicts {source, text, tokens} en el orden de los ids de fragmento.
+    # Se escribe en un directorio temporal y se renombra al terminar
+    size = len(vectors)
+    temporary = path + '.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+
+    def save(name, array):
+        np.ascontiguousarray(array).tofile(os.path.join(temporary, name))
+
+    rng = np.random.default_rng(0)
+    lists = max(1, min(int(np.sqrt(size)), 4096))
+    centroids = _kmeans(vectors, lists, rng)
+    assignment = _assign(vectors, centroids)
+    order = np.argsort(assignment, kind='stable')
+    counts = np.bincount(assignment, minlength=lists)
+    save('centroids.f32', centroids)
+    save('ivf_offsets.i64', np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+    save('ivf_ids.i32', order.astype(np.int32))
+    with open(os.path.join(temporary, 'vectors.f32'), 'wb') as vectors_file:
+        for start in range(0, size, 65536):
+            vectors_file.write(np.ascontiguousarray(vectors[order[start:start + 65536]], dtype=np.float32).tobytes())
+
+    # Impacto BM25 precalculado (parte de frecuencia y longitud); el idf se
+    # aplica al consultar con las frecuencias de documento de todos los segmentos
+    chunk_ids, buckets, frequencies = chunk_postings
+    average = float(lengths.mean()) if size and lengths.sum() else 1.0
+    impacts = frequencies * (K1 + 1) / (frequencies + K1 * (1 - B + B * lengths[chunk_ids] / average))
+    by_bucket = np.lexsort((-impacts, buckets))
+    save('post_offsets.i64', np.concatenate([[0], np.cumsum(np.bincount(buckets, minlength=BUCKETS))]).astype(np.int64))
+    save('post_ids.i32', chunk_ids[by_bucket].astype(np.int32))
+    save('post_impacts.f32', impacts[by_bucket].astype(np.float32))
+
+    offsets = [0]
+    with open(os.path.join(temporary, 'chunks.jsonl'), 'wb') as chunks_file:
+        for record in records:
+            line = json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n'
+            chunks_file.write(line)
+            offsets.append(offsets[-1] + len(line))
+    save('chunk_offsets.i64', np.array(offsets, dtype=np.int64))
+    with open(os.path.join(temporary, 'meta.json'), 'w') as meta:
+        json.dump({'chunks': size, 'lists': lists, 'dimensions': DIMENSIONS, 'buckets': BUCKETS}, meta)
+    os.replace(temporary, path)
+
+
+class Segment:
+    def __init__(self, path, deleted=()):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as meta:
+            self.size = json.load(meta)['chunks']
+        # Solo los centroides y los offsets IVF (pequeños) se cargan en memoria
+        self.centroids = np.fromfile(os.path.join(path, 'centroids.f32'), dtype=np.float32).reshape(-1, DIMENSIONS)
+        self.ivf_offsets = np.fromfile(os.path.join(path, 'ivf_offsets.i64'), dtype=np.int64)
+        self.vectors = self._map('vectors.f32', np.float32, (self.size, DIMENSIONS))
+        self.ivf_ids = self._map('ivf_ids.i32', np.int32)
+        self.post_offsets = self._map('post_offsets.i64', np.int64)
+        self.post_ids = self._map('post_ids.i32', np.int32)
+        self.post_impacts = self._map('post_impacts.f32', np.float32)
+        self.chunk_offsets = self._map('chunk_offsets.i64', np.int64)
+        # También el texto: si una compactación borra el segmento mientras se
+        # usa, los mapas conservan sus páginas y las búsquedas en curso acaban
+        self.chunks = self._map('chunks.jsonl', np.uint8)
+        self._rows = None
+        self.set_deleted(deleted)
+
+    def _map(self, name, dtype, shape=None):
+        path = os.path.join(self.path, name)
+        if not os.path.getsize(path):
+            return np.zeros(shape or 0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+    def set_deleted(self, ranges):
+        ranges = sorted(ranges)
+        self.deleted_starts = np.array([start for start, _ in ranges], dtype=np.int64)
+        self.deleted_ends = np.array([end for _, end in ranges], dtype=np.int64)
+        self.live = self.size - int((self.deleted_ends - self.deleted_starts).sum())
+
+    def alive(self, chunk_ids):
+        if not len(self.deleted_starts):
+            return np.ones(len(chunk_ids), dtype=bool)
+        index = np.searchsorted(self.deleted_starts, chunk_ids, side='right') - 1
+        return ~((index >= 0) & (chunk_ids < self.deleted_ends[np.maximum(index, 0)]))
+
+    def dense(self, query, probes, limit):
+        # Producto escalar solo con los vectores de las `probes` listas más cercanas
+        centroid_scores = self.centroids @ query
+        probes = min(probes, len(centroid_scores))
+        lists = np.argpartition(-centroid_scores, probes - 1)[:probes]
+        scores, ids = [], []
+        for lst in lists:
+            start, end = self.ivf_offsets[lst], self.ivf_offsets[lst + 1]
+            if start < end:
+                scores.append(self.vectors[start:end] @ query)
+                ids.append(self.ivf_ids[start:end])
+        if not scores:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int32)
+        return _top(np.concatenate(scores), np.concatenate(ids), limit, self)
+
+    def document_frequency(self, term_bucket):
+        return int(self.post_offsets[term_bucket + 1] - self.post_offsets[term_bucket])
+
+    def sparse(self, weights, limit):
+        # weights: {cubo: idf}. Suma idf * impacto de las mejores postings de cada término
+        ids, scores = [], []
+        for term_bucket, idf in weights.items():
+            start = int(self.post_offsets[term_bucket])
+            end = min(int(self.post_offsets[term_bucket + 1]), start + MAX_POSTINGS)
+            if start < end:
+                ids.append(self.post_ids[start:end])
+                scores.append(self.post_impacts[start:end] * idf)
+        if not ids:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int32)
+        unique, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        return _top(np.bincount(inverse, weights=np.concatenate(scores)), unique, limit, self)
+
+    def chunk(self, chunk_id):
+        start, end = int(self.chunk_offsets[chunk_id]), int(self.chunk_offsets[chunk_id + 1])
+        return json.loads(self.chunks[start:end].tobytes())
+
+    def vectors_for(self, chunk_ids):
+        # Solo al fusionar segmentos: fila IVF de cada id de fragmento
+        if self._rows is None:
+            self._rows = np.empty(self.size, dtype=np.int64)
+            self._rows[self.ivf_ids] = np.arange(self.size)
+        return np.asarray(self.vectors[self._rows[chunk_ids]])
+
+
+def _top(scores, ids, limit, segment):
+    alive = segment.alive(ids)
+    scores, ids = scores[alive], ids[alive]
+    if len(scores) > limit:
+        best = np.argpartition(-scores, limit - 1)[:limit]
+        scores, ids = scores[best], ids[best]
+    order = np.argsort(-scores, kind='stable')
+    return scores[order], ids[order]
+
+
+def _load_json(path, default):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return default
+
+
+def _write_json(path, data):
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as json_file:
+        json.dump(data, json_file)
+    os.replace(temporary, path)
+
+
+class RagIndex:
+    def __init__(self, directory, top_k=4, probes=8, min_score=0.25):
+        self.directory = directory
+        self.top_k = top_k
+        self.probes = probes
+        self.min_score = min_score
+        self.searches = 0
+        self._segments = []
+        self._manifest_mtime = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        # Reabre el manifest si index_documents lo cambió; los segmentos que
+        # siguen vivos se reutilizan (sus mapas de memoria no se rehacen)
+        try:
+            mtime = os.stat(os.path.join(self.directory, MANIFEST)).st_mtime_ns
+        except FileNotFoundError:
+            self._segments, self._manifest_mtime = [], None
+            return
+        if mtime == self._manifest_mtime:
+            return
+        manifest = _load_json(os.path.join(self.directory, MANIFEST), {'segments': []})
+        current = {segment.path: segment for segment in self._segments}
+        segments = []
+        for entry in manifest['segments']:
+            path = os.path.join(self.directory, entry['name'])
+            segment = current.get(path) or Segment(path)
+            segment.set_deleted(entry['deleted'])
+            segments.append(segment)
+        self._segments, self._manifest_mtime = segments, mtime
+
+    def segments(self):
+        with self._lock:
+            self._refresh()
+            return self._segments
+
+    def search(self, query, top_k=None):
+        # Fragmentos más relevantes: fusión por rango (RRF) de la búsqueda
+        # densa y la BM25. Un fragmento sin ningún término de la consulta solo
+        # entra si su similitud coseno llega a min_score
+        top_k = top_k or self.top_k
+        segments = self.segments()
+        if not segments or not query.strip():
+            return []
+        self.searches += 1
+        limit = max(4 * top_k, 32)
+        query_vector = embed(query)
+        total = sum(segment.size for segment in segments)
+        weights = {}
+        for term_bucket in {bucket(term) for term in tokens(query)}:
+            df = sum(segment.document_frequency(term_bucket) for segment in segments)
+            if df:
+                weights[term_bucket] = np.log(1 + (total - df + 0.5) / (df + 0.5))
+
+        dense, sparse = [], []
+        for index, segment in enumerate(segments):
+            scores, ids = segment.dense(query_vector, self.probes, limit)
+            dense.extend(zip(scores.tolist(), [index] * len(ids), ids.tolist()))
+            if weights:
+                scores, ids = segment.sparse(weights, limit)
+                sparse.extend(zip(scores.tolist(), [index] * len(ids), ids.tolist()))
+        dense.sort(reverse=True)
+        sparse.sort(reverse=True)
+
+        fused, similarity = {}, {}
+        for rank, (score, index, chunk_id) in enumerate(dense[:limit]):
+            fused[index, chunk_id] = 1 / (RRF_K + rank)
+            similarity[index, chunk_id] = score
+        lexical = set()
+        for rank, (_, index, chunk_id) in enumerate(sparse[:limit]):
+            fused[index, chunk_id] = fused.get((index, chunk_id), 0) + 1 / (RRF_K + rank)
+            lexical.add((index, chunk_id))
+        ranked = sorted(
+            (key for key in fused if key in lexical or similarity.get(key, 0) >= self.min_score),
+            key=fused.get, reverse=True
+        )[:top_k]
+
+        passages = []
+        for index, chunk_id in ranked:
+            chunk = segments[index].chunk(chunk_id)
+            # Tokens del fragmento tal como lo formatea PromptBuilder
+            chunk['tokens'] += count_tokens(chunk['source']) + 2
+            chunk['score'] = round(fused[index, chunk_id], 6)
+            passages.append(chunk)
+        return passages
+
+    def stats(self):
+        segments = self.segments()
+        return {
+            'segments': len(segments),
+            'chunks': sum(segment.live for segment in segments),
+            'searches': self.searches,
+        }
+
+
+class _IndexLock:
+    # Un solo index_documents a la vez sobre el mismo directorio
+    def __init__(self, directory):
+        self.path = os.path.join(directory, '.lock')
+
+    def __enter__(self):
+        self.file = open(self.path, 'w')
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def _document_files(paths):
+    for root in paths:
+        root = os.path.abspath(root)
+        if os.path.isfile(root):
+            yield root, os.path.dirname(root)
+            continue
+        for directory, _, names in os.walk(root):
+            for name in sorted(names):
+                if name.lower().endswith(TEXT_EXTENSIONS):
+                    yield os.path.join(directory, name), root
+
+
+def _remove_orphans(directory, manifest):
+    # Segmentos fuera del manifest: los de una ejecución que murió antes de
+    # escribirlo (su nombre se reutilizará) o los que ya no tienen fragmentos.
+    # Un worker que aún los tenga mapeados conserva sus páginas
+    names = {entry['name'] for entry in manifest['segments']}
+    for name in os.listdir(directory):
+        if name.startswith('seg-') and name not in names:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def _tombstone(manifest, document):
+    for entry in manifest['segments']:
+        if entry['name'] == document['segment']:
+            entry['deleted'].append([document['start'], document['end']])
+
+
+def _build(directory, name, records):
+    texts = [record['text'] for record in records]
+    vectors = np.empty((len(records), DIMENSIONS), dtype=np.float32)
+    for row, text in enumerate(texts):
+        vectors[row] = embed(text)
+    chunk_postings, lengths = postings(texts)
+    write_segment(os.path.join(directory, name), records, vectors, chunk_postings, lengths)
+
+
+def _compact(directory, manifest, documents, name):
+    # Un único segmento con los fragmentos vivos; reutiliza los vectores
+    segments = {entry['name']: Segment(os.path.join(directory, entry['name'])) for entry in manifest['segments']}
+    order = {entry['name']: position for position, entry in enumerate(manifest['segments'])}
+    records, vectors = [], []
+    for document in sorted(documents.values(), key=lambda doc: (order[doc['segment']], doc['start'])):
+        segment = segments[document['segment']]
+        chunk_ids = np.arange(document['start'], document['end'])
+        start = len(records)
+        records.extend(segment.chunk(chunk_id) for chunk_id in chunk_ids)
+        vectors.append(segment.vectors_for(chunk_ids))
+        document.update(segment=name, start=start, end=len(records))
+    if records:
+        chunk_postings, lengths = postings(record['text'] for record in records)
+        write_segment(os.path.join(directory, name), records, np.concatenate(vectors), chunk_postings, lengths)
+        manifest['segments'] = [{'name': name, 'deleted': []}]
+    else:
+        manifest['segments'] = []
+
+
+def index_documents(directory, paths, chunk_tokens=200, overlap=40, max_segments=8, compact=False):
+    # Indexa de forma incremental: solo se trocean y vectorizan los ficheros
+    # nuevos o modificados, en un segmento nuevo; los fragmentos de sus
+    # versiones anteriores y de los ficheros borrados quedan marcados como
+    # borrados. Con más de max_segments segmentos (o compact=True) se fusionan
+    os.makedirs(directory, exist_ok=True)
+    with _IndexLock(directory):
+        manifest = _load_json(os.path.join(directory, MANIFEST), {'generation': 0, 'segments': []})
+        documents = _load_json(os.path.join(directory, DOCUMENTS), {})
+        _remove_orphans(directory, manifest)
+        stats = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+        roots = [os.path.abspath(path) for path in paths]
+        records, new_documents, seen = [], {}, set()
+
+        for path, root in _document_files(paths):
+            seen.add(path)
+            stat = os.stat(path)
+            previous = documents.get(path)
+            if previous and (previous['mtime_ns'], previous['size']) == (stat.st_mtime_ns, stat.st_size):
+                stats['unchanged'] += 1
+                continue
+            if previous:
+                _tombstone(manifest, previous)
+                del documents[path]
+            stats['updated' if previous else 'added'] += 1
+            start = len(records)
+            source = os.path.relpath(path, root)
+            records.extend(
+                {'source': source, 'text': text, 'tokens': text_tokens}
+                for text, text_tokens in chunk_text(read_document(path), chunk_tokens, overlap)
+            )
+            if len(records) > start:
+                new_documents[path] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size,
+                                       'start': start, 'end': len(records)}
+
+        for path in list(documents):
+            inside = any(path == root or path.startswith(root + os.sep) for root in roots)
+            if inside and path not in seen:
+                _tombstone(manifest, documents.pop(path))
+                stats['removed'] += 1
+
+        manifest['generation'] += 1
+        if records:
+            name = f"seg-{manifest['generation']:06d}"
+            _build(directory, name, records)
+            manifest['segments'].append({'name': name, 'deleted': []})
+            for document in new_documents.values():
+                document['segment'] = name
+            documents.update(new_documents)
+        # Los segmentos que ya no tienen fragmentos vivos se descartan
+        live = {document['segment'] for document in documents.values()}
+        manifest['segments'] = [entry for entry in manifest['segments'] if entry['name'] in live]
+        if compact or len(manifest['segments']) > max_segments:
+            manifest['generation'] += 1
+            _compact(directory, manifest, documents, f"seg-{manifest['generation']:06d}")
+
+        _write_json(os.path.join(directory, DOCUMENTS), documents)
+        # El manifest se escribe el último: es lo que vigilan los workers
+        _write_json(os.path.join(directory, MANIFEST), manifest)
+        _remove_orphans(directory, manifest)
+        stats['segments'] = len(manifest['segments'])
+        stats['chunks'] = sum(document['end'] - document['start'] for document in documents.values())
+        return stats
+
+
+_rag_index = None
+_rag_index_lock = threading.Lock()
+
+
+def get_rag_index():
+    global _rag_index
+    if _rag_index is None:
+        with _rag_index_lock:
+            if _rag_index is None:
+                _rag_index = RagIndex(
+                    settings.CHATBOT_RAG_DIR,
+                    top_k=settings.CHATBOT_RAG_TOP_K,
+                    probes=settings.CHATBOT_RAG_PROBES,
+                    min_score=settings.CHATBOT_RAG_MIN_SCORE,
+                )
+    return _rag_index
+
+
+@receiver(setting_changed)
+def _reset_rag_index(setting, **kwargs):
+    global _rag_index
+    if setting.startswith('CHATBOT_RAG_'):
+        _rag_index = None
+
+
+def retrieve(message):
+    # Fragmentos para el prompt; [] si está desactivado, aún no hay índice o
+    # falla la búsqueda: el contexto de documentos es opcional, el turno no
+    if not settings.CHATBOT_RAG_ENABLED:
+        return []
+    try:
+        return get_rag_index().search(message)
+    except Exception:
+        logger.exception("Falló la búsqueda en el índice de documentos")
+        return []
+
+
+async def aretrieve(message):
+    # Lectura de los mapas de memoria y cálculo NumPy: fuera del event loop
+    if not settings.CHATBOT_RAG_ENABLED:
+        return []
+    return await sync_to_async(retrieve, thread_sensitive=False)(message)
@@ -0,0 +1,123 @@
+import gzip
+import json
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Min
+from django.utils import timezone
+
+from . import partitions
+from .models import ChatMessage, Conversation
+
+EXPORT_FIELDS = ('id', 'conversation_id', 'role', 'content', 'timestamp')
+
+
+def retention_cutoff(retention_days=None, now=None):
+    days = settings.CHATBOT_MESSAGE_RETENTION_DAYS if retention_days is None else retention_days
+    return (now or timezone.now()) - timedelta(days=days)
+
+
+def _months_before(first, cutoff):
+    months = []
+    if first is not None:
+        month = partitions.month_start(first)
+        while partitions.next_month(month) <= cutoff:
+            months.append((partitions.partition_name(month), month))
+            month = partitions.next_month(month)
+    return months
+
+
+def expired_months(cutoff):
+    # Meses completos anteriores al corte, de más antiguo a más nuevo. Un mes
+    # a caballo del corte se conserva entero hasta que caduca del todo.
+    if partitions.is_partitioned():
+        attached = partitions.list_partitions()
+        months = [(name, month) for name, month in attached if partitions.next_month(month) <= cutoff]
+        # Los meses sin partición propia que tienen filas en la partición por
+        # defecto también caducan; esos se borran en lugar de hacer DROP
+        names = {name for name, _ in attached}
+        months += [
+            (name, month) for name, month in _months_before(partitions.default_partition_first(), cutoff)
+            if name not in names
+        ]
+        return sorted(months, key=lambda item: item[1])
+    return _months_before(ChatMessage.objects.aggregate(first=Min('timestamp'))['first'], cutoff)
+
+
+def _month_messages(month):
+    return ChatMessage.objects.filter(timestamp__gte=month, timestamp__lt=partitions.next_month(month))
+
+
+def export_month(month, path, chunk_size=5000):
+    # JSONL comprimido, fila a fila con un cursor: no carga el mes en memoria.
+    # Se escribe a un temporal y se renombra, así un archivo a medias nunca
+    # parece completo.
+    tmp_path = f"{path}.tmp"
+    rows = 0
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as archive:
+        for row in _month_messages(month).order_by().values(*EXPORT_FIELDS).iterator(chunk_size=chunk_size):
+            row['timestamp'] = row['timestamp'].isoformat()
+            archive.write(json.dumps(row, ensure_ascii=False))
+            archive.write('\n')
+            rows += 1
+    with open(tmp_path, 'rb') as archive:
+        os.fsync(archive.fileno())
+    os.replace(tmp_path, path)
+    return rows
+
+
+def _delete_month(month, batch_size):
+    # Sin particiones (SQLite) no queda más remedio que borrar por lotes
+    deleted = 0
+    queryset = _month_messages(month)
+    while True:
+        ids = list(queryset.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += ChatMessage.objects.filter(id__in=ids).delete()[0]
+
+
+def archive_expired(cutoff, archive_dir=None, dry_run=False, batch_size=5000):
+    # Exporta cada mes caducado a <archive_dir>/<partición>.jsonl.gz y luego lo
+    # elimina: en PostgreSQL con DETACH + DROP de la partición, sin DELETE ni VACUUM
+    archive_dir = archive_dir or settings.CHATBOT_ARCHIVE_DIR
+    os.makedirs(archive_dir, exist_ok=True)
+    archived = []
+    droppable = {name for name, _ in partitions.list_partitions()} if partitions.is_partitioned() else set()
+    for name, month in expired_months(cutoff):
+        if dry_run:
+            archived.append((name, _month_messages(month).count()))
+            continue
+        rows = export_month(month, os.path.join(archive_dir, f"{name}.jsonl.gz"), chunk_size=batch_size)
+        if name in droppable:
+            partitions.drop_partition(name)
+        else:
+            _delete_month(month, batch_size)
+        archived.append((name, rows))
+    return archived
+
+
+def sweep_conversation_ttl(now=None, dry_run=False):
+    # TTL por conversación: borra los mensajes más antiguos que su retention_days.
+    # Cada borrado usa el índice (conversation_id, timestamp).
+    now = now or timezone.now()
+    deleted = 0
+    conversations = Conversation.objects.filter(retention_days__isnull=False).values_list('id', 'retention_days')
+    for conversation_id, days in conversations.iterator():
+        expired = ChatMessage.objects.filter(
+            conversation_id=conversation_id,
+            timestamp__lt=now - timedelta(days=days),
+        )
+        deleted += expired.count() if dry_run else expired.delete()[0]
+    return deleted
+
+
+def ensure_future_partitions(months_ahead=None):
+    if not partitions.is_partitioned():
+        return []
+    until = timezone.now()
+    for _ in range(settings.CHATBOT_PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead):
+        until = partitions.next_month(until)
+    return partitions.ensure_partitions(until, using=connection)
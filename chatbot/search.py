@@ -0,0 +1,215 @@
+import heapq
+import math
+import re
+import threading
+from collections import defaultdict
+
+from django.db import connection
+
+from .embeddings import STOPWORDS, normalize
+from .models import ChatMessage
+
+# Configuración de texto de PostgreSQL: el contenido del chat está en español
+SEARCH_CONFIG = 'spanish'
+SNIPPET_OPTIONS = 'MaxFragments=1, MaxWords=24, MinWords=8, StartSel=<mark>, StopSel=</mark>'
+
+_WORD_RE = re.compile(r"\w+")
+
+POSTGRES_SEARCH_SQL = f"""
+    WITH query AS (SELECT websearch_to_tsquery('{SEARCH_CONFIG}', %(q)s) AS q)
+    SELECT id, conversation_id, role, "timestamp", rank,
+           ts_headline('{SEARCH_CONFIG}', content, query.q, %(snippet)s) AS snippet
+    FROM (
+        SELECT m.id, m.conversation_id, m.role, m.content, m."timestamp",
+               ts_rank_cd(m.search_vector, query.q) AS rank
+        FROM chatbot_chatmessage m, query
+        WHERE m.search_vector @@ query.q {{conversation_filter}}
+    ) ranked, query
+    {{cursor_filter}}
+    ORDER BY rank DESC, id DESC
+    LIMIT %(limit)s
+"""
+
+
+def tokens(text):
+    # Palabras normalizadas sin palabras vacías, con un stemming mínimo de
+    # plurales para acercarse a lo que hace la configuración 'spanish'
+    for word in _WORD_RE.findall(normalize(text)):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith('es'):
+            word = word[:-2]
+        elif len(word) > 3 and word.endswith('s'):
+            word = word[:-1]
+        yield word
+
+
+# Índice invertido en memoria para SQLite (pruebas y desarrollo). Se pone al
+# día de forma incremental con los mensajes de id mayor que el último indexado.
+class InvertedIndex:
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.lengths = {}
+        self.total_length = 0
+        self.last_id = 0
+        # Ids borrados de la base de datos que aún quedan en postings
+        self.removed = set()
+        self._lock = threading.Lock()
+
+    def refresh(self, chunk_size=5000):
+        with self._lock:
+            new_messages = (
+                ChatMessage.objects.filter(id__gt=self.last_id)
+                .order_by('id').values_list('id', 'content')
+                .iterator(chunk_size=chunk_size)
+            )
+            for message_id, content in new_messages:
+                self.add(message_id, content)
+
+    def add(self, message_id, content):
+        counts = defaultdict(int)
+        for token in tokens(content):
+            counts[token] += 1
+        for token, count in counts.items():
+            self.postings[token][message_id] = count
+        length = sum(counts.values())
+        self.lengths[message_id] = length
+        self.total_length += length
+        self.last_id = max(self.last_id, message_id)
+
+    def remove(self, message_ids):
+        # Los postings de un mensaje borrado se limpian al consultarlos en _rank
+        with self._lock:
+            for message_id in message_ids:
+                length = self.lengths.pop(message_id, None)
+                if length is not None:
+                    self.total_length -= length
+                    self.removed.add(message_id)
+
+    def search(self, query, limit, after=None, conversation_ids=None):
+        # BM25 sobre los mensajes que contienen todos los términos; devuelve
+        # [(score, id)] ordenado como en PostgreSQL: score y id descendentes
+        terms = set(tokens(query))
+        with self._lock:
+            if not terms or not self.lengths:
+                return []
+            return self._rank(terms, limit, after, conversation_ids)
+
+    def _rank(self, terms, limit, after, conversation_ids):
+        postings = [self.postings.get(term, {}) for term in terms]
+        if self.removed:
+            for posting in postings:
+                for message_id in self.removed.intersection(posting):
+                    del posting[message_id]
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates &= posting.keys()
+        if conversation_ids is not None:
+            candidates &= conversation_ids
+        total = len(self.lengths)
+        average = self.total_length / total
+        k1, b = self.K1, self.B
+        weighted = [
+            (posting, math.log(1 + (total - len(posting) + 0.5) / (len(posting) + 0.5)) * (k1 + 1))
+            for posting in postings
+        ]
+        lengths = self.lengths
+        scored = []
+        for message_id in candidates:
+            norm = k1 * (1 - b + b * lengths[message_id] / average)
+            score = 0.0
+            for posting, weight in weighted:
+                tf = posting[message_id]
+                score += weight * tf / (tf + norm)
+            if after is None or (score, message_id) < after:
+                scored.append((score, message_id))
+        return heapq.nlargest(limit, scored)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = InvertedIndex()
+    return _index
+
+
+def _snippet(content, query, width=160):
+    # Fragmento alrededor del primer término encontrado
+    normalized = normalize(content)
+    positions = [normalized.find(term) for term in tokens(query)]
+    positions = [p for p in positions if p >= 0]
+    start = max(0, min(positions) - width // 4) if positions else 0
+    snippet = content[start:start + width]
+    return ('…' if start else '') + snippet + ('…' if start + width < len(content) else '')
+
+
+def _search_postgres(query, limit, after, conversation_ids):
+    params = {'q': query, 'snippet': SNIPPET_OPTIONS, 'limit': limit}
+    conversation_filter = cursor_filter = ''
+    if conversation_ids is not None:
+        conversation_filter = 'AND m.conversation_id = ANY(%(conversation_ids)s)'
+        params['conversation_ids'] = list(conversation_ids)
+    if after is not None:
+        cursor_filter = 'WHERE (rank, id) < (%(rank)s::real, %(id)s)'
+        params['rank'], params['id'] = after
+    sql = POSTGRES_SEARCH_SQL.format(conversation_filter=conversation_filter, cursor_filter=cursor_filter)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def _search_fallback(query, limit, after, conversation_ids):
+    index = get_index()
+    index.refresh()
+    # El índice en memoria filtra por ids de mensaje
+    message_ids = None
+    if conversation_ids is not None:
+        message_ids = set(
+            ChatMessage.objects.filter(conversation_id__in=conversation_ids).values_list('id', flat=True)
+        )
+    while True:
+        hits = index.search(query, limit, after=tuple(after) if after else None, conversation_ids=message_ids)
+        rows = ChatMessage.objects.in_bulk([message_id for _, message_id in hits])
+        # Mensajes borrados (retención) después de indexarse: se quitan del
+        # índice y se repite la búsqueda para no devolver una página corta
+        deleted = [message_id for _, message_id in hits if message_id not in rows]
+        if not deleted:
+            break
+        index.remove(deleted)
+    results = []
+    for score, message_id in hits:
+        message = rows[message_id]
+        results.append({
+            'id': message.id,
+            'conversation_id': message.conversation_id,
+            'role': message.role,
+            'timestamp': message.timestamp,
+            'rank': score,
+            'snippet': _snippet(message.content, query),
+        })
+    return results
+
+
+def search_messages(query, limit=20, after=None, conversation_ids=None):
+    # Devuelve (resultados, cursor_siguiente). after es el (rank, id) del
+    # último resultado de la página anterior; conversation_ids limita la
+    # búsqueda a esas conversaciones (None: todas)
+    if conversation_ids is not None and not conversation_ids:
+        return [], None
+    search = _search_postgres if connection.vendor == 'postgresql' else _search_fallback
+    results = search(query, limit + 1, after, conversation_ids)
+    has_more = len(results) > limit
+    results = results[:limit]
+    next_after = (results[-1]['rank'], results[-1]['id']) if has_more else None
+    return results, next_after
@@ -0,0 +1,160 @@
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .embeddings import DIMENSIONS, embed, fold
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Dimensiones del índice aproximado y candidatos que se reordenan con el vector completo
+COARSE_DIMENSIONS = 64
+CANDIDATES = 64
+
+
+# Caché semántica de respuestas: preguntas ya contestadas y sus vectores en una
+# matriz NumPy; se persiste en disco como ficheros de solo anexado
+# (vectors.f32 con los vectores y entries.jsonl con pregunta y respuesta)
+class SemanticCache:
+    def __init__(self, directory, threshold=0.8, max_entries=100_000):
+        self.directory = directory
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.vectors_path = os.path.join(directory, 'vectors.f32')
+        self.entries_path = os.path.join(directory, 'entries.jsonl')
+        self._vectors = np.zeros((1024, DIMENSIONS), dtype=np.float32)
+        self._coarse = np.zeros((1024, COARSE_DIMENSIONS), dtype=np.float32)
+        self._answers = []
+        self._entries_offset = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._load_new_entries()
+
+    def __len__(self):
+        return len(self._answers)
+
+    def _grow(self, size):
+        capacity = len(self._vectors)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for name in ('_vectors', '_coarse'):
+            current = getattr(self, name)
+            grown = np.zeros((capacity, current.shape[1]), dtype=np.float32)
+            grown[:len(self._answers)] = current[:len(self._answers)]
+            setattr(self, name, grown)
+
+    def _load_new_entries(self):
+        # Lee lo que otros procesos (o una ejecución anterior) añadieron a los ficheros
+        if not os.path.exists(self.entries_path):
+            return
+        if os.path.getsize(self.entries_path) == self._entries_offset:
+            return
+        with open(self.entries_path, 'rb') as entries_file:
+            entries_file.seek(self._entries_offset)
+            lines = entries_file.read().split(b'\n')
+        # La última línea puede estar a medio escribir: se deja para la próxima vez
+        complete = lines[:-1]
+        if not complete:
+            return
+        start = len(self._answers)
+        vectors = np.fromfile(
+            self.vectors_path, dtype=np.float32,
+            count=len(complete) * DIMENSIONS, offset=start * DIMENSIONS * 4
+        ).reshape(-1, DIMENSIONS)
+        count = min(len(complete), len(vectors))
+        self._grow(start + count)
+        self._vectors[start:start + count] = vectors[:count]
+        self._coarse[start:start + count] = fold(vectors[:count], COARSE_DIMENSIONS)
+        self._answers.extend(json.loads(line)['answer'] for line in complete[:count])
+        self._entries_offset += sum(len(line) + 1 for line in complete[:count])
+
+    def lookup(self, question):
+        query = embed(question)
+        with self._lock:
+            self._load_new_entries()
+            size = len(self._answers)
+            if not size:
+                self.misses += 1
+                return None
+            # Primero un barrido barato en 64 dimensiones y después el producto
+            # exacto solo sobre los mejores candidatos
+            coarse_scores = self._coarse[:size] @ fold(query, COARSE_DIMENSIONS)
+            if size > CANDIDATES:
+                candidates = np.argpartition(coarse_scores, -CANDIDATES)[-CANDIDATES:]
+            else:
+                candidates = np.arange(size)
+            scores = self._vectors[candidates] @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._answers[candidates[best]]
+
+    def add(self, question, answer):
+        vector = embed(question)
+        line = json.dumps({'question': question, 'answer': answer}, ensure_ascii=False).encode('utf-8') + b'\n'
+        with self._lock:
+            self._load_new_entries()
+            if len(self._answers) >= self.max_entries:
+                return False
+            with open(self.entries_path, 'ab') as entries_file, open(self.vectors_path, 'ab') as vectors_file:
+                # Vector y respuesta se escriben juntos para no desalinear los ficheros
+                if fcntl is not None:
+                    fcntl.flock(entries_file, fcntl.LOCK_EX)
+                try:
+                    vectors_file.write(vector.tobytes())
+                    vectors_file.flush()
+                    entries_file.write(line)
+                    entries_file.flush()
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(entries_file, fcntl.LOCK_UN)
+            self._load_new_entries()
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._answers)}
+
+
+_semantic_cache = None
+_semantic_cache_lock = threading.Lock()
+
+
+def get_semantic_cache():
+    # None si está desactivada en settings
+    global _semantic_cache
+    if not settings.CHATBOT_SEMANTIC_CACHE_ENABLED:
+        return None
+    if _semantic_cache is None:
+        with _semantic_cache_lock:
+            if _semantic_cache is None:
+                _semantic_cache = SemanticCache(
+                    settings.CHATBOT_SEMANTIC_CACHE_DIR,
+                    threshold=settings.CHATBOT_SEMANTIC_CACHE_THRESHOLD,
+                    max_entries=settings.CHATBOT_SEMANTIC_CACHE_MAX_ENTRIES,
+                )
+    return _semantic_cache
+
+
+@receiver(setting_changed)
+def _reset_semantic_cache(setting, **kwargs):
+    global _semantic_cache
+    if setting.startswith('CHATBOT_SEMANTIC_CACHE_'):
+        _semantic_cache = None
@@ -0,0 +1,72 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import llm
+from .models import ChatMessage, ConversationSummary
+
+logger = logging.getLogger(__name__)
+
+# Un único hilo en segundo plano: el resumen nunca bloquea la respuesta al usuario
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chatbot-summary')
+
+SUMMARY_INSTRUCTIONS = (
+    "Eres un asistente que resume conversaciones. Actualiza el resumen existente "
+    "con los mensajes nuevos. Conserva datos, nombres, decisiones y preguntas "
+    "pendientes; responde solo con el resumen, en español y en pocas frases."
+)
+
+
+def _summary_prompt(previous_summary, messages):
+    transcript = "\n".join(f"{role}: {content}" for role, content in messages)
+    return [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+        {"role": "user", "content": f"Resumen actual:\n{previous_summary or '(vacío)'}\n\nMensajes nuevos:\n{transcript}"},
+    ]
+
+
+def compact_conversation(conversation_id):
+    # Pliega en el resumen los mensajes más antiguos que aún no estén incluidos.
+    # Solo se envían el resumen previo y los mensajes nuevos, nunca la conversación entera.
+    # Por debajo del umbral solo se lee: la fila del resumen se crea al plegar
+    summary = (
+        ConversationSummary.objects.filter(pk=conversation_id).first()
+        or ConversationSummary(conversation_id=conversation_id)
+    )
+    pending = ChatMessage.objects.filter(conversation_id=conversation_id, id__gt=summary.summarized_through)
+    pending_count = pending.count()
+    if pending_count <= settings.CHATBOT_SUMMARY_THRESHOLD:
+        return False
+    if summary._state.adding:
+        summary, _ = ConversationSummary.objects.get_or_create(conversation_id=conversation_id)
+
+    rows = list(
+        pending.order_by('id').values_list('id', 'role', 'content')[:pending_count - settings.CHATBOT_SUMMARY_KEEP_RECENT]
+    )
+    content = llm.complete(
+        _summary_prompt(summary.content, [(role, text) for _, role, text in rows]),
+        temperature=0.2,
+        max_tokens=500
+    )
+
+    # Si otro proceso actualizó el resumen mientras tanto, se descarta este
+    return bool(
+        ConversationSummary.objects
+        .filter(pk=conversation_id, summarized_through=summary.summarized_through)
+        .update(content=content.strip(), summarized_through=rows[-1][0])
+    )
+
+
+def _compact_in_background(conversation_id):
+    try:
+        compact_conversation(conversation_id)
+    except Exception:
+        logger.exception("No se pudo resumir la conversación %s", conversation_id)
+    finally:
+        close_old_connections()
+
+
+def schedule_compaction(conversation_id):
+    _executor.submit(_compact_in_background, conversation_id)
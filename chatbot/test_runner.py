@@ -0,0 +1,31 @@
+import os
+import shutil
+import tempfile
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+# Directorios de datos que la aplicación crea bajo var/: las pruebas usan unos
+# propios en un directorio temporal que se borra al terminar
+DATA_DIRS = (
+    'CHATBOT_COALESCE_DIR',
+    'CHATBOT_RAG_DIR',
+    'CHATBOT_SEMANTIC_CACHE_DIR',
+    'CHATBOT_WRITE_BEHIND_DIR',
+    'CHATBOT_ARCHIVE_DIR',
+)
+
+
+class TestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.data_root = tempfile.mkdtemp(prefix='chatbot-tests-')
+        self.data_dirs = override_settings(**{
+            name: os.path.join(self.data_root, name.lower()) for name in DATA_DIRS
+        })
+        self.data_dirs.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.data_dirs.disable()
+        shutil.rmtree(self.data_root, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
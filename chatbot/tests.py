@@ -1,3 +1,1286 @@
-from django.test import TestCase
+import asyncio
+import copy
+import gzip
+import importlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import threading
+from datetime import datetime, timezone as dt_timezone
+from unittest import mock, skipUnless
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+
+from . import fastjson, jobs, llm, metrics, partitions, persistence, retention, transcripts
+from .access import SESSION_KEY
+from .benchmark import regressions, rss_bytes, summarize
+from .cache import CompletionCache, NullCache, get_completion_cache
+from .coalesce import RESULT_MAX_AGE, SingleFlight, get_singleflight
+from .embeddings import embed
+from .fake_llm import FakeLLMServer
+from .governor import CircuitOpenError, Governor, UpstreamError
+from .history import load_context
+from .prompt import PromptBuilder, count_tokens
+from .providers import HEDGE_MIN_SAMPLES, LatencyTracker, Provider, Router, _adiscard
+from .rag import RagIndex, chunk_text, index_documents, retrieve
+from .models import ChatMessage, Conversation, ConversationSummary, Job
+from .pagination import encode_cursor
+from .persistence import WriteBehindBuffer
+from .retention import archive_expired, sweep_conversation_ttl
+from .semantic_cache import CANDIDATES, SemanticCache
+from .search import InvertedIndex, search_messages
+from .summary import compact_conversation
+from .throttle import Throttle
+from .titles import fallback_title
+from .views import _acached_answer
+from .ws import websocket_application
+
+
+@override_settings(CHATBOT_SUMMARY_THRESHOLD=6, CHATBOT_SUMMARY_KEEP_RECENT=2)
+class SummaryCompactionTests(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create(title="Horarios")
+        self.add_messages(8)
+
+    def add_messages(self, count):
+        start = self.conversation.messages.count()
+        for i in range(start, start + count):
+            ChatMessage.objects.create(
+                conversation=self.conversation,
+                role='user' if i % 2 == 0 else 'assistant',
+                content=f"mensaje {i}"
+            )
+
+    @mock.patch('chatbot.summary.llm.complete', return_value="Resumen uno")
+    def test_folds_old_messages_and_keeps_recent_window(self, complete):
+        self.assertTrue(compact_conversation(self.conversation.id))
+
+        prompt = complete.call_args.args[0][-1]['content']
+        self.assertIn("mensaje 0", prompt)
+        self.assertIn("mensaje 5", prompt)
+        self.assertNotIn("mensaje 6", prompt)
+
+        summary, history = load_context(self.conversation.id)
+        self.assertEqual(summary, "Resumen uno")
+        self.assertEqual([m['content'] for m in history], ["mensaje 6", "mensaje 7"])
+
+    @mock.patch('chatbot.summary.llm.complete', return_value="Resumen")
+    def test_below_threshold_does_not_call_llm(self, complete):
+        ChatMessage.objects.filter(conversation=self.conversation).order_by('-id').first().delete()
+        ChatMessage.objects.filter(conversation=self.conversation).order_by('-id').first().delete()
+
+        self.assertFalse(compact_conversation(self.conversation.id))
+        complete.assert_not_called()
+        # Ni se escribe una fila de resumen vacía en cada turno
+        self.assertFalse(ConversationSummary.objects.exists())
+
+    @mock.patch('chatbot.summary.llm.complete', side_effect=["Resumen uno", "Resumen dos"])
+    def test_update_is_incremental(self, complete):
+        compact_conversation(self.conversation.id)
+        self.add_messages(5)
+        self.assertTrue(compact_conversation(self.conversation.id))
+
+        # La segunda pasada solo recibe el resumen previo y los mensajes nuevos
+        prompt = complete.call_args.args[0][-1]['content']
+        self.assertIn("Resumen uno", prompt)
+        self.assertNotIn("mensaje 5", prompt)
+        self.assertIn("mensaje 6", prompt)
+        self.assertIn("mensaje 10", prompt)
+        self.assertNotIn("mensaje 11", prompt)
+
+        summary = ConversationSummary.objects.get(pk=self.conversation.id)
+        self.assertEqual(summary.content, "Resumen dos")
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create(title="Archivo")
+        for month in (1, 2, 3):
+            ChatMessage.objects.create(
+                conversation=self.conversation, role='user', content=f"mes {month}",
+                timestamp=datetime(2025, month, 15, tzinfo=dt_timezone.utc),
+            )
+
+    def test_archives_whole_months_before_cutoff(self):
+        with tempfile.TemporaryDirectory() as directory:
+            archived = archive_expired(datetime(2025, 3, 10, tzinfo=dt_timezone.utc), directory)
+            self.assertEqual(archived, [('chatbot_chatmessage_p202501', 1), ('chatbot_chatmessage_p202502', 1)])
+            with gzip.open(f"{directory}/chatbot_chatmessage_p202502.jsonl.gz", 'rt', encoding='utf-8') as archive:
+                rows = [json.loads(line) for line in archive]
+        self.assertEqual([row['content'] for row in rows], ["mes 2"])
+        self.assertEqual(list(ChatMessage.objects.values_list('content', flat=True)), ["mes 3"])
+
+    @skipUnless(connection.vendor == 'postgresql', "Las particiones solo existen en PostgreSQL")
+    def test_drops_expired_partitions_and_empties_the_default_one(self):
+        with connection.cursor() as cursor:
+            partitions.create_partition(cursor, datetime(2024, 12, 1, tzinfo=dt_timezone.utc))
+        ChatMessage.objects.create(conversation=self.conversation, role='user', content="mes 12",
+                                   timestamp=datetime(2024, 12, 15, tzinfo=dt_timezone.utc))
+        with connection.cursor() as cursor:
+            # Dentro de la transacción del test la clave ajena diferida impediría el DROP
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        with tempfile.TemporaryDirectory() as directory:
+            archived = archive_expired(datetime(2025, 3, 10, tzinfo=dt_timezone.utc), directory)
+        self.assertEqual(archived[0], ('chatbot_chatmessage_p202412', 1))
+        self.assertNotIn('chatbot_chatmessage_p202412', [name for name, _ in partitions.list_partitions()])
+        self.assertEqual(list(ChatMessage.objects.values_list('content', flat=True)), ["mes 3"])
+
+    @skipUnless(connection.vendor == 'postgresql', "Las particiones solo existen en PostgreSQL")
+    def test_creates_partitions_for_months_already_in_the_default_one(self):
+        # Más allá de las particiones que creó la migración: cae en la de por defecto
+        month = partitions.month_start(datetime.now(dt_timezone.utc))
+        for _ in range(6):
+            month = partitions.next_month(month)
+        message = ChatMessage.objects.create(conversation=self.conversation, role='user', content="beca futura",
+                                             timestamp=month.replace(day=10))
+
+        def partition_of(message):
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT tableoid::regclass::text FROM chatbot_chatmessage WHERE id = %s', [message.id])
+                return cursor.fetchone()[0]
+
+        self.assertEqual(partition_of(message), partitions.DEFAULT_PARTITION)
+        with self.assertLogs('chatbot.partitions', 'WARNING'):
+            created = retention.ensure_future_partitions(months_ahead=7)
+        self.assertIn(partitions.partition_name(month), created)
+        self.assertEqual(partition_of(message), partitions.partition_name(month))
+        self.assertEqual([result['id'] for result in search_messages("beca")[0]], [message.id])
+
+    def test_conversation_ttl_only_touches_that_conversation(self):
+        other = Conversation.objects.create(title="Sin TTL")
+        ChatMessage.objects.create(conversation=other, role='user', content="viejo",
+                                   timestamp=datetime(2025, 1, 1, tzinfo=dt_timezone.utc))
+        self.conversation.retention_days = 30
+        self.conversation.save()
+        now = datetime(2025, 3, 20, tzinfo=dt_timezone.utc)
+        self.assertEqual(sweep_conversation_ttl(now=now), 2)
+        self.assertEqual(self.conversation.messages.get().content, "mes 3")
+        self.assertTrue(other.messages.exists())
+
+
+@skipUnless(connection.vendor == 'postgresql', "La migración solo particiona en PostgreSQL")
+class PartitionMigrationTests(TransactionTestCase):
+    def test_unpartition_and_partition_again_keep_the_messages(self):
+        conversation = Conversation.objects.create(title="Migración")
+        for month in (1, 6):
+            ChatMessage.objects.create(conversation=conversation, role='user', content=f"mes {month}",
+                                       timestamp=datetime(2025, month, 15, tzinfo=dt_timezone.utc))
+        call_command('migrate', 'chatbot', '0014', verbosity=0)
+        self.assertFalse(partitions.is_partitioned())
+        call_command('migrate', 'chatbot', verbosity=0)
+        self.assertTrue(partitions.is_partitioned())
+        self.assertIn('chatbot_chatmessage_p202501', [name for name, _ in partitions.list_partitions()])
+        messages = ChatMessage.objects.order_by('id')
+        self.assertEqual(list(messages.values_list('content', flat=True)), ["mes 1", "mes 6"])
+        # La secuencia sigue después del último id copiado
+        latest = ChatMessage.objects.create(conversation=conversation, role='user', content="beca nueva")
+        self.assertGreater(latest.id, messages[1].id)
+        # La columna search_vector (0016) también existe en las particiones nuevas
+        self.assertEqual([result['id'] for result in search_messages("beca")[0]], [latest.id])
+
+
+class TranscriptTransferTests(TestCase):
+    def test_export_import_round_trip(self):
+        # En PostgreSQL la importación usa COPY; en SQLite, bulk_create
+        formats = [('jsonl', 'export.jsonl.gz')]
+        if transcripts.pa is not None:
+            formats.append(('parquet', 'export'))
+        for output_format, name in formats:
+            with self.subTest(format=output_format):
+                ChatMessage.objects.all().delete()
+                Conversation.objects.all().delete()
+                for title in ("Primera", "Segunda", "Tercera"):
+                    conversation = Conversation.objects.create(title=title)
+                    for i in range(3):
+                        ChatMessage.objects.create(conversation=conversation, role='user', content=f"{title} ñ {i}")
+                ChatMessage.objects.create(conversation=conversation, role='assistant', content='')
+                with tempfile.TemporaryDirectory() as directory:
+                    path = os.path.join(directory, name)
+                    call_command('export_conversations', path, format=output_format, batch_size=2,
+                                 stdout=io.StringIO())
+                    self.assertFalse(os.path.exists(f"{path}.checkpoint"))
+                    ChatMessage.objects.all().delete()
+                    Conversation.objects.all().delete()
+                    call_command('import_conversations', path, batch_size=2, stdout=io.StringIO())
+                imported = Conversation.objects.get(title="Segunda")
+                self.assertEqual(
+                    list(imported.messages.order_by('timestamp').values_list('content', flat=True)),
+                    ["Segunda ñ 0", "Segunda ñ 1", "Segunda ñ 2"],
+                )
+                self.assertEqual(ChatMessage.objects.count(), 10)
+                empty = ChatMessage.objects.get(conversation__title="Tercera", role='assistant')
+                self.assertEqual((empty.content, empty.token_count), ('', 0))
+
+
+def own_conversations(client, *conversations):
+    # Conversaciones creadas desde la sesión del cliente de pruebas
+    session = client.session
+    session[SESSION_KEY] = [conversation.id for conversation in conversations]
+    session.save()
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        # Índice propio en cada prueba: el de módulo persiste entre tests
+        patcher = mock.patch('chatbot.search._index', InvertedIndex())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.conversation = Conversation.objects.create(title="Becas")
+        for content in ("¿Cuándo abre la convocatoria de becas?", "La beca Erasmus cubre el alojamiento",
+                        "Horario de la biblioteca", "Beca de comedor y beca de transporte"):
+            ChatMessage.objects.create(conversation=self.conversation, role='user', content=content)
+        own_conversations(self.client, self.conversation)
+
+    @override_settings(CHATBOT_OPERATOR_TOKEN='secreto')
+    def test_only_searches_the_session_conversations(self):
+        other = Conversation.objects.create(title="Ajena")
+        ChatMessage.objects.create(conversation=other, role='user', content="Mi beca secreta")
+        ids = {r['conversation_id'] for r in self.client.get('/search/', {'q': 'beca'}).json()['results']}
+        self.assertEqual(ids, {self.conversation.id})
+        self.assertEqual(self.client.get('/search/', {'q': 'beca', 'conversation_id': other.id}).json()['results'], [])
+        self.assertEqual(Client().get('/search/', {'q': 'beca'}).json()['results'], [])
+        operator = Client(HTTP_AUTHORIZATION='Bearer secreto')
+        self.assertEqual(len(operator.get('/search/', {'q': 'beca'}).json()['results']), 4)
+        results = operator.get('/search/', {'q': 'beca', 'conversation_id': other.id}).json()['results']
+        self.assertEqual([r['conversation_id'] for r in results], [other.id])
+
+    def test_ranked_keyset_pages(self):
+        response = self.client.get('/search/', {'q': 'beca', 'limit': 2})
+        page = response.json()
+        # PostgreSQL marca los términos con <mark>; el índice en memoria no
+        snippet = page['results'][0]['snippet'].replace('<mark>', '').replace('</mark>', '')
+        self.assertEqual(snippet, "Beca de comedor y beca de transporte")
+        self.assertEqual(page['results'][0]['conversation_title'], "Becas")
+        second = self.client.get('/search/', {'q': 'beca', 'limit': 2, 'cursor': page['next_cursor']}).json()
+        self.assertIsNone(second['next_cursor'])
+        ids = [r['id'] for r in page['results'] + second['results']]
+        self.assertEqual(len(set(ids)), 3)
+
+    def test_rejects_bad_cursor(self):
+        self.assertEqual(self.client.get('/search/', {'q': 'beca', 'cursor': 'nope'}).status_code, 400)
+        for position in (["a", "b"], [None, 1], [1.5, "7"], [True, 1], [1.5, 2.0]):
+            with self.subTest(position=position):
+                cursor = encode_cursor(position)
+                self.assertEqual(self.client.get('/search/', {'q': 'beca', 'cursor': cursor}).status_code, 400)
+
+    def test_deleted_messages_do_not_end_pages_early(self):
+        self.assertEqual(len(self.client.get('/search/', {'q': 'beca'}).json()['results']), 3)
+        for content in ("Beca de residencia", "Beca de idiomas"):
+            ChatMessage.objects.create(conversation=self.conversation, role='user', content=content)
+        ChatMessage.objects.filter(content__in=("Beca de comedor y beca de transporte", "Beca de residencia")).delete()
+        seen, cursor = [], None
+        while True:
+            page = self.client.get('/search/', {'q': 'beca', 'limit': 1, **({'cursor': cursor} if cursor else {})}).json()
+            self.assertEqual(len(page['results']), 1)
+            seen.append(page['results'][0]['id'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(len(set(seen)), 3)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create(title="Paginada")
+        moment = datetime(2025, 5, 1, tzinfo=dt_timezone.utc)
+        # Varios mensajes con la misma marca de tiempo: el id deshace el empate
+        for i in range(7):
+            ChatMessage.objects.create(conversation=self.conversation, role='user', content=f"m{i}", timestamp=moment)
+        own_conversations(self.client, self.conversation)
+
+    def test_pages_cover_every_message_once(self):
+        url = f'/conversations/{self.conversation.id}/messages/'
+        seen, cursor = [], None
+        while True:
+            page = self.client.get(url, {'limit': 3, **({'cursor': cursor} if cursor else {})}).json()
+            seen.extend(message['content'] for message in page['results'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(seen, [f"m{i}" for i in reversed(range(7))])
+
+    def test_unchanged_page_returns_304(self):
+        response = self.client.get('/conversations/')
+        self.assertEqual(response.json()['results'][0]['title'], "Paginada")
+        etag = response['ETag']
+        self.assertEqual(self.client.get('/conversations/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Conversation.objects.filter(pk=self.conversation.pk).update(title="Renombrada")
+        self.assertEqual(self.client.get('/conversations/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    @override_settings(CHATBOT_OPERATOR_TOKEN='secreto')
+    def test_only_the_creating_session_or_an_operator_sees_a_conversation(self):
+        other = Conversation.objects.create(title="Ajena")
+        messages_url = f'/conversations/{other.id}/messages/'
+        self.assertEqual([row['title'] for row in self.client.get('/conversations/').json()['results']], ["Paginada"])
+        self.assertEqual(self.client.get(messages_url).status_code, 404)
+        self.assertEqual(Client().get('/conversations/').json()['results'], [])
+        operator = Client(HTTP_AUTHORIZATION='Bearer secreto')
+        self.assertEqual(len(operator.get('/conversations/').json()['results']), 2)
+        self.assertEqual(operator.get(messages_url).status_code, 200)
+        self.assertEqual(Client(HTTP_AUTHORIZATION='Bearer otro').get(messages_url).status_code, 404)
+
+    @mock.patch('chatbot.views.llm.is_configured', return_value=True)
+    @mock.patch('chatbot.views.llm.complete_payload', return_value="Hola")
+    @mock.patch('chatbot.views.llm.acomplete_payload', new_callable=mock.AsyncMock, return_value="Hola")
+    def test_chat_remembers_new_conversations_in_the_session(self, *mocks):
+        client = Client()
+        for url in ('/', '/async/'):
+            with self.subTest(url=url):
+                conversation_id = client.post(url, {'message': f'Hola {url}'},
+                                              content_type='application/json').json()['conversation_id']
+                self.assertIn(conversation_id, client.session[SESSION_KEY])
+                self.assertEqual(client.get(f'/conversations/{conversation_id}/messages/').status_code, 200)
+
+
+class GovernorTests(TestCase):
+    def setUp(self):
+        self.server = FakeLLMServer().start()
+        self.addCleanup(self.server.stop)
+        self.governor = Governor(max_concurrency=2, queue_timeout=5, max_retries=2, base_delay=0.01,
+                                 max_delay=0.5, breaker_threshold=3, breaker_reset=60)
+        provider = Provider('fake', self.server.url, kind='llamacpp', governor=self.governor)
+        patcher = mock.patch('chatbot.providers._router', Router([provider]))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.payload = llm.build_payload([{"role": "user", "content": "Hola"}])
+
+    def test_retries_transient_errors_honouring_retry_after(self):
+        self.server.fail_next(1, status=429, retry_after=0.2)
+        self.server.fail_next(1, status=503)
+        started = time.monotonic()
+        self.assertEqual(llm.complete_payload(self.payload), self.server.reply)
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(self.server.requests_served, 3)
+
+    def test_breaker_opens_and_fails_fast(self):
+        self.server.fail_next(3, status=500)
+        with self.assertRaises(UpstreamError):
+            llm.complete_payload(self.payload)
+        with self.assertRaises(CircuitOpenError):
+            llm.complete_payload(self.payload)
+        self.assertEqual(self.server.requests_served, 3)
+
+    def test_caps_concurrent_upstream_calls(self):
+        self.server.latency = 0.05
+        threads = [threading.Thread(target=llm.complete_payload, args=(self.payload,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.requests_served, 8)
+        self.assertLessEqual(self.server.max_in_flight, 2)
+
+    def test_half_open_probe_is_returned_when_it_cannot_get_a_slot(self):
+        governor = Governor(max_concurrency=1, queue_timeout=0.05, rate=1, burst=1, max_retries=0,
+                            breaker_threshold=1, breaker_reset=0)
+        governor.breaker.record_failure()
+        hold = governor._acquire_slot()
+        # La prueba del half-open no consigue hueco: ni se queda con la prueba ni con la ficha
+        with self.assertRaises(UpstreamError) as raised:
+            governor.call(lambda: self.fail("no debería llegar a enviarse"))
+        self.assertNotIsInstance(raised.exception, CircuitOpenError)
+        self.assertEqual(governor.bucket.tokens, 1)
+
+        async def cancelled_probe():
+            task = asyncio.ensure_future(governor.acall(mock.AsyncMock()))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        asyncio.run(cancelled_probe())
+        hold()
+
+        response, release = governor.call(lambda: mock.Mock(status_code=200))
+        release()
+        self.assertEqual(governor.breaker.state, governor.breaker.CLOSED)
+
+
+class RouterTests(TestCase):
+    def setUp(self):
+        self.payload = llm.build_payload([{"role": "user", "content": "Hola"}])
+        self.servers = [FakeLLMServer(reply=name).start() for name in ("uno", "dos")]
+        for server in self.servers:
+            self.addCleanup(server.stop)
+        self.providers = [
+            Provider(reply, server.url, kind='llamacpp',
+                     governor=Governor(max_retries=0, breaker_threshold=100))
+            for server, reply in zip(self.servers, ("uno", "dos"))
+        ]
+
+    def seed_latency(self, provider, seconds):
+        for _ in range(HEDGE_MIN_SAMPLES):
+            provider.latency.record(seconds)
+
+    def test_fails_over_to_next_provider(self):
+        self.servers[0].fail_next(1, status=500)
+        router = Router(self.providers)
+        self.assertEqual(router.complete(self.payload), "dos")
+        self.assertEqual(router.failovers, 1)
+        # El proveedor que falló queda penalizado en el orden
+        self.assertEqual(router.ranked()[0].name, "dos")
+
+    def test_fails_over_on_a_malformed_response(self):
+        for body in (b'<html>Bad gateway</html>', b'{"choices": []}', b'[]'):
+            with self.subTest(body=body):
+                response = mock.Mock(status_code=200, content=body, elapsed=mock.Mock(total_seconds=lambda: 0))
+                self.providers[0].latency = LatencyTracker()
+                router = Router(self.providers)
+                with mock.patch.object(self.providers[0], '_post', return_value=response):
+                    self.assertEqual(router.complete(self.payload), "dos")
+                self.assertEqual(router.failovers, 1)
+                self.assertEqual(self.providers[0].latency.error_rate(), 1)
+
+    def test_hedges_when_primary_exceeds_its_p95(self):
+        self.seed_latency(self.providers[0], 0.02)
+        self.seed_latency(self.providers[1], 0.05)
+        self.servers[0].latency = 1.0
+        router = Router(self.providers, hedge=True)
+        started = time.monotonic()
+        self.assertEqual(router.complete(self.payload), "dos")
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual((router.hedged, router.hedge_wins), (1, 1))
+
+    def test_closes_the_losing_stream_when_both_attempts_succeed(self):
+        for provider in self.providers:
+            self.seed_latency(provider, 0.01)
+        released = []
+
+        def stream(name):
+            response = mock.Mock(aclose=mock.AsyncMock())
+            return llm.GovernedStream(response, lambda: released.append(name), name)
+
+        # Ninguno responde hasta que han empezado los dos: terminan juntos
+        barrier = threading.Barrier(2)
+
+        def open_stream(name):
+            def call(payload):
+                barrier.wait(5)
+                return stream(name)
+            return call
+
+        both_started = asyncio.Event()
+
+        def aopen_stream(name):
+            async def call(payload):
+                if name == "dos":
+                    both_started.set()
+                await both_started.wait()
+                return stream(name)
+            return call
+
+        async def aopen(router):
+            opened = await router.aopen_stream(self.payload)
+            await asyncio.sleep(0.05)
+            return opened
+
+        for mode in ('sync', 'async'):
+            with self.subTest(mode=mode):
+                released.clear()
+                router = Router(self.providers, hedge=True)
+                with mock.patch.object(self.providers[0], 'open_stream', open_stream("uno")), \
+                        mock.patch.object(self.providers[1], 'open_stream', open_stream("dos")), \
+                        mock.patch.object(self.providers[0], 'aopen_stream', aopen_stream("uno")), \
+                        mock.patch.object(self.providers[1], 'aopen_stream', aopen_stream("dos")):
+                    if mode == 'sync':
+                        opened = router.open_stream(self.payload)
+                        time.sleep(0.05)
+                    else:
+                        opened = asyncio.run(aopen(router))
+                self.assertEqual(router.hedged, 1)
+                self.assertEqual(released, ["dos" if opened.provider == "uno" else "uno"])
+
+    def test_logs_a_losing_stream_that_fails_to_close(self):
+        released = []
+        response = mock.Mock(aclose=mock.AsyncMock(side_effect=OSError("conexión rota")))
+
+        async def scenario():
+            loser = asyncio.get_running_loop().create_future()
+            loser.set_result(llm.GovernedStream(response, lambda: released.append(True)))
+            _adiscard(loser)
+            await asyncio.sleep(0.01)
+
+        with self.assertLogs('chatbot.providers', 'ERROR'):
+            asyncio.run(scenario())
+        self.assertEqual(released, [True])
+
+    def test_cancelling_the_caller_cancels_the_primary(self):
+        self.seed_latency(self.providers[0], 5)
+        self.seed_latency(self.providers[1], 5)
+        cancelled = []
+
+        async def slow(payload):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        async def scenario():
+            router = Router(self.providers, hedge=True)
+            with mock.patch.object(router.ranked()[0], 'aopen_stream', slow):
+                call = asyncio.create_task(router.aopen_stream(self.payload))
+                await asyncio.sleep(0.05)
+                call.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await call
+            await asyncio.sleep(0)
+            # Antes de que asyncio.run cancele lo que quede al terminar
+            self.assertEqual(cancelled, [True])
+
+        asyncio.run(scenario())
+
+
+class ThrottleTests(TestCase):
+    def setUp(self):
+        overrides = override_settings(CHATBOT_THROTTLE_ENABLED=True, CHATBOT_THROTTLE_IP_RATE=6,
+                                      CHATBOT_THROTTLE_IP_BURST=2, CHATBOT_THROTTLE_CACHE='')
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def post(self):
+        # conversation_id inválido: la vista responde 400 sin llamar al LLM
+        return self.client.post('/', {'message': 'Hola', 'conversation_id': 'x'},
+                                content_type='application/json')
+
+    def test_rejects_after_burst_with_retry_after(self):
+        self.assertEqual([self.post().status_code for _ in range(2)], [400, 400])
+        response = self.post()
+        self.assertEqual(response.status_code, 429)
+        # 6 por minuto = una cada 10 s
+        self.assertEqual(response['Retry-After'], '10')
+        self.assertEqual(self.client.get('/stats/llm/').status_code, 403)
+        with override_settings(CHATBOT_OPERATOR_TOKEN='secreto'):
+            stats = self.client.get('/stats/llm/', HTTP_AUTHORIZATION='Bearer secreto').json()['throttle']
+        self.assertEqual(stats['rejected']['ip'], 1)
+        staff = Client()
+        staff.force_login(User.objects.create_user('operadora', is_staff=True))
+        self.assertEqual(staff.get('/stats/llm/').status_code, 200)
+
+    def test_shared_window_limits_across_workers(self):
+        # Dos procesos con su propio fast path comparten el contador de la caché
+        caches['default'].clear()
+        workers = [Throttle({'ip': (3, 3)}, cache_alias='default') for _ in range(2)]
+        results = [workers[i % 2].check({'ip': '10.0.0.1'}) for i in range(4)]
+        self.assertEqual(results[:3], [None, None, None])
+        self.assertIsNotNone(results[3])
+        self.assertEqual(workers[1].stats()['rejected']['ip'], 1)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.server = FakeLLMServer().start()
+        self.addCleanup(self.server.stop)
+        provider = Provider('fake', self.server.url, kind='llamacpp', governor=Governor(max_retries=0))
+        patcher = mock.patch('chatbot.providers._router', Router([provider]))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_records_phases_and_token_usage(self):
+        requests_before = metrics.REQUEST_SECONDS.count('chatbot_message', 'POST', 200)
+        tokens_before = metrics.LLM_TOKENS.value('fake', 'completion')
+        response = self.client.post('/', {'message': 'Hola métricas'}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(metrics.REQUEST_SECONDS.count('chatbot_message', 'POST', 200), requests_before + 1)
+        for phase in ('parse', 'db', 'cache', 'upstream_ttfb', 'upstream_total', 'serialize'):
+            self.assertGreater(metrics.PHASE_SECONDS.count('chatbot_message', phase), 0, phase)
+        self.assertEqual(metrics.LLM_TOKENS.value('fake', 'completion') - tokens_before, len(self.server.tokens))
+
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        with override_settings(CHATBOT_OPERATOR_TOKEN='secreto'):
+            exposition = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secreto').content.decode()
+        self.assertIn('# TYPE chatbot_request_duration_seconds histogram', exposition)
+        self.assertIn('chatbot_request_duration_seconds_bucket{view="chatbot_message",method="POST",'
+                      'status="200",le="+Inf"}', exposition)
+        self.assertIn('chatbot_llm_breaker_open{provider="fake"} 0', exposition)
+
+    def test_pool_stats_cover_the_async_client_of_each_loop(self):
+        payload = llm.build_payload([{'role': 'user', 'content': 'Hola'}])
+
+        async def scenario():
+            for _ in range(2):
+                await llm.acomplete_payload(payload)
+            return llm.pool_stats()['async'][f"loop-{id(asyncio.get_running_loop()):x}"]
+
+        parts = urlsplit(self.server.url)
+        stats = asyncio.run(scenario())[f"{parts.scheme}://{parts.hostname}:{parts.port}"]
+        self.assertEqual(stats, {'in_use': 0, 'idle': 1, 'max_size': settings.LLM_MAX_CONNECTIONS,
+                                 'requests': 2, 'connections_opened': 1, 'reuses': 1})
+
+
+class ChatViewTests(TestCase):
+    def test_sync_and_async_views_reject_turns_alike(self):
+        # Las dos vistas comparten los pasos previos a la llamada al LLM
+        cases = [({'message': 'Hola', 'conversation_id': 'x'}, 400, 'Invalid conversation_id'),
+                 ({'message': 'Hola', 'conversation_id': 999999}, 404, 'Conversation not found')]
+        for url in ('/', '/async/'):
+            for data, status, error in cases:
+                with self.subTest(url=url, status=status):
+                    response = self.client.post(url, data, content_type='application/json')
+                    self.assertEqual((response.status_code, response.json()['error']), (status, error))
+            with self.subTest(url=url, status=500), mock.patch('chatbot.views.llm.is_configured', return_value=False):
+                response = self.client.post(url, {'message': 'Hola'}, content_type='application/json')
+                self.assertEqual((response.status_code, response.json()['error']), (500, 'API key not configured'))
+
+
+# TransactionTestCase: el benchmark hace peticiones desde otros hilos, que no
+# verían los datos de la transacción de un TestCase
+class BenchmarkTests(TransactionTestCase):
+    @mock.patch('chatbot.views.schedule_compaction')
+    def test_suite_reports_and_checks_baseline(self, schedule_compaction):
+        with tempfile.TemporaryDirectory() as directory:
+            baseline = os.path.join(directory, 'baseline.json')
+            # Un solo hilo y sin resúmenes en segundo plano: la base de datos en
+            # memoria de las pruebas (SQLite con caché compartida) no espera a
+            # otra conexión con la tabla bloqueada, falla
+            options = dict(requests=6, concurrency=3, sync_workers=1, latency=0, turns=2, stream=True)
+            call_command('bench_chat', save_baseline=baseline, stdout=io.StringIO(), **options)
+            with open(baseline) as baseline_file:
+                results = json.load(baseline_file)['results']
+            self.assertEqual(set(results), {'sync', 'async'})
+            self.assertEqual(results['sync']['requests'], 6)
+            self.assertEqual(results['sync']['errors'], 0)
+            self.assertGreater(results['async']['queries_per_request'], 0)
+            # Los tiempos de una máquina de CI varían: solo se exige que no falle.
+            # Un usuario real escribe mientras corre: su conversación no se borra
+            with mock.patch('chatbot.management.commands.bench_chat.Command._report',
+                            side_effect=lambda *args: Conversation.objects.create(title="Usuario real")):
+                call_command('bench_chat', baseline=baseline, tolerance=100, stdout=io.StringIO(), **options)
+        self.assertEqual(list(Conversation.objects.values_list('title', flat=True)), ["Usuario real"] * 2)
+
+    def test_regressions_flag_slower_or_heavier_runs(self):
+        baseline = {'sync': {'throughput': 100, 'p50_ms': 10, 'p95_ms': 20, 'p99_ms': 30,
+                             'queries_per_request': 4, 'rss_mb': 80, 'errors': 0}}
+        current = {'sync': {**baseline['sync'], 'throughput': 70, 'queries_per_request': 6}}
+        self.assertEqual(regressions(current, baseline, 0.2), [
+            "sync queries_per_request: 4 -> 6", "sync throughput: 100 -> 70"
+        ])
+        self.assertEqual(regressions(baseline, baseline, 0.2), [])
+
+    def test_runs_without_memory_measurements(self):
+        # Windows: ni /proc ni el módulo resource
+        with mock.patch('chatbot.benchmark.resource', None), \
+                mock.patch('builtins.open', side_effect=OSError):
+            self.assertIsNone(rss_bytes())
+        summary = summarize(1.0, [(0.01, 200)], 2, None)
+        self.assertIsNone(summary['rss_mb'])
+        baseline = {'sync': {**summary, 'rss_mb': 80}}
+        self.assertEqual(regressions({'sync': summary}, baseline, 0.2), [])
+
+
+class ProductionSettingsTests(TestCase):
+    def test_profile_tunes_base_settings_without_mutating_them(self):
+        from chatbot_project import settings as base, settings_production as production
+
+        # Django completa base.DATABASES con sus valores por defecto al abrir la
+        # conexión; lo que se comprueba es que reimportar el perfil no lo toque
+        before = copy.deepcopy((base.DATABASES, base.MIDDLEWARE, base.TEMPLATES))
+        production = importlib.reload(production)
+        self.assertEqual((base.DATABASES, base.MIDDLEWARE, base.TEMPLATES), before)
+
+        self.assertFalse(production.DEBUG)
+        self.assertEqual(production.DATABASES['default']['CONN_MAX_AGE'], 600)
+        self.assertTrue(production.DATABASES['default']['CONN_HEALTH_CHECKS'])
+        self.assertEqual(production.MIDDLEWARE[2], 'chatbot.middleware.AsyncWhiteNoiseMiddleware')
+        self.assertNotIn('django.contrib.messages.middleware.MessageMiddleware', production.MIDDLEWARE)
+        self.assertEqual(production.TEMPLATES[0]['OPTIONS']['loaders'][0][0], 'django.template.loaders.cached.Loader')
+        self.assertTrue(base.TEMPLATES[0]['APP_DIRS'])
+
+
+# TransactionTestCase: WorkerPool reclama los trabajos desde sus propios hilos
+class JobQueueTests(TransactionTestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(jobs.HANDLERS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.batches = []
+
+    def test_runs_jobs_of_a_kind_in_batches(self):
+        jobs.handler('collect', batch_size=3)(self.batches.append)
+        for number in range(7):
+            jobs.enqueue('collect', {'n': number})
+        processed = jobs.WorkerPool(1, poll_interval=0.01).run(once=True)
+        self.assertEqual(processed, 7)
+        self.assertEqual([[payload['n'] for payload in batch] for batch in self.batches],
+                         [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertFalse(Job.objects.exists())
+
+    @override_settings(CHATBOT_JOB_RETRY_DELAY=0, CHATBOT_JOB_MAX_ATTEMPTS=2)
+    def test_failing_job_is_retried_then_dead_lettered_without_sinking_its_batch(self):
+        def process(payloads):
+            if any(payload.get('broken') for payload in payloads):
+                raise ValueError("payload roto")
+            self.batches.append(payloads)
+
+        jobs.handler('fragile', batch_size=10)(process)
+        jobs.enqueue('fragile', {'broken': True})
+        jobs.enqueue('fragile', {'n': 1})
+        self.assertEqual(jobs.run_pending('fragile'), 1)
+        self.assertEqual(self.batches, [[{'n': 1}]])
+        dead = Job.objects.get()
+        self.assertEqual((dead.status, dead.attempts), (Job.DEAD, 2))
+        self.assertIn("ValueError: payload roto", dead.last_error)
+        self.assertEqual(jobs.stats(), {'fragile:dead': 1})
+
+    @override_settings(CHATBOT_JOB_VISIBILITY_TIMEOUT=0)
+    def test_requeues_jobs_abandoned_by_a_dead_worker(self):
+        jobs.handler('collect')(self.batches.append)
+        jobs.enqueue('collect', {'n': 1})
+        jobs.claim('worker-que-murio')
+        self.assertEqual(jobs.run_pending('collect'), 0)
+        self.assertEqual(jobs.requeue_stale(), 1)
+        self.assertEqual(jobs.run_pending('collect'), 1)
+
+    @override_settings(CHATBOT_JOB_VISIBILITY_TIMEOUT=0, CHATBOT_JOB_MAX_ATTEMPTS=5)
+    def test_abandoned_jobs_respect_their_handler_max_attempts(self):
+        jobs.handler('once', max_attempts=1)(self.batches.append)
+        jobs.handler('collect')(self.batches.append)
+        jobs.enqueue('once', {'n': 1})
+        jobs.enqueue('collect', {'n': 2})
+        jobs.claim('worker-que-murio', ['once'])
+        jobs.claim('worker-que-murio', ['collect'])
+        self.assertEqual(jobs.requeue_stale(), 2)
+        self.assertEqual(dict(Job.objects.values_list('kind', 'status')), {'once': Job.DEAD, 'collect': Job.QUEUED})
+
+    @override_settings(CHATBOT_LLM_TITLES=True)
+    def test_generates_title_with_the_llm(self):
+        server = FakeLLMServer(reply="«Receta de paella.»").start()
+        self.addCleanup(server.stop)
+        provider = Provider('fake', server.url, kind='llamacpp', governor=Governor(max_retries=0))
+        with mock.patch('chatbot.providers._router', Router([provider])):
+            response = self.client.post('/', {'message': '¿Cómo hago una paella valenciana para seis personas?'},
+                                        content_type='application/json')
+            conversation = Conversation.objects.get(pk=response.json()['conversation_id'])
+            self.assertEqual(conversation.title, fallback_title('¿Cómo hago una paella valenciana para seis personas?'))
+            jobs.load_handlers()
+            self.assertEqual(jobs.run_pending('generate_title'), 1)
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.title, "Receta de paella")
+
+    @override_settings(CHATBOT_PERSIST_WITH_JOBS=True, CHATBOT_WRITE_BEHIND=False)
+    def test_persists_messages_through_the_queue_and_flushes_before_reading(self):
+        jobs.load_handlers()
+        conversation = Conversation.objects.create(title='Cola')
+        persistence.save_message(conversation.id, 'user', 'Hola')
+        persistence.save_message(conversation.id, 'assistant', '¡Hola!')
+        self.assertFalse(ChatMessage.objects.exists())
+        persistence.flush_conversation(conversation.id)
+        self.assertEqual(list(ChatMessage.objects.values_list('content', flat=True).order_by('id')),
+                         ['Hola', '¡Hola!'])
+        self.assertFalse(Job.objects.exists())
+
+
+# TransactionTestCase: el buffer escribe en su propia transacción por lote
+class WriteBehindTests(TransactionTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # El hilo del buffer no llega a vaciarlo durante la prueba: se vacía a mano
+        self.buffer = WriteBehindBuffer(self.directory, batch_size=1000, flush_interval=60)
+        self.conversation = Conversation.objects.create(title='Diferida')
+
+    def journals(self):
+        return [name for name in os.listdir(self.directory) if name.startswith('journal-')]
+
+    def test_sets_aside_records_that_can_never_be_saved(self):
+        deleted = Conversation.objects.create(title='Borrada')
+        self.buffer.add(self.conversation.id, 'user', 'Hola')
+        self.buffer.add(deleted.id, 'user', 'Perdido')
+        self.buffer.add(self.conversation.id, 'assistant', None, token_count=0)  # NOT NULL
+        self.buffer.add(self.conversation.id, 'assistant', '¡Hola!')
+        deleted.delete()
+        with self.assertLogs('chatbot.persistence', 'ERROR'):
+            self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(list(ChatMessage.objects.values_list('content', flat=True).order_by('id')),
+                         ['Hola', '¡Hola!'])
+        with open(os.path.join(self.directory, 'deadletter.jsonl')) as dead_letter:
+            self.assertEqual([json.loads(line)['content'] for line in dead_letter], [None])
+        self.assertEqual(self.buffer.stats()['pending'], 0)
+        # Los mensajes siguientes ya no quedan atascados detrás del malo
+        self.buffer.add(self.conversation.id, 'user', 'Otra')
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(len(self.journals()), 1)  # solo el segmento abierto
+
+    def test_retries_transient_failures_without_duplicating(self):
+        self.buffer.add(self.conversation.id, 'user', 'Uno')
+        self.buffer.add(self.conversation.id, 'user', 'Dos')
+        real_insert = persistence._bulk_insert
+
+        def insert_then_fail(records):
+            real_insert(records[:1])
+            raise OperationalError("conexión perdida")
+        with mock.patch('chatbot.persistence._bulk_insert', side_effect=insert_then_fail):
+            with self.assertRaises(OperationalError):
+                self.buffer.flush()
+        self.assertEqual(self.buffer.stats()['pending'], 2)
+        self.assertEqual(len(self.journals()), 2)
+        self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(list(ChatMessage.objects.values_list('content', flat=True).order_by('id')), ['Uno', 'Dos'])
+
+    def test_replays_journals_of_a_dead_process_once(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        saved = persistence._record(self.conversation.id, 'user', 'Ya guardado')
+        persistence._bulk_insert([saved])
+        records = [saved, persistence._record(self.conversation.id, 'assistant', 'Pendiente')]
+        with open(os.path.join(self.directory, f'journal-{process.pid}-1.jsonl'), 'wb') as journal:
+            for record in records:
+                journal.write(json.dumps(record).encode('utf-8') + b'\n')
+            journal.write(b'{"conversation_id": ')  # Línea a medias de la caída
+        self.assertEqual(persistence.replay_journals(self.directory), 1)
+        self.assertEqual(persistence.replay_journals(self.directory), 0)
+        self.assertEqual(ChatMessage.objects.count(), 2)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_reads_wait_for_the_journals_of_other_workers(self):
+        # Otro worker vivo (aquí, el proceso padre) tiene pendiente un mensaje
+        # de la conversación; lo confirma y borra su segmento al cabo de 0.2 s
+        record = persistence._record(self.conversation.id, 'user', 'De otro worker')
+        path = os.path.join(self.directory, f'journal-{os.getppid()}-1.jsonl')
+        with open(path, 'wb') as journal:
+            journal.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+
+        def other_worker_flushes():
+            time.sleep(0.2)
+            persistence._bulk_insert([record])
+            os.remove(path)
+        worker = threading.Thread(target=other_worker_flushes)
+        other = Conversation.objects.create(title='Otra')
+        with override_settings(CHATBOT_WRITE_BEHIND=True, CHATBOT_WRITE_BEHIND_DIR=self.directory,
+                               CHATBOT_WRITE_BEHIND_READ_TIMEOUT=0.05):
+            # Una conversación sin mensajes en el journal no espera
+            started = time.monotonic()
+            persistence.flush_conversation(other.id)
+            asyncio.run(persistence.aflush_conversation(other.id))
+            self.assertLess(time.monotonic() - started, 0.05)
+            with self.assertLogs('chatbot.persistence', 'WARNING'):
+                persistence.flush_conversation(self.conversation.id)
+            worker.start()
+            self.addCleanup(worker.join)
+            with override_settings(CHATBOT_WRITE_BEHIND_READ_TIMEOUT=5):
+                persistence.flush_conversation(self.conversation.id)
+        self.assertEqual(list(ChatMessage.objects.values_list('content', flat=True)), ['De otro worker'])
+
+
+class PromptBuilderTests(TestCase):
+    def turn(self, role, content):
+        return {'role': role, 'content': content, 'tokens': count_tokens(content)}
+
+    def test_counts_words_in_chunks_and_punctuation(self):
+        self.assertEqual(count_tokens(""), 0)
+        self.assertEqual(count_tokens("Hola, ¿qué tal?"), 6)
+        self.assertEqual(count_tokens("internacionalización"), 5)
+
+    def test_drops_oldest_history_first_and_keeps_summary(self):
+        builder = PromptBuilder("Sistema", token_budget=60)
+        history = [self.turn('user', f"mensaje número {i} " * 3) for i in range(6)]
+        messages, tokens = builder.build("Resumen breve", history, "¿Y ahora?")
+        self.assertEqual(messages[0], {'role': 'system', 'content': 'Sistema'})
+        self.assertIn("Resumen breve", messages[1]['content'])
+        self.assertEqual(messages[-1], {'role': 'user', 'content': '¿Y ahora?'})
+        kept = [m['content'] for m in messages[2:-1]]
+        self.assertTrue(kept)
+        self.assertEqual(kept, [turn['content'] for turn in history[-len(kept):]])
+        self.assertLessEqual(tokens, 60)
+
+    def test_truncates_a_message_that_does_not_fit_alone(self):
+        builder = PromptBuilder("Sistema", token_budget=40)
+        messages, tokens = builder.build("Resumen", [self.turn('user', "hola")], "palabra " * 100)
+        self.assertEqual([m['role'] for m in messages], ['system', 'user'])
+        self.assertLess(len(messages[-1]['content']), len("palabra " * 100))
+        self.assertLessEqual(tokens, 40)
+
+    def test_token_counts_are_stored_once_and_reused(self):
+        conversation = Conversation.objects.create(title='Tokens')
+        message = ChatMessage.objects.create(conversation=conversation, role='user', content="Hola, ¿qué tal?")
+        self.assertEqual(message.token_count, 6)
+        ChatMessage.objects.filter(pk=message.pk).update(token_count=42)
+        with mock.patch('chatbot.history.count_tokens') as recount:
+            _, history = load_context(conversation.id)
+        recount.assert_not_called()
+        self.assertEqual(history, [{'role': 'user', 'content': "Hola, ¿qué tal?", 'tokens': 42}])
+
+
+class RagTests(TestCase):
+    def setUp(self):
+        self.documents = tempfile.mkdtemp()
+        self.index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.documents)
+        self.addCleanup(shutil.rmtree, self.index_dir)
+        self.write('becas.md', "# Becas\n\nLas becas de matrícula se solicitan en la secretaría virtual "
+                               "entre el 1 y el 30 de septiembre.")
+        self.write('horarios.html', "<p>La biblioteca abre los sábados de 9:00 a 14:00.</p><script>x()</script>")
+
+    def write(self, name, text):
+        with open(os.path.join(self.documents, name), 'w') as document:
+            document.write(text)
+
+    def sources(self, query):
+        return [passage['source'] for passage in RagIndex(self.index_dir).search(query)]
+
+    def test_chunks_respect_the_token_size(self):
+        text = "\n\n".join(f"Párrafo {i} " + "palabra " * 30 for i in range(10)) + "\n\n" + "larga " * 500
+        chunks = chunk_text(text, chunk_tokens=100, overlap=20)
+        self.assertGreater(len(chunks), 5)
+        self.assertTrue(all(tokens <= 110 for _, tokens in chunks))
+
+    def test_retrieves_passages_and_updates_incrementally(self):
+        stats = index_documents(self.index_dir, [self.documents])
+        self.assertEqual((stats['added'], stats['chunks']), (2, 2))
+        self.assertEqual(self.sources("¿Cuándo se piden las becas de matrícula?")[0], 'becas.md')
+        self.assertEqual(self.sources("horario de la biblioteca el sábado")[0], 'horarios.html')
+        self.assertEqual(self.sources("receta de tortilla de patatas"), [])
+
+        os.remove(os.path.join(self.documents, 'horarios.html'))
+        self.write('becas.md', "Las becas de comedor se piden en octubre.")
+        self.write('gimnasio.txt', "El gimnasio cierra en agosto.")
+        stats = index_documents(self.index_dir, [self.documents])
+        self.assertEqual((stats['added'], stats['updated'], stats['removed']), (1, 1, 1))
+        self.assertEqual(self.sources("biblioteca sábado"), [])
+        passage = RagIndex(self.index_dir).search("becas")[0]
+        self.assertIn("comedor", passage['text'])
+        self.assertEqual(self.sources("gimnasio en agosto")[0], 'gimnasio.txt')
+
+        stats = index_documents(self.index_dir, [self.documents], compact=True)
+        self.assertEqual((stats['segments'], stats['chunks']), (1, 2))
+        self.assertEqual(self.sources("gimnasio en agosto")[0], 'gimnasio.txt')
+
+    def test_recovers_from_an_interrupted_run_and_outlives_compaction(self):
+        index_documents(self.index_dir, [self.documents])
+        segment = RagIndex(self.index_dir).segments()[0]
+        # Una ejecución que muere tras escribir su segmento, antes del manifest
+        self.write('gimnasio.txt', "El gimnasio cierra en agosto.")
+        with mock.patch('chatbot.rag._write_json', side_effect=OSError("disco lleno")):
+            with self.assertRaises(OSError):
+                index_documents(self.index_dir, [self.documents])
+        stats = index_documents(self.index_dir, [self.documents], compact=True)
+        self.assertEqual((stats['added'], stats['segments']), (1, 1))
+        self.assertEqual(self.sources("gimnasio en agosto")[0], 'gimnasio.txt')
+        # La compactación borró el segmento que aún usaba una búsqueda anterior
+        self.assertFalse(os.path.exists(segment.path))
+        self.assertEqual(segment.chunk(0)['source'], 'becas.md')
+
+        with override_settings(CHATBOT_RAG_DIR=self.index_dir), \
+                mock.patch.object(RagIndex, 'search', side_effect=FileNotFoundError("chunks.jsonl")), \
+                self.assertLogs('chatbot.rag', 'ERROR'):
+            self.assertEqual(retrieve("gimnasio"), [])
+
+    @mock.patch('chatbot.views.llm.is_configured', return_value=True)
+    @mock.patch('chatbot.views.llm.complete_payload', return_value="Del 1 al 30 de septiembre.")
+    def test_chat_prompt_includes_retrieved_passages(self, complete_payload, is_configured):
+        index_documents(self.index_dir, [self.documents])
+        with override_settings(CHATBOT_RAG_DIR=self.index_dir):
+            response = self.client.post('/', {'message': '¿Cuándo se solicitan las becas de matrícula?'},
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        messages = complete_payload.call_args.args[0]['messages']
+        self.assertEqual(messages[1]['role'], 'system')
+        self.assertIn("[becas.md]", messages[1]['content'])
+        self.assertNotIn("biblioteca", messages[1]['content'])
+        self.assertEqual(messages[-1]['content'], '¿Cuándo se solicitan las becas de matrícula?')
+
+
+# TransactionTestCase: los turnos del WebSocket son tareas del event loop y
+# sus consultas salen por sync_to_async, como bajo uvicorn
+@override_settings(CHATBOT_CACHE_ENABLED=False)
+class WebSocketTests(TransactionTestCase):
+    def start_llm(self, **options):
+        self.server = FakeLLMServer(**options).start()
+        self.addCleanup(self.server.stop)
+        provider = Provider('fake', self.server.url, kind='llamacpp', governor=Governor(max_retries=0))
+        patcher = mock.patch('chatbot.providers._router', Router([provider]))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def connect(self, origin=b'http://testserver', cookie=None):
+        # Conduce la aplicación ASGI con dos colas, como haría uvicorn
+        self.incoming, self.outgoing = asyncio.Queue(), asyncio.Queue()
+        headers = [(b'origin', origin)] + ([(b'cookie', cookie)] if cookie else [])
+        scope = {'type': 'websocket', 'path': '/ws/chat/', 'client': ('127.0.0.1', 50000), 'headers': headers}
+        self.app = asyncio.create_task(websocket_application(scope, self.incoming.get, self.outgoing.put))
+        await self.incoming.put({'type': 'websocket.connect'})
+        return await self.outgoing.get()
+
+    async def send_frame(self, frame):
+        await self.incoming.put({'type': 'websocket.receive', 'text': json.dumps(frame)})
+
+    async def next_frame(self, timeout=5):
+        event = await asyncio.wait_for(self.outgoing.get(), timeout)
+        return json.loads(event['text'])
+
+    async def disconnect(self):
+        await self.incoming.put({'type': 'websocket.disconnect', 'code': 1000})
+        await asyncio.wait_for(self.app, 5)
+
+    async def test_one_connection_streams_several_conversations(self):
+        self.start_llm()
+        turns_before = metrics.REQUEST_SECONDS.count('chat_ws', 'WS', 200)
+        self.assertEqual((await self.connect())['type'], 'websocket.accept')
+        await self.send_frame({'type': 'message', 'id': 'a', 'message': '¿Qué tiempo hace en Madrid?'})
+        await self.send_frame({'type': 'message', 'id': 'b', 'message': 'Explícame las listas de Python'})
+        await self.send_frame({'type': 'ping'})
+        texts, conversations, pongs = {'a': '', 'b': ''}, {}, 0
+        while len(conversations) < 2:
+            frame = await self.next_frame()
+            if frame['type'] == 'pong':
+                pongs += 1
+            elif frame['type'] == 'delta':
+                texts[frame['id']] += frame['content']
+            elif frame['type'] == 'done':
+                conversations[frame['id']] = frame['conversation_id']
+            else:
+                self.assertIn(frame['type'], ('typing', 'start'), frame)
+        await self.disconnect()
+
+        self.assertEqual(pongs, 1)
+        self.assertEqual(texts, {'a': self.server.reply, 'b': self.server.reply})
+        self.assertNotEqual(conversations['a'], conversations['b'])
+        for conversation_id in conversations.values():
+            self.assertEqual(await ChatMessage.objects.filter(conversation_id=conversation_id).acount(), 2)
+        self.assertEqual(metrics.REQUEST_SECONDS.count('chat_ws', 'WS', 200), turns_before + 2)
+
+    async def test_remembers_new_conversations_in_the_browser_session(self):
+        self.start_llm()
+        session = SessionStore()
+        await sync_to_async(session.create)()
+        cookie = f'{settings.SESSION_COOKIE_NAME}={session.session_key}'.encode()
+        self.assertEqual((await self.connect(cookie=cookie))['type'], 'websocket.accept')
+        await self.send_frame({'type': 'message', 'id': 'a', 'message': 'Hola'})
+        while (frame := await self.next_frame())['type'] != 'done':
+            pass
+        await self.disconnect()
+        stored = await sync_to_async(lambda: SessionStore(session.session_key)[SESSION_KEY])()
+        self.assertEqual(stored, [frame['conversation_id']])
+
+    async def test_cancel_aborts_the_upstream_request_and_keeps_partial_answer(self):
+        self.start_llm(tokens_per_second=20, reply=' '.join(['palabra'] * 200))
+        await self.connect()
+        await self.send_frame({'type': 'message', 'id': '1', 'message': 'Cuéntame algo largo'})
+        frame = await self.next_frame()
+        while frame['type'] != 'delta':
+            frame = await self.next_frame()
+        started = time.perf_counter()
+        await self.send_frame({'type': 'cancel', 'id': '1'})
+        while frame['type'] != 'cancelled':
+            frame = await self.next_frame()
+        self.assertLess(time.perf_counter() - started, 1)
+
+        # El servidor falso nota el corte en su siguiente escritura
+        deadline = time.monotonic() + 3
+        while self.server.in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self.assertEqual(self.server.in_flight, 0)
+        self.assertEqual(self.server.disconnects, 1)
+        answer = await ChatMessage.objects.aget(role='assistant')
+        self.assertTrue(answer.content.startswith('palabra'))
+        self.assertLess(len(answer.content), len(self.server.reply))
+        await self.disconnect()
+
+    @override_settings(ALLOWED_HOSTS=['testserver'])
+    async def test_rejects_foreign_origin(self):
+        event = await self.connect(origin=b'https://evil.example')
+        self.assertEqual(event, {'type': 'websocket.close', 'code': 1008})
+        await asyncio.wait_for(self.app, 5)
+
+
+def _join_in_other_worker(directory, key, results):
+    flight, leader = SingleFlight(directory=directory, wait_timeout=10).join(key)
+    if leader:
+        flight.resolve('otro worker')
+    results.put((leader, flight.wait(10)))
+
+
+class CompletionCacheTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.payloads = [llm.build_payload([{"role": "user", "content": f"Pregunta {i}"}]) for i in range(3)]
+
+    def test_evicts_least_recently_used(self):
+        cache = CompletionCache(max_entries=2)
+        cache.set(self.payloads[0], "cero")
+        cache.set(self.payloads[1], "uno")
+        cache.get(self.payloads[0])
+        cache.set(self.payloads[2], "dos")
+        self.assertEqual([cache.get(payload) for payload in self.payloads], ["cero", None, "dos"])
+
+    def test_entries_expire_after_ttl(self):
+        cache = CompletionCache(ttl=10)
+        with mock.patch('chatbot.cache.time.monotonic', return_value=100):
+            cache.set(self.payloads[0], "cero")
+        with mock.patch('chatbot.cache.time.monotonic', return_value=109):
+            self.assertEqual(cache.get(self.payloads[0]), "cero")
+        with mock.patch('chatbot.cache.time.monotonic', return_value=111):
+            self.assertIsNone(cache.get(self.payloads[0]))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    def test_shared_tier_serves_other_workers(self):
+        writer, reader = CompletionCache(backend='default'), CompletionCache(backend='default')
+        payload = {**self.payloads[0], 'stream': True}
+        writer.set(payload, "compartida")
+        # stream no cambia la respuesta: misma clave
+        self.assertEqual(reader.get(self.payloads[0]), "compartida")
+        self.assertEqual(reader.stats()['entries'], 1)
+        self.assertIsNone(reader.get({**self.payloads[1], 'temperature': 1.5}))
+        self.assertEqual(reader.stats()['bypassed'], 1)
+
+    def test_follows_setting_overrides(self):
+        with override_settings(CHATBOT_CACHE_ENABLED=False):
+            self.assertIsInstance(get_completion_cache(), NullCache)
+        with override_settings(CHATBOT_CACHE_ENABLED=True, CHATBOT_CACHE_MAX_ENTRIES=7):
+            self.assertEqual(get_completion_cache().max_entries, 7)
+
+
+class SemanticCacheTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_answers_similar_questions_above_the_threshold(self):
+        cache = SemanticCache(self.directory, threshold=0.8)
+        cache.add("¿Cuándo empieza el plazo de matrícula?", "En julio")
+        self.assertEqual(cache.lookup("cuando empieza el plazo de la matricula"), "En julio")
+        self.assertIsNone(cache.lookup("¿A qué hora abre la biblioteca?"))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'entries': 1})
+
+    def test_reranks_coarse_candidates_with_full_vectors(self):
+        cache = SemanticCache(self.directory, threshold=0.95)
+        questions = [f"asignatura{i} grupo{i * 7} aula{i * 13}" for i in range(CANDIDATES * 3)]
+        for index, question in enumerate(questions):
+            cache.add(question, f"respuesta {index}")
+        for index in (0, 50, len(questions) - 1):
+            self.assertEqual(cache.lookup(questions[index]), f"respuesta {index}")
+
+    def test_loads_entries_written_by_other_processes(self):
+        SemanticCache(self.directory).add("¿Dónde está secretaría?", "En la planta baja")
+        # Otro proceso a mitad de escribir: vector completo, línea sin terminar
+        with open(os.path.join(self.directory, 'vectors.f32'), 'ab') as vectors_file:
+            vectors_file.write(embed("¿Hay becas de comedor?").tobytes())
+        with open(os.path.join(self.directory, 'entries.jsonl'), 'ab') as entries_file:
+            entries_file.write('{"question": "¿Hay becas de comedor?", "answer": "Sí'.encode('utf-8'))
+        cache = SemanticCache(self.directory)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.lookup("donde esta secretaria"), "En la planta baja")
+        with open(os.path.join(self.directory, 'entries.jsonl'), 'ab') as entries_file:
+            entries_file.write(', cada curso"}\n'.encode('utf-8'))
+        self.assertEqual(cache.lookup("¿Hay becas de comedor?"), "Sí, cada curso")
+
+    def test_async_views_use_it_off_the_event_loop(self):
+        threads = []
+        original = SemanticCache.lookup
+
+        def lookup(cache, question):
+            threads.append(threading.get_ident())
+            return original(cache, question)
+
+        async def answer():
+            threads.append(threading.get_ident())
+            return await _acached_answer(llm.build_payload([{"role": "user", "content": "Hola"}]), "Hola", True)
+
+        with override_settings(CHATBOT_SEMANTIC_CACHE_ENABLED=True, CHATBOT_SEMANTIC_CACHE_DIR=self.directory), \
+                mock.patch.object(SemanticCache, 'lookup', lookup):
+            self.assertIsNone(asyncio.run(answer()))
+        loop_thread, lookup_thread = threads
+        self.assertNotEqual(loop_thread, lookup_thread)
+
+
+class SingleFlightTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_follows_setting_overrides(self):
+        # Las pruebas no dejan ficheros de lock en var/coalesce
+        self.assertFalse((get_singleflight().directory or '').startswith(str(settings.BASE_DIR)))
+        with override_settings(CHATBOT_COALESCE_DIR=self.directory):
+            self.assertEqual(get_singleflight().directory, self.directory)
+        with override_settings(CHATBOT_COALESCE_ACROSS_WORKERS=False):
+            self.assertIsNone(get_singleflight().directory)
+
+    def test_threads_share_one_call(self):
+        group = SingleFlight()
+        leader_flight, leader = group.join('clave')
+        self.assertTrue(leader)
+        results = []
+
+        def follower():
+            flight, is_leader = group.join('clave')
+            results.append((is_leader, flight.wait(5)))
+
+        threads = [threading.Thread(target=follower) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        leader_flight.resolve('respuesta')
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [(False, 'respuesta')] * 5)
+        self.assertEqual(group.stats(), {'coalesced': 5, 'in_flight': 0})
+
+    def test_workers_share_one_call_through_the_lock_file(self):
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        flight, leader = SingleFlight(directory=self.directory).join('clave')
+        self.assertTrue(leader)
+        worker = context.Process(target=_join_in_other_worker, args=(self.directory, 'clave', results))
+        worker.start()
+        time.sleep(0.3)
+        flight.resolve('respuesta')
+        worker.join(10)
+        self.assertEqual(results.get(timeout=1), (False, 'respuesta'))
+
+    def test_sweep_keeps_lock_files_in_use(self):
+        group = SingleFlight(directory=self.directory)
+        flight, leader = group.join('ocupada')
+        self.assertTrue(leader)
+        open(os.path.join(self.directory, 'libre.lock'), 'w').close()
+        open(os.path.join(self.directory, 'vieja.json'), 'w').close()
+        old = time.time() - RESULT_MAX_AGE - 10
+        for name in ('ocupada.lock', 'libre.lock', 'vieja.json'):
+            os.utime(os.path.join(self.directory, name), (old, old))
+
+        SingleFlight(directory=self.directory)._sweep()
+        self.assertEqual(sorted(os.listdir(self.directory)), ['ocupada.lock'])
+
+        # El lock sigue agrupando: otra petición espera al líder en vez de llamar
+        other = SingleFlight(directory=self.directory, wait_timeout=5)
+        results = []
+        thread = threading.Thread(target=lambda: results.append(other.join('ocupada')[1]))
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(results, [])
+        flight.resolve('respuesta')
+        thread.join()
+        self.assertEqual(results, [False])
+
+
+class FastJsonTests(TestCase):
+    def test_backends_serialize_like_json_response(self):
+        data = {'response': 'Año académico, ñandú', 'when': datetime(2024, 5, 1, 12, 30, 0, 123456, tzinfo=dt_timezone.utc)}
+        expected = {'response': 'Año académico, ñandú', 'when': '2024-05-01T12:30:00.123Z'}
+        for name in fastjson.BACKENDS:
+            with self.subTest(backend=name), override_settings(CHATBOT_JSON_BACKEND=name):
+                encoded = fastjson.dumps(data)
+                self.assertIn('ñandú'.encode('utf-8'), encoded)
+                self.assertEqual(fastjson.loads(encoded), expected)
+
+    @override_settings(CHATBOT_MAX_REQUEST_BYTES=1024)
+    def test_rejects_oversized_messages_before_parsing(self):
+        body = json.dumps({'message': 'información ' * 200})
+        with mock.patch('chatbot.views.fastjson.loads') as loads:
+            response = self.client.post('/', body, content_type='application/json')
+        self.assertEqual(response.status_code, 413)
+        loads.assert_not_called()
+        self.assertEqual(Conversation.objects.count(), 0)
 
-# Create your tests here.
@@ -0,0 +1,210 @@
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import JsonResponse, parse_cookie
+
+from .governor import TokenBucket
+
+
+def client_ip(request):
+    # Detrás de nginx, REMOTE_ADDR es el proxy: la última entrada de
+    # X-Forwarded-For es la que añadió nuestro proxy, la única de confianza
+    if settings.CHATBOT_THROTTLE_TRUST_FORWARDED:
+        forwarded = request.META.get('HTTP_X_FORWARDED_FOR', '')
+        if forwarded:
+            return forwarded.split(',')[-1].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def request_identities(request):
+    # {ámbito: identificador}; la sesión solo cuenta si el navegador ya tiene una
+    identities = {'ip': client_ip(request)}
+    session = getattr(request, 'session', None)
+    session_key = session.session_key if session is not None else None
+    if session_key:
+        identities['session'] = session_key
+    return identities
+
+
+def scope_identities(scope):
+    # Lo mismo para una conexión ASGI sin HttpRequest (el canal WebSocket)
+    headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope.get('headers', ())}
+    identities = {'ip': (scope.get('client') or ('',))[0]}
+    if settings.CHATBOT_THROTTLE_TRUST_FORWARDED and headers.get('x-forwarded-for'):
+        identities['ip'] = headers['x-forwarded-for'].split(',')[-1].strip()
+    session_key = parse_cookie(headers.get('cookie', '')).get(settings.SESSION_COOKIE_NAME)
+    if session_key:
+        identities['session'] = session_key
+    return identities
+
+
+# Limitador de peticiones por IP y por sesión. El camino rápido es un token
+# bucket en memoria por identificador (sin E/S); si hay una caché compartida,
+# además se aplica una ventana deslizante aproximada entre todos los workers.
+class Throttle:
+    def __init__(self, rules, cache_alias=None, window=60, max_keys=10000):
+        # rules: {ámbito: (peticiones por ventana, ráfaga)}
+        self.rules = rules
+        self.window = window
+        self.max_keys = max_keys
+        self.cache = caches[cache_alias] if cache_alias else None
+        self.allowed = 0
+        self.rejected = {scope: 0 for scope in rules}
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bucket(self, scope, ident):
+        key = (scope, ident)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                limit, burst = self.rules[scope]
+                bucket = self._buckets[key] = TokenBucket(limit / self.window, burst)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket
+
+    def _reject(self, scope, retry_after):
+        with self._lock:
+            self.rejected[scope] += 1
+        return retry_after
+
+    def _local_check(self, identities):
+        for scope, ident in identities.items():
+            if scope not in self.rules:
+                continue
+            granted, wait = self._bucket(scope, ident).reserve(max_wait=0)
+            if not granted:
+                return self._reject(scope, wait)
+        return None
+
+    def _window_keys(self, scope, ident, now):
+        index = int(now // self.window)
+        return f"chatbot:throttle:{scope}:{ident}:{index - 1}", f"chatbot:throttle:{scope}:{ident}:{index}"
+
+    def _window_estimate(self, previous, current, now):
+        # Ventana deslizante aproximada: la anterior pesa lo que le queda de solape
+        elapsed = now % self.window
+        return previous * (1 - elapsed / self.window) + current, elapsed
+
+    def _shared_retry_after(self, scope, previous, current, now):
+        limit = self.rules[scope][0]
+        estimate, elapsed = self._window_estimate(previous, current, now)
+        if estimate < limit:
+            return None
+        # Cuánto falta para que el peso de la ventana anterior deje sitio
+        if previous and current < limit:
+            return (estimate - limit + 1) * self.window / previous
+        return self.window - elapsed
+
+    def check(self, identities):
+        # None si se permite; si no, segundos hasta poder reintentar
+        retry_after = self._local_check(identities)
+        if retry_after is None and self.cache is not None:
+            now = time.time()
+            for scope, ident in identities.items():
+                if scope not in self.rules:
+                    continue
+                previous_key, current_key = self._window_keys(scope, ident, now)
+                counts = self.cache.get_many([previous_key, current_key])
+                retry_after = self._shared_retry_after(
+                    scope, counts.get(previous_key, 0), counts.get(current_key, 0), now
+                )
+                if retry_after is not None:
+                    retry_after = self._reject(scope, retry_after)
+                    break
+                self.cache.add(current_key, 0, timeout=2 * self.window)
+                self.cache.incr(current_key)
+        if retry_after is None:
+            with self._lock:
+                self.allowed += 1
+        return retry_after
+
+    async def acheck(self, identities):
+        retry_after = self._local_check(identities)
+        if retry_after is None and self.cache is not None:
+            now = time.time()
+            for scope, ident in identities.items():
+                if scope not in self.rules:
+                    continue
+                previous_key, current_key = self._window_keys(scope, ident, now)
+                counts = await self.cache.aget_many([previous_key, current_key])
+                retry_after = self._shared_retry_after(
+                    scope, counts.get(previous_key, 0), counts.get(current_key, 0), now
+                )
+                if retry_after is not None:
+                    retry_after = self._reject(scope, retry_after)
+                    break
+                await self.cache.aadd(current_key, 0, timeout=2 * self.window)
+                await self.cache.aincr(current_key)
+        if retry_after is None:
+            with self._lock:
+                self.allowed += 1
+        return retry_after
+
+    def stats(self):
+        with self._lock:
+            return {'allowed': self.allowed, 'rejected': dict(self.rejected), 'tracked_keys': len(self._buckets)}
+
+
+_throttle = None
+_throttle_lock = threading.Lock()
+
+
+def get_throttle():
+    global _throttle
+    if _throttle is None:
+        with _throttle_lock:
+            if _throttle is None:
+                _throttle = Throttle(
+                    {
+                        'ip': (settings.CHATBOT_THROTTLE_IP_RATE, settings.CHATBOT_THROTTLE_IP_BURST),
+                        'session': (settings.CHATBOT_THROTTLE_SESSION_RATE, settings.CHATBOT_THROTTLE_SESSION_BURST),
+                    },
+                    cache_alias=settings.CHATBOT_THROTTLE_CACHE or None,
+                )
+    return _throttle
+
+
+@receiver(setting_changed)
+def _reset_throttle(setting, **kwargs):
+    global _throttle
+    if setting.startswith('CHATBOT_THROTTLE_'):
+        _throttle = None
+
+
+def _too_many_requests(retry_after):
+    response = JsonResponse({'error': 'Demasiados mensajes seguidos, espera un momento'}, status=429)
+    response['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def throttle(view):
+    # Limita los POST (mensajes nuevos) de la vista; el GET que sirve la página no cuenta
+    if asyncio.iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method == 'POST' and settings.CHATBOT_THROTTLE_ENABLED:
+                retry_after = await get_throttle().acheck(request_identities(request))
+                if retry_after is not None:
+                    return _too_many_requests(retry_after)
+            return await view(request, *args, **kwargs)
+    else:
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method == 'POST' and settings.CHATBOT_THROTTLE_ENABLED:
+                retry_after = get_throttle().check(request_identities(request))
+                if retry_after is not None:
+                    return _too_many_requests(retry_after)
+            return view(request, *args, **kwargs)
+    return wrapper
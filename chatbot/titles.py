@@ -0,0 +1,49 @@
+from django.conf import settings
+
+from . import jobs, llm
+from .models import Conversation
+
+TITLE_INSTRUCTIONS = (
+    "Escribe un título breve (máximo seis palabras) para una conversación que "
+    "empieza con el mensaje del usuario. Responde solo con el título, sin "
+    "comillas ni punto final, en el idioma del mensaje."
+)
+TITLE_MAX_LENGTH = 80
+
+
+def fallback_title(message):
+    # Título provisional hasta que el worker genere el definitivo
+    return message[:50] + ('...' if len(message) > 50 else '')
+
+
+def _clean(title):
+    title = title.strip().splitlines()[0] if title.strip() else ''
+    return title.strip(' "\'«».')[:TITLE_MAX_LENGTH]
+
+
+@jobs.handler('generate_title', batch_size=10)
+def generate_titles(payloads):
+    # Un LLM por conversación; solo se sustituye el título provisional, así
+    # que repetir el trabajo (o que el usuario ya lo haya cambiado) es inocuo
+    for payload in payloads:
+        message = payload['message']
+        title = _clean(llm.complete(
+            [{"role": "system", "content": TITLE_INSTRUCTIONS}, {"role": "user", "content": message[:2000]}],
+            temperature=0.3,
+            max_tokens=30
+        ))
+        if title:
+            # update() no toca last_updated: la conversación no sube en la lista
+            Conversation.objects.filter(
+                pk=payload['conversation_id'], title=fallback_title(message)
+            ).update(title=title)
+
+
+def schedule_title(conversation_id, message):
+    if settings.CHATBOT_LLM_TITLES and message:
+        jobs.enqueue('generate_title', {'conversation_id': conversation_id, 'message': message})
+
+
+async def aschedule_title(conversation_id, message):
+    if settings.CHATBOT_LLM_TITLES and message:
+        await jobs.aenqueue('generate_title', {'conversation_id': conversation_id, 'message': message})
@@ -0,0 +1,261 @@
+import csv
+import gzip
+import io
+import json
+import os
+from datetime import datetime
+
+from django.db import connection, transaction
+
+from .models import ChatMessage, Conversation
+from .prompt import count_tokens
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet es opcional: sin pyarrow solo hay JSONL
+    pa = pq = None
+
+CONVERSATION_FIELDS = ('id', 'title', 'created_at', 'last_updated', 'retention_days')
+MESSAGE_FIELDS = ('id', 'conversation_id', 'role', 'content', 'timestamp')
+
+
+# Exportación e importación de conversaciones en memoria constante. El fichero
+# es una secuencia de lotes: hasta batch_size conversaciones (en orden de id)
+# seguidas de todos sus mensajes. Cada lote es la unidad de checkpoint.
+
+def _as_datetime(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _as_text(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def load_checkpoint(path):
+    try:
+        with open(path, encoding='utf-8') as checkpoint:
+            return json.load(checkpoint)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(path, state):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as checkpoint:
+        json.dump(state, checkpoint)
+        checkpoint.flush()
+        os.fsync(checkpoint.fileno())
+    os.replace(tmp_path, path)
+
+
+def conversation_batches(batch_size, start_id=0, end_id=None, since=None, until=None):
+    # Keyset por id: cada consulta trae como mucho batch_size conversaciones
+    queryset = Conversation.objects.order_by('id').values(*CONVERSATION_FIELDS)
+    if end_id is not None:
+        queryset = queryset.filter(id__lte=end_id)
+    if since is not None:
+        queryset = queryset.filter(created_at__gte=since)
+    if until is not None:
+        queryset = queryset.filter(created_at__lt=until)
+    last_id = start_id
+    while True:
+        batch = list(queryset.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1]['id']
+
+
+def batch_messages(conversation_ids, chunk_size):
+    # Cursor de servidor en PostgreSQL; recorre el índice (conversation_id, timestamp)
+    return (
+        ChatMessage.objects
+        .filter(conversation_id__in=conversation_ids)
+        .order_by('conversation_id', 'timestamp')
+        .values(*MESSAGE_FIELDS)
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+class JsonlWriter:
+    # Cada lote se escribe como un miembro gzip independiente: el fichero se
+    # puede truncar al último checkpoint y seguir añadiendo
+    def __init__(self, path, offset=0):
+        self.path = path
+        if os.path.exists(path):
+            with open(path, 'r+b') as output:
+                output.truncate(offset)
+
+    def write_batch(self, conversations, messages):
+        count = 0
+        with open(self.path, 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as output:
+                for conversation in conversations:
+                    output.write(self._line('conversation', conversation))
+                for message in messages:
+                    output.write(self._line('message', message))
+                    count += 1
+            raw.flush()
+            os.fsync(raw.fileno())
+            offset = raw.tell()
+        return count, offset
+
+    @staticmethod
+    def _line(kind, row):
+        record = {'type': kind, **{key: _as_text(value) for key, value in row.items()}}
+        return json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n'
+
+
+class ParquetWriter:
+    # Un directorio con un par de ficheros por lote (conversations-N y
+    # messages-N); los mensajes se escriben en row groups de chunk_size
+    def __init__(self, path, chunk_size=5000):
+        if pa is None:
+            raise ImportError("La exportación a Parquet necesita pyarrow")
+        self.path = path
+        self.chunk_size = chunk_size
+        self.conversation_schema = pa.schema([
+            ('id', pa.int64()), ('title', pa.string()),
+            ('created_at', pa.timestamp('us', tz='UTC')), ('last_updated', pa.timestamp('us', tz='UTC')),
+            ('retention_days', pa.int64()),
+        ])
+        self.message_schema = pa.schema([
+            ('id', pa.int64()), ('conversation_id', pa.int64()), ('role', pa.string()),
+            ('content', pa.string()), ('timestamp', pa.timestamp('us', tz='UTC')),
+        ])
+        os.makedirs(path, exist_ok=True)
+
+    def write_batch(self, conversations, messages):
+        suffix = f"{conversations[-1]['id']:012d}.parquet"
+        self._write(f"conversations-{suffix}", self.conversation_schema, [conversations])
+        count = self._write(f"messages-{suffix}", self.message_schema, _chunks(messages, self.chunk_size))
+        return count, 0
+
+    def _write(self, name, schema, chunks):
+        path = os.path.join(self.path, name)
+        tmp_path = f"{path}.tmp"
+        count = 0
+        with pq.ParquetWriter(tmp_path, schema, compression='zstd') as writer:
+            for rows in chunks:
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                count += len(rows)
+        os.replace(tmp_path, path)
+        return count
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_jsonl(path):
+    # gzip.open lee seguidos todos los miembros del fichero
+    with gzip.open(path, 'rt', encoding='utf-8') as source:
+        for line in source:
+            yield json.loads(line)
+
+
+def iter_parquet(path):
+    if pq is None:
+        raise ImportError("La importación de Parquet necesita pyarrow")
+    for name in sorted(os.listdir(path)):
+        if not (name.startswith('conversations-') and name.endswith('.parquet')):
+            continue
+        for kind, part in (('conversation', name), ('message', name.replace('conversations-', 'messages-', 1))):
+            for batch in pq.ParquetFile(os.path.join(path, part)).iter_batches():
+                for row in batch.to_pylist():
+                    yield {'type': kind, **row}
+
+
+class _Stream:
+    # Iterador con un elemento de adelanto y contador de registros consumidos
+    def __init__(self, records):
+        self._records = iter(records)
+        self.position = 0
+        self._next = next(self._records, None)
+
+    def peek(self):
+        return self._next
+
+    def take(self):
+        record = self._next
+        self._next = next(self._records, None)
+        self.position += 1
+        return record
+
+
+def _insert_conversations(records):
+    conversations = [
+        Conversation(title=r['title'], retention_days=r.get('retention_days')) for r in records
+    ]
+    Conversation.objects.bulk_create(conversations)
+    # bulk_create pisa created_at/last_updated (auto_now); se restauran los originales
+    for conversation, record in zip(conversations, records):
+        conversation.created_at = _as_datetime(record['created_at'])
+        conversation.last_updated = _as_datetime(record['last_updated'])
+    Conversation.objects.bulk_update(conversations, ['created_at', 'last_updated'])
+    return {record['id']: conversation.id for record, conversation in zip(records, conversations)}
+
+
+def _insert_messages(records, id_map):
+    rows = []
+    for record in records:
+        try:
+            rows.append((id_map[record['conversation_id']], record['role'], record['content'], record['timestamp']))
+        except KeyError:
+            raise ValueError(f"Mensaje {record.get('id')} de una conversación fuera de su lote")
+    if connection.vendor == 'postgresql':
+        # COPY evita el coste de parsear un INSERT por fila. En CSV un campo
+        # vacío sin comillas es NULL: FORCE_NOT_NULL lo lee como cadena vacía
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for conversation_id, role, content, timestamp in rows:
+            writer.writerow((conversation_id, role, content, _as_text(timestamp), count_tokens(content)))
+        buffer.seek(0)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f'COPY {ChatMessage._meta.db_table} (conversation_id, role, content, "timestamp", token_count) '
+                f"FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (role, content))",
+                buffer
+            )
+    else:
+        ChatMessage.objects.bulk_create([
+            ChatMessage(conversation_id=conversation_id, role=role, content=content, timestamp=_as_datetime(timestamp),
+                        token_count=count_tokens(content))
+            for conversation_id, role, content, timestamp in rows
+        ])
+    return len(rows)
+
+
+def import_records(records, batch_size=5000, skip=0, on_batch=None):
+    # Cada lote del fichero se importa en una transacción; on_batch(posición,
+    # conversaciones, mensajes) permite guardar el checkpoint tras confirmarlo.
+    # Los ids se reasignan: los mensajes apuntan a las conversaciones nuevas.
+    stream = _Stream(records)
+    while stream.position < skip and stream.peek() is not None:
+        stream.take()
+
+    def messages():
+        while stream.peek() is not None and stream.peek()['type'] == 'message':
+            yield stream.take()
+
+    imported_conversations = imported_messages = 0
+    while stream.peek() is not None:
+        conversations = []
+        while stream.peek() is not None and stream.peek()['type'] == 'conversation':
+            conversations.append(stream.take())
+        with transaction.atomic():
+            id_map = _insert_conversations(conversations) if conversations else {}
+            count = sum(_insert_messages(chunk, id_map) for chunk in _chunks(messages(), batch_size))
+        imported_conversations += len(conversations)
+        imported_messages += count
+        if on_batch is not None:
+            on_batch(stream.position, imported_conversations, imported_messages)
+    return imported_conversations, imported_messages
@@ -5,5 +5,11 @@ app_name = 'chatbot'
 
 urlpatterns = [
     path('', views.chat_message, name='chatbot_message'),
+    path('async/', views.achat_message, name='chatbot_message_async'),
+    path('stats/llm/', views.llm_stats, name='llm_stats'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('search/', views.search, name='search'),
+    path('conversations/', views.conversation_list, name='conversation_list'),
+    path('conversations/<int:conversation_id>/messages/', views.conversation_messages, name='conversation_messages'),
     
 ]
@@ -1,84 +1,593 @@
+from asgiref.sync import sync_to_async
 from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+import hashlib
+import asyncio
 import json
+import math
+import httpx
 import requests
-from .models import Conversation, ChatMessage
-from decouple import config  # Para obtener las variables de entorno
+from .access import operator_required, remember_conversation, visible_conversations
+from .models import ChatMessage, Conversation
+from .cache import get_completion_cache, payload_key
+from .coalesce import get_singleflight
+from .governor import RETRYABLE_STATUS
+from .history import aload_context, load_context
+from .providers import get_router
+from .rag import aretrieve, get_rag_index, retrieve
+from .pagination import InvalidCursor, decode_cursor, encode_cursor, keyset_page, page_size
+from .persistence import aflush_conversation, asave_message, flush_conversation, save_message
+from .prompt import count_tokens, get_prompt_builder
+from .search import search_messages
+from .semantic_cache import get_semantic_cache
+from .summary import schedule_compaction
+from .throttle import get_throttle, throttle
+from .titles import aschedule_title, fallback_title, schedule_title
+from .fastjson import JsonResponse
+from . import fastjson, jobs, llm, metrics
+
+
+def _sse(event, data):
+    # Formatea un evento server-sent events
+    return b"event: " + event.encode('ascii') + b"\ndata: " + fastjson.dumps(data) + b"\n\n"
+
+
+def _streaming_response(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream; charset=utf-8')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Evita el buffering de nginx
+    return response
+
+
+def _conversation_id(data):
+    # None para empezar una conversación nueva; ValueError si no es un entero
+    conversation_id = data.get('conversation_id')
+    if conversation_id in (None, ''):
+        return None
+    return int(conversation_id)
+
+
+def _request_too_large(request):
+    # Se mira Content-Length antes de leer el cuerpo; sin esa cabecera
+    # (chunked), lo leído, que Django ya corta en DATA_UPLOAD_MAX_MEMORY_SIZE
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if not length:
+        length = len(request.body)
+    return length > settings.CHATBOT_MAX_REQUEST_BYTES
+
+
+def _too_large_response():
+    return JsonResponse({'error': 'Mensaje demasiado largo'}, status=413)
+
+
+def _seek_position(request):
+    # Posición (fecha, id) del cursor de las listas; InvalidCursor si no es válido
+    cursor = request.GET.get('cursor')
+    if not cursor:
+        return None
+    moment, row_id = decode_cursor(cursor, 2)
+    moment = parse_datetime(moment) if isinstance(moment, str) else None
+    if moment is None or not isinstance(row_id, int):
+        raise InvalidCursor("Cursor no válido")
+    return [moment, row_id]
+
+
+def _search_position(cursor):
+    # Posición (rank, id) del cursor de la búsqueda; InvalidCursor si no es válido
+    rank, row_id = decode_cursor(cursor, 2)
+    if (isinstance(rank, bool) or not isinstance(rank, (int, float)) or not math.isfinite(rank)
+            or isinstance(row_id, bool) or not isinstance(row_id, int)):
+        raise InvalidCursor("Cursor no válido")
+    return [rank, row_id]
+
+
+def _conditional_json(request, payload):
+    # ETag fuerte sobre el cuerpo: si el cliente ya tiene esta página, 304 sin cuerpo
+    response = JsonResponse(payload)
+    response['ETag'] = f'"{hashlib.sha256(response.content).hexdigest()[:32]}"'
+    response['Cache-Control'] = 'private, no-cache'
+    return get_conditional_response(request, etag=response['ETag'], response=response)
+
+
+def _upstream_error_response(error):
+    # Si DeepSeek está saturado o caído, 503 con Retry-After para que el cliente
+    # espere en lugar de reintentar enseguida; cualquier otro fallo sigue siendo 500
+    if error.retry_after is None and error.status_code not in RETRYABLE_STATUS:
+        return JsonResponse({'error': 'Error en la API de Deepseek'}, status=500)
+    response = JsonResponse({'error': 'Deepseek no está disponible ahora, inténtalo en unos segundos'}, status=503)
+    response['Retry-After'] = str(max(1, math.ceil(error.retry_after or 1)))
+    return response
+
+
+def _cached_answer(payload, message, new_conversation):
+    # Primero la caché exacta y, en conversaciones nuevas (sin contexto
+    # previo que cambie el sentido), la caché semántica de preguntas parecidas
+    assistant_message = get_completion_cache().get(payload)
+    semantic_cache = get_semantic_cache()
+    if assistant_message is None and new_conversation and semantic_cache is not None:
+        assistant_message = semantic_cache.lookup(message)
+    return assistant_message
+
+
+async def _acached_answer(payload, message, new_conversation):
+    assistant_message = await get_completion_cache().aget(payload)
+    semantic_cache = get_semantic_cache()
+    if assistant_message is None and new_conversation and semantic_cache is not None:
+        # Cálculo NumPy y lectura de ficheros: fuera del event loop, como aretrieve
+        assistant_message = await sync_to_async(semantic_cache.lookup, thread_sensitive=False)(message)
+    return assistant_message
+
+
+def _remember_answer(payload, message, new_conversation, assistant_message):
+    get_completion_cache().set(payload, assistant_message)
+    semantic_cache = get_semantic_cache()
+    if new_conversation and semantic_cache is not None:
+        semantic_cache.add(message, assistant_message)
+
+
+async def _aremember_answer(payload, message, new_conversation, assistant_message):
+    await get_completion_cache().aset(payload, assistant_message)
+    semantic_cache = get_semantic_cache()
+    if new_conversation and semantic_cache is not None:
+        await sync_to_async(semantic_cache.add, thread_sensitive=False)(message, assistant_message)
+
+
+def _answer_or_flight(payload, message, new_conversation):
+    # Devuelve (respuesta, None) si la respuesta está en caché o la produjo otra
+    # petición idéntica en curso; si no, (None, flight) y esta petición llama al LLM
+    assistant_message = _cached_answer(payload, message, new_conversation)
+    if assistant_message is not None:
+        return assistant_message, None
+    flight, leader = get_singleflight().join(payload_key(payload))
+    if not leader:
+        return flight.wait(flight.group.wait_timeout), None
+    return None, flight
+
+
+async def _aanswer_or_flight(payload, message, new_conversation):
+    assistant_message = await _acached_answer(payload, message, new_conversation)
+    if assistant_message is not None:
+        return assistant_message, None
+    # join y wait pueden bloquear (flock entre workers, espera al líder)
+    flight, leader = await sync_to_async(get_singleflight().join, thread_sensitive=False)(payload_key(payload))
+    if not leader:
+        return await asyncio.to_thread(flight.wait, flight.group.wait_timeout), None
+    return None, flight
+
+
+def _finish_flight(flight, payload, message, new_conversation, assistant_message):
+    if assistant_message is None:
+        flight.fail(llm.UpstreamError("Error en la API de Deepseek"))
+        return
+    _remember_answer(payload, message, new_conversation, assistant_message)
+    flight.resolve(assistant_message)
+
+
+async def _afinish_flight(flight, payload, message, new_conversation, assistant_message):
+    if assistant_message is None:
+        flight.fail(llm.UpstreamError("Error en la API de Deepseek"))
+        return
+    await _aremember_answer(payload, message, new_conversation, assistant_message)
+    flight.resolve(assistant_message)
+
+
+def _cached_stream(assistant_message, conversation_id):
+    # Respuesta ya disponible: se envía de una vez con los mismos eventos del stream
+    yield _sse('start', {'conversation_id': conversation_id})
+    yield _sse('delta', {'content': assistant_message})
+    yield _sse('done', {'conversation_id': conversation_id})
+
+
+def _relay_stream(upstream, conversation_id, on_finish):
+    # Reenvía los fragmentos al navegador a medida que llegan y guarda
+    # el mensaje del asistente una sola vez, al terminar el stream.
+    # on_finish recibe el texto completo, o None si el stream falló.
+    parts = []
+    completed = False
+    try:
+        yield _sse('start', {'conversation_id': conversation_id})
+        for delta in llm.iter_deltas(upstream):
+            parts.append(delta)
+            yield _sse('delta', {'content': delta})
+        completed = True
+        yield _sse('done', {'conversation_id': conversation_id})
+    except (requests.RequestException, ValueError, KeyError, IndexError):
+        yield _sse('error', {'error': 'Error en la API de Deepseek'})
+    finally:
+        upstream.close()
+        try:
+            if parts:
+                save_message(conversation_id, 'assistant', ''.join(parts))
+        finally:
+            on_finish(''.join(parts) if completed else None)
+
+
+async def _arelay_events(upstream, conversation_id, on_finish):
+    # Versión asíncrona de _relay_stream para el cliente httpx. Produce tuplas
+    # (evento, datos) que la vista formatea como SSE y chatbot.ws como frames
+    parts = []
+    completed = False
+    try:
+        yield 'start', {'conversation_id': conversation_id}
+        async for delta in llm.aiter_deltas(upstream):
+            parts.append(delta)
+            yield 'delta', {'content': delta}
+        completed = True
+        yield 'done', {'conversation_id': conversation_id}
+    except (httpx.HTTPError, ValueError, KeyError, IndexError):
+        yield 'error', {'error': 'Error en la API de Deepseek'}
+    finally:
+        await upstream.aclose()
+        try:
+            if parts:
+                await asave_message(conversation_id, 'assistant', ''.join(parts))
+        finally:
+            await on_finish(''.join(parts) if completed else None)
+
+
+async def _arelay_stream(upstream, conversation_id, on_finish):
+    async for event, data in _arelay_events(upstream, conversation_id, on_finish):
+        yield _sse(event, data)
+
+
+class TurnRejected(Exception):
+    # El turno no puede empezar; status es el código HTTP equivalente
+    def __init__(self, error, status):
+        super().__init__(error)
+        self.error = error
+        self.status = status
+
+
+class Turn:
+    # Turno de chat listo para pedir la respuesta al LLM. answer es la
+    # respuesta ya disponible (caché o petición idéntica en curso); si es
+    # None, este turno lidera el flight y debe llamar a finish (afinish en
+    # asíncrono) o fail. created indica que la conversación se creó en este turno
+    def __init__(self, conversation_id, message, payload, new_conversation, answer, flight, created=False):
+        self.conversation_id = conversation_id
+        self.created = created
+        self.message = message
+        self.payload = payload
+        self.new_conversation = new_conversation
+        self.answer = answer
+        self.flight = flight
+
+    def finish(self, assistant_message):
+        _finish_flight(self.flight, self.payload, self.message, self.new_conversation, assistant_message)
+
+    async def afinish(self, assistant_message):
+        await _afinish_flight(self.flight, self.payload, self.message, self.new_conversation, assistant_message)
+
+    def fail(self, error):
+        self.flight.fail(error)
+
+
+def _parse_turn(data):
+    # (mensaje, tokens del mensaje, conversation_id o None) de un turno
+    message = data.get('message', '').strip()
+    try:
+        conversation_id = _conversation_id(data)
+    except (TypeError, ValueError):
+        raise TurnRejected('Invalid conversation_id', 400)
+    return message, count_tokens(message), conversation_id
+
+
+def _turn_payload(summary, history, message, message_tokens, passages, stream):
+    # Payload del turno con el contexto y los fragmentos recuperados
+    with metrics.phase('prompt'):
+        messages_for_api, _ = get_prompt_builder().build(summary, history, message, message_tokens, passages)
+    return llm.build_payload(messages_for_api, stream=stream), not (summary or history)
+
+
+def prepare_turn(data, stream):
+    # Pasos de chat_message hasta la llamada al LLM: conversación, mensaje del
+    # usuario, contexto, prompt y caché. Es aprepare_turn con E/S síncrona
+    message, message_tokens, conversation_id = _parse_turn(data)
+    created = conversation_id is None
+    with metrics.phase('db'):
+        if created:
+            conversation_id = Conversation.objects.create(
+                title=fallback_title(message)
+            ).id
+            schedule_title(conversation_id, message)
+            summary, history = '', []
+        else:
+            # Una sola consulta comprueba que existe y actualiza last_updated
+            if not Conversation.objects.filter(pk=conversation_id).update(last_updated=timezone.now()):
+                raise TurnRejected('Conversation not found', 404)
+            flush_conversation(conversation_id)
+            summary, history = load_context(conversation_id)
+            # Plegar los turnos antiguos en el resumen, fuera de la petición
+            schedule_compaction(conversation_id)
+
+        save_message(conversation_id, 'user', message, message_tokens)
+
+    if not llm.is_configured():
+        raise TurnRejected('API key not configured', 500)
+    with metrics.phase('retrieve'):
+        passages = retrieve(message)
+    payload, new_conversation = _turn_payload(summary, history, message, message_tokens, passages, stream)
+    with metrics.phase('cache'):
+        answer, flight = _answer_or_flight(payload, message, new_conversation)
+    return Turn(conversation_id, message, payload, new_conversation, answer, flight, created)
+
+
+async def aprepare_turn(data, stream):
+    # Lo mismo para achat_message y el canal WebSocket (chatbot.ws)
+    message, message_tokens, conversation_id = _parse_turn(data)
+    created = conversation_id is None
+    with metrics.phase('db'):
+        if created:
+            conversation = await Conversation.objects.acreate(
+                title=fallback_title(message)
+            )
+            conversation_id = conversation.id
+            await aschedule_title(conversation_id, message)
+            summary, history = '', []
+        else:
+            if not await Conversation.objects.filter(pk=conversation_id).aupdate(last_updated=timezone.now()):
+                raise TurnRejected('Conversation not found', 404)
+            await aflush_conversation(conversation_id)
+            summary, history = await aload_context(conversation_id)
+            schedule_compaction(conversation_id)
+
+        await asave_message(conversation_id, 'user', message, message_tokens)
+
+    if not llm.is_configured():
+        raise TurnRejected('API key not configured', 500)
+    with metrics.phase('retrieve'):
+        passages = await aretrieve(message)
+    payload, new_conversation = _turn_payload(summary, history, message, message_tokens, passages, stream)
+    with metrics.phase('cache'):
+        answer, flight = await _aanswer_or_flight(payload, message, new_conversation)
+    return Turn(conversation_id, message, payload, new_conversation, answer, flight, created)
+
 
 @csrf_exempt
+@throttle
 def chat_message(request):
     if request.method == 'POST':
+        if _request_too_large(request):
+            return _too_large_response()
         try:
-            data = json.loads(request.body)
-            message = data.get('message', '').strip()
+            with metrics.phase('parse'):
+                data = fastjson.loads(request.body)
+            stream = bool(data.get('stream', False))
+            try:
+                turn = prepare_turn(data, stream)
+            except TurnRejected as e:
+                return JsonResponse({'error': e.error}, status=e.status)
+            conversation_id = turn.conversation_id
+            assistant_message = turn.answer
+            if turn.created:
+                remember_conversation(request, conversation_id)
 
-            # Obtener o crear la conversación
-            conversation = Conversation.objects.create(
-                title=message[:50] + ('...' if len(message) > 50 else '')
-            )
+            if stream:
+                if assistant_message is not None:
+                    save_message(conversation_id, 'assistant', assistant_message)
+                    return _streaming_response(_cached_stream(assistant_message, conversation_id))
 
-            # Guardar el mensaje del usuario
-            ChatMessage.objects.create(
-                conversation=conversation,
-                role='user',
-                content=message
-            )
-            
-            api_key = config('DEEPSEEK_API_KEY')
-            if not api_key:
-                return JsonResponse({'error': 'API key not configured'}, status=500)
-
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-                "Accept": "application/json"
-            }
-
-            # Aquí deberías obtener los mensajes anteriores en la conversación (si los hubiera)
-            messages_for_api = [{"role": "assistant", "content": "Soy un asistente de Deepseek, estoy aquí para ayudarte."}]
-            messages_for_api.append({"role": "user", "content": message})
-
-            payload = {
-                "model": "deepseek-chat",
-                "messages": messages_for_api,
-                "temperature": 0.7,
-                "max_tokens": 2000,
-                "top_p": 0.95,
-                "stream": False,
-                "presence_penalty": 0,
-                "frequency_penalty": 0
-            }
-
-            response = requests.post(
-                "https://api.deepseek.com/v1/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
-            
-            if response.status_code != 200:
-                return JsonResponse({'error': 'Error en la API de Deepseek'}, status=500)
-            
-            response_data = response.json()
-            assistant_message = response_data['choices'][0]['message']['content']
+                try:
+                    upstream = llm.open_stream(turn.payload)
+                except Exception as e:
+                    turn.fail(e)
+                    raise
+                return _streaming_response(_relay_stream(upstream, conversation_id, turn.finish))
+
+            if assistant_message is None:
+                try:
+                    assistant_message = llm.complete_payload(turn.payload)
+                except Exception as e:
+                    turn.fail(e)
+                    raise
+                turn.finish(assistant_message)
 
             # Guardar el mensaje de la respuesta del asistente
-            ChatMessage.objects.create(
-                conversation=conversation,
-                role='assistant',
-                content=assistant_message
-            )
-            
-            return JsonResponse({
-                'response': assistant_message,
-                'conversation_id': conversation.id
-            }, json_dumps_params={'ensure_ascii': False})
+            with metrics.phase('db'):
+                save_message(conversation_id, 'assistant', assistant_message)
+
+            with metrics.phase('serialize'):
+                return JsonResponse({
+                    'response': assistant_message,
+                    'conversation_id': conversation_id
+                })
 
         except json.JSONDecodeError:
             return JsonResponse({'error': 'Invalid JSON format'}, status=400)
+        except llm.UpstreamError as e:
+            return _upstream_error_response(e)
         except Exception as e:
             return JsonResponse({'error': f"Error: {str(e)}"}, status=500)
-    
+
     # Renderizar la página de chat en una solicitud GET
     return render(request, 'chatbot/chat.html')
+
+
+@operator_required
+def llm_stats(request):
+    # Estadísticas del pool de conexiones hacia el LLM (tasa de reutilización)
+    semantic_cache = get_semantic_cache()
+    return JsonResponse({
+        'pools': llm.pool_stats(),
+        'cache': get_completion_cache().stats(),
+        'semantic_cache': semantic_cache.stats() if semantic_cache is not None else {},
+        'coalescing': get_singleflight().stats(),
+        'router': get_router().stats(),
+        'throttle': get_throttle().stats(),
+        'rag': get_rag_index().stats(),
+    })
+
+
+@operator_required
+def metrics_view(request):
+    # Métricas en formato de texto de Prometheus. Son de este proceso: con
+    # varios workers, Prometheus debe scrapear cada uno (o agregarlas fuera)
+    throttle_stats = get_throttle().stats()
+    router_stats = get_router().stats()
+    extra = [
+        ('chatbot_throttle_allowed_total', 'counter', "Mensajes admitidos por el limitador",
+         [({}, throttle_stats['allowed'])]),
+        ('chatbot_throttle_rejected_total', 'counter', "Mensajes rechazados con 429, por ámbito",
+         [({'scope': scope}, count) for scope, count in throttle_stats['rejected'].items()]),
+        ('chatbot_llm_failovers_total', 'counter', "Peticiones reenviadas a otro proveedor tras un fallo",
+         [({}, router_stats['failovers'])]),
+        ('chatbot_llm_hedged_total', 'counter', "Peticiones duplicadas en un segundo proveedor",
+         [({}, router_stats['hedged'])]),
+        ('chatbot_jobs', 'gauge', "Trabajos de la cola por tipo y estado",
+         [({'kind': key.split(':')[0], 'status': key.split(':')[1]}, count) for key, count in jobs.stats().items()]),
+        ('chatbot_llm_breaker_open', 'gauge', "1 si el circuit breaker del proveedor está abierto",
+         [({'provider': provider.name}, int(provider.governor.breaker.is_open()))
+          for provider in get_router().providers]),
+    ]
+    return HttpResponse(metrics.render(extra), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def conversation_list(request):
+    # Conversaciones de la sesión (todas para un operador) por actividad
+    # reciente, paginadas con keyset (last_updated, id)
+    try:
+        limit = page_size(request.GET.get('limit'))
+        after = _seek_position(request)
+    except (InvalidCursor, ValueError):
+        return JsonResponse({'error': 'Invalid cursor or limit'}, status=400)
+    conversations = Conversation.objects.all()
+    visible = visible_conversations(request)
+    if visible is not None:
+        conversations = conversations.filter(id__in=visible)
+    rows, next_after = keyset_page(
+        conversations.values('id', 'title', 'created_at', 'last_updated'),
+        ('last_updated', 'id'), after, limit
+    )
+    return _conditional_json(request, {
+        'results': rows,
+        'next_cursor': encode_cursor(next_after) if next_after else None,
+    })
+
+
+def conversation_messages(request, conversation_id):
+    # Mensajes de una conversación del más nuevo al más antiguo, keyset (timestamp, id)
+    try:
+        limit = page_size(request.GET.get('limit'), default=50, maximum=200)
+        after = _seek_position(request)
+    except (InvalidCursor, ValueError):
+        return JsonResponse({'error': 'Invalid cursor or limit'}, status=400)
+    # Una conversación de otra sesión responde igual que una inexistente
+    visible = visible_conversations(request)
+    if visible is not None and conversation_id not in visible:
+        return JsonResponse({'error': 'Conversation not found'}, status=404)
+    if not Conversation.objects.filter(pk=conversation_id).exists():
+        return JsonResponse({'error': 'Conversation not found'}, status=404)
+    flush_conversation(conversation_id)
+    rows, next_after = keyset_page(
+        ChatMessage.objects.filter(conversation_id=conversation_id).values('id', 'role', 'content', 'timestamp'),
+        ('timestamp', 'id'), after, limit
+    )
+    return _conditional_json(request, {
+        'conversation_id': conversation_id,
+        'results': rows,
+        'next_cursor': encode_cursor(next_after) if next_after else None,
+    })
+
+
+def search(request):
+    # Búsqueda de texto completo en los mensajes de las conversaciones de la
+    # sesión (todas para un operador), ordenada por relevancia y paginada con
+    # un cursor keyset (rank, id)
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({'error': 'Missing q'}, status=400)
+    try:
+        limit = page_size(request.GET.get('limit'))
+        conversation_id = _conversation_id(request.GET)
+        cursor = request.GET.get('cursor')
+        after = _search_position(cursor) if cursor else None
+    except InvalidCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid limit or conversation_id'}, status=400)
+
+    conversation_ids = visible_conversations(request)
+    if conversation_id is not None:
+        conversation_ids = {conversation_id} if conversation_ids is None else conversation_ids & {conversation_id}
+    results, next_after = search_messages(query, limit, after, conversation_ids)
+    titles = dict(
+        Conversation.objects.filter(id__in={r['conversation_id'] for r in results}).values_list('id', 'title')
+    )
+    return JsonResponse({
+        'results': [
+            {**result, 'conversation_title': titles.get(result['conversation_id'])} for result in results
+        ],
+        'next_cursor': encode_cursor(list(next_after)) if next_after else None,
+    })
+
+
+@throttle
+async def achat_message(request):
+    # Versión asíncrona de chat_message para servir con ASGI: la espera a
+    # DeepSeek no ocupa un hilo, así que un worker atiende cientos de chats
+    if request.method == 'POST':
+        if _request_too_large(request):
+            return _too_large_response()
+        try:
+            with metrics.phase('parse'):
+                data = fastjson.loads(request.body)
+            stream = bool(data.get('stream', False))
+            try:
+                turn = await aprepare_turn(data, stream)
+            except TurnRejected as e:
+                return JsonResponse({'error': e.error}, status=e.status)
+            conversation_id = turn.conversation_id
+            assistant_message = turn.answer
+            if turn.created:
+                # La sesión de Django 4.2 solo tiene API síncrona
+                await sync_to_async(remember_conversation)(request, conversation_id)
+
+            if stream:
+                if assistant_message is not None:
+                    await asave_message(conversation_id, 'assistant', assistant_message)
+                    return _streaming_response(_cached_stream(assistant_message, conversation_id))
+
+                try:
+                    upstream = await llm.aopen_stream(turn.payload)
+                except Exception as e:
+                    turn.fail(e)
+                    raise
+                return _streaming_response(_arelay_stream(upstream, conversation_id, turn.afinish))
+
+            if assistant_message is None:
+                try:
+                    assistant_message = await llm.acomplete_payload(turn.payload)
+                except Exception as e:
+                    turn.fail(e)
+                    raise
+                await turn.afinish(assistant_message)
+
+            with metrics.phase('db'):
+                await asave_message(conversation_id, 'assistant', assistant_message)
+
+            with metrics.phase('serialize'):
+                return JsonResponse({
+                    'response': assistant_message,
+                    'conversation_id': conversation_id
+                })
+
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Invalid JSON format'}, status=400)
+        except llm.UpstreamError as e:
+            return _upstream_error_response(e)
+        except Exception as e:
+            return JsonResponse({'error': f"Error: {str(e)}"}, status=500)
+
+    return render(request, 'chatbot/chat.html')
+
+
+# csrf_exempt de Django 4.2 no conserva las vistas asíncronas
+achat_message.csrf_exempt = True
@@ -0,0 +1,266 @@
+"""
+Canal WebSocket del chat (ASGI puro, sin Channels).
+
+Una conexión sirve varios turnos a la vez, de una o varias conversaciones.
+Cada frame es un objeto JSON con un "type"; los turnos se identifican con
+el "id" que elige el cliente.
+
+Cliente -> servidor:
+    {"type": "message", "id": "1", "conversation_id": null, "message": "Hola"}
+    {"type": "cancel", "id": "1"}
+    {"type": "ping"}
+
+Servidor -> cliente:
+    {"type": "typing", "id": "1"}                      turno aceptado
+    {"type": "start", "id": "1", "conversation_id": 7}
+    {"type": "delta", "id": "1", "content": "..."}
+    {"type": "done", "id": "1", "conversation_id": 7}
+    {"type": "cancelled", "id": "1"}
+    {"type": "error", "id": "1", "error": "...", "retry_after": 5}
+    {"type": "pong"}
+
+Cancelar un turno cierra en el acto la petición al LLM; lo recibido hasta
+entonces se guarda como respuesta. El POST a / (o /async/) sigue sirviendo
+a los clientes sin WebSocket.
+"""
+import asyncio
+import logging
+import math
+from contextlib import aclosing, suppress
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.http.request import split_domain_port, validate_host
+
+from . import fastjson, llm, metrics
+from .governor import RETRYABLE_STATUS
+from .access import remember_conversation_in_session
+from .persistence import asave_message
+from .throttle import get_throttle, scope_identities
+from .views import TurnRejected, _arelay_events, aprepare_turn
+
+logger = logging.getLogger(__name__)
+
+PATH = '/ws/chat/'
+# Códigos de cierre (RFC 6455)
+POLICY_VIOLATION = 1008
+
+
+class SlowConsumer(Exception):
+    pass
+
+
+def _origin_allowed(scope):
+    # Un navegador siempre manda Origin: se exige que sea uno de nuestros
+    # hosts para que otra web no abra el canal con las cookies del usuario
+    for name, value in scope.get('headers', ()):
+        if name == b'origin':
+            domain, _ = split_domain_port(urlsplit(value.decode('latin-1')).netloc)
+            allowed_hosts = settings.ALLOWED_HOSTS
+            if settings.DEBUG and not allowed_hosts:
+                allowed_hosts = ['.localhost', '127.0.0.1', '[::1]']
+            return bool(domain) and validate_host(domain, allowed_hosts)
+    return True
+
+
+def _upstream_error(error):
+    # Mismo criterio que _upstream_error_response de las vistas: (frame, status)
+    if error.retry_after is None and error.status_code not in RETRYABLE_STATUS:
+        return {'error': 'Error en la API de Deepseek'}, 500
+    return {
+        'error': 'Deepseek no está disponible ahora, inténtalo en unos segundos',
+        'retry_after': max(1, math.ceil(error.retry_after or 1)),
+    }, 503
+
+
+class ChatSocket:
+    def __init__(self, scope, receive, send):
+        self.scope = scope
+        self.receive = receive
+        self.send = send
+        # Frames pendientes de enviar. Si el cliente no lee, la cola se llena,
+        # los turnos dejan de leer del LLM y, pasado SEND_TIMEOUT, se cierra
+        self.outbox = asyncio.Queue(settings.CHATBOT_WS_SEND_QUEUE)
+        self.turns = {}
+        # Turnos que ya enviaron su último frame y solo están guardando: no se cancelan
+        self.answered = set()
+        self.closing = False
+        self.writer = None
+
+    async def run(self):
+        if (await self.receive())['type'] != 'websocket.connect':
+            return
+        if self.scope['path'] != PATH or not _origin_allowed(self.scope):
+            # Cerrar antes de aceptar rechaza el handshake (HTTP 403)
+            await self.send({'type': 'websocket.close', 'code': POLICY_VIOLATION})
+            return
+        await self.send({'type': 'websocket.accept'})
+        self.writer = asyncio.create_task(self._write())
+        try:
+            while True:
+                event = await self.receive()
+                if event['type'] == 'websocket.disconnect':
+                    break
+                if event['type'] == 'websocket.receive' and not self.closing:
+                    try:
+                        await self._dispatch(event.get('text') or event.get('bytes') or b'')
+                    except SlowConsumer:
+                        await self._abort()
+        finally:
+            self.closing = True
+            turns = list(self.turns.values())
+            for frame_id, task in self.turns.items():
+                if frame_id not in self.answered:
+                    task.cancel()
+            await asyncio.gather(*turns, return_exceptions=True)
+            self.writer.cancel()
+
+    async def _write(self):
+        # Único emisor de la conexión. Junta los deltas seguidos de un mismo
+        # turno en un frame: un cliente lento recibe menos frames, no menos texto
+        following = None
+        while True:
+            frame = following or await self.outbox.get()
+            following = None
+            if frame['type'] == 'delta':
+                parts = [frame['content']]
+                while not self.outbox.empty():
+                    following = self.outbox.get_nowait()
+                    if following['type'] != 'delta' or following['id'] != frame['id']:
+                        break
+                    parts.append(following['content'])
+                    following = None
+                frame = {**frame, 'content': ''.join(parts)}
+            await self.send({'type': 'websocket.send', 'text': fastjson.dumps(frame).decode('utf-8')})
+
+    async def _emit(self, frame):
+        try:
+            await asyncio.wait_for(self.outbox.put(frame), settings.CHATBOT_WS_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise SlowConsumer from None
+
+    async def _abort(self):
+        # Cliente que no lee: se cierra la conexión y con ella todos sus turnos
+        if self.closing:
+            return
+        self.closing = True
+        logger.warning("Cerrando WebSocket de %s: no lee los mensajes", (self.scope.get('client') or ('',))[0])
+        self.writer.cancel()
+        for task in self.turns.values():
+            if task is not asyncio.current_task():
+                task.cancel()
+        with suppress(Exception):  # El cliente puede haberse ido ya
+            await self.send({'type': 'websocket.close', 'code': POLICY_VIOLATION})
+
+    async def _dispatch(self, data):
+        # Mismo límite que el cuerpo de un POST (en caracteres para los frames de
+        # texto: sin codificarlos de nuevo a UTF-8 solo para medirlos)
+        if len(data) > settings.CHATBOT_MAX_REQUEST_BYTES:
+            await self._emit({'type': 'error', 'id': None, 'error': 'Mensaje demasiado largo'})
+            return
+        try:
+            frame = fastjson.loads(data)
+            kind = frame['type']
+        except (ValueError, TypeError, KeyError):
+            await self._emit({'type': 'error', 'id': None, 'error': 'Invalid JSON format'})
+            return
+
+        if kind == 'ping':
+            await self._emit({'type': 'pong'})
+        elif kind == 'cancel':
+            frame_id = str(frame.get('id'))
+            if frame_id in self.turns and frame_id not in self.answered:
+                self.turns[frame_id].cancel()
+        elif kind == 'message':
+            frame_id = str(frame.get('id') or '')
+            if not frame_id or frame_id in self.turns:
+                await self._emit({'type': 'error', 'id': frame_id or None, 'error': 'Invalid id'})
+                return
+            if len(self.turns) >= settings.CHATBOT_WS_MAX_STREAMS:
+                await self._emit({'type': 'error', 'id': frame_id, 'error': 'Demasiadas respuestas en curso'})
+                return
+            if settings.CHATBOT_THROTTLE_ENABLED:
+                retry_after = await get_throttle().acheck(scope_identities(self.scope))
+                if retry_after is not None:
+                    await self._emit({'type': 'error', 'id': frame_id, 'retry_after': max(1, math.ceil(retry_after)),
+                                      'error': 'Demasiados mensajes seguidos, espera un momento'})
+                    return
+            task = asyncio.create_task(self._turn(frame_id, frame))
+            self.turns[frame_id] = task
+            task.add_done_callback(lambda _: self._forget(frame_id))
+        else:
+            await self._emit({'type': 'error', 'id': frame.get('id'), 'error': 'Unknown type'})
+
+    def _forget(self, frame_id):
+        self.turns.pop(frame_id, None)
+        self.answered.discard(frame_id)
+
+    async def _turn(self, frame_id, frame):
+        # Cada turno se mide como una petición más (vista chat_ws, método WS);
+        # 499 = cancelado por el cliente, como en nginx
+        timer, token = metrics.start_request()
+        status = 500
+        try:
+            status = await self._answer(frame_id, frame)
+        except asyncio.CancelledError:
+            status = 499
+            if not self.closing:
+                await self._emit({'type': 'cancelled', 'id': frame_id})
+        except SlowConsumer:
+            await self._abort()
+        except Exception as e:
+            await self._emit({'type': 'error', 'id': frame_id, 'error': f"Error: {e}"})
+        finally:
+            metrics.finish('chat_ws', 'WS', status, timer, token)
+            await sync_to_async(close_old_connections)()
+
+    async def _answer(self, frame_id, frame):
+        await self._emit({'type': 'typing', 'id': frame_id})
+        try:
+            turn = await aprepare_turn(frame, stream=True)
+        except TurnRejected as e:
+            await self._emit({'type': 'error', 'id': frame_id, 'error': e.error})
+            return e.status
+        except llm.UpstreamError as e:
+            error, status = _upstream_error(e)
+            await self._emit({'type': 'error', 'id': frame_id, **error})
+            return status
+
+        conversation_id = turn.conversation_id
+        if turn.created:
+            session_key = scope_identities(self.scope).get('session')
+            if session_key:
+                await sync_to_async(remember_conversation_in_session)(session_key, conversation_id)
+        if turn.answer is not None:
+            await asave_message(conversation_id, 'assistant', turn.answer)
+            await self._emit({'type': 'start', 'id': frame_id, 'conversation_id': conversation_id})
+            await self._emit({'type': 'delta', 'id': frame_id, 'content': turn.answer})
+            await self._emit({'type': 'done', 'id': frame_id, 'conversation_id': conversation_id})
+            return 200
+
+        try:
+            upstream = await llm.aopen_stream(turn.payload)
+        except BaseException as e:
+            turn.fail(e if isinstance(e, Exception) else llm.UpstreamError("Turno cancelado"))
+            if not isinstance(e, llm.UpstreamError):
+                raise
+            error, status = _upstream_error(e)
+            await self._emit({'type': 'error', 'id': frame_id, **error})
+            return status
+
+        # aclosing: al cancelar mientras se espera a _emit, el finally del relay
+        # (cerrar la petición al LLM, guardar lo recibido) se ejecuta ya, no en el GC
+        async with aclosing(_arelay_events(upstream, conversation_id, turn.afinish)) as events:
+            async for event, data in events:
+                if event in ('done', 'error'):
+                    self.answered.add(frame_id)
+                await self._emit({'type': event, 'id': frame_id, **data})
+                if event == 'error':
+                    return 502
+        return 200
+
+
+async def websocket_application(scope, receive, send):
+    await ChatSocket(scope, receive, send).run()
@@ -3,6 +3,15 @@ ASGI config for chatbot_project project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The asynchronous chat endpoint (``/async/``) runs natively here, so one
+worker can keep hundreds of DeepSeek calls in flight, e.g.::
+
+    gunicorn chatbot_project.asgi:application -k uvicorn.workers.UvicornWorker
+
+WebSocket connections to ``/ws/chat/`` go to ``chatbot.ws`` (one connection
+per browser tab, several streamed answers at a time); uvicorn needs the
+``websockets`` or ``wsproto`` package installed to accept them.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
@@ -13,4 +22,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatbot_project.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Después de get_asgi_application(): chatbot.ws importa modelos
+from chatbot.ws import websocket_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        return await websocket_application(scope, receive, send)
+    return await django_application(scope, receive, send)
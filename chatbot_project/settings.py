@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 from pathlib import Path
+import json
 import os
 from dotenv import load_dotenv
 
@@ -43,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chatbot.metrics.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -76,17 +78,20 @@ WSGI_APPLICATION = 'chatbot_project.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# PostgreSQL por defecto; DB_ENGINE=django.db.backends.sqlite3 (con DB_NAME
+# como ruta del fichero) permite correr pruebas y benchmarks sin servidor
+DB_ENGINE = os.getenv('DB_ENGINE', 'django.db.backends.postgresql')
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
-        'NAME': 'chatbotgei',
-        'USER': 'postgres',
-        'PASSWORD': 'admin1234',
-        'HOST': 'localhost',
-        'PORT': '5432',
+        'ENGINE': DB_ENGINE,
+        'NAME': os.getenv('DB_NAME', 'chatbotgei'),
+        'USER': os.getenv('DB_USER', 'postgres'),
+        'PASSWORD': os.getenv('DB_PASSWORD', 'admin1234'),
+        'HOST': os.getenv('DB_HOST', 'localhost'),
+        'PORT': os.getenv('DB_PORT', '5432'),
         'OPTIONS': {
             'client_encoding': 'UTF8',
-        },
+        } if DB_ENGINE.endswith('postgresql') else {},
     }
 }
 
@@ -129,14 +134,24 @@ LOGGING = {
         },
     },
     'loggers': {
+        # Volcar cada SQL a la consola es caro: solo en desarrollo
         'django.db.backends': {
             'handlers': ['console'],
-            'level': 'DEBUG',
+            'level': os.getenv('DB_LOG_LEVEL', 'DEBUG' if DEBUG else 'WARNING'),
             'propagate': True,
         },
+        # Una línea JSON por petición con sus tiempos por fase (nivel INFO)
+        'chatbot.requests': {
+            'handlers': ['console'],
+            'level': os.getenv('CHATBOT_REQUEST_LOG_LEVEL', 'WARNING'),
+            'propagate': False,
+        },
     },
 }
 
+# Histogramas de latencia por petición y por fase, servidos en /metrics
+CHATBOT_METRICS_ENABLED = os.getenv('CHATBOT_METRICS_ENABLED', 'True') == 'True'
+
 # Security settings
 SECURE_SSL_REDIRECT = False
 SESSION_COOKIE_SECURE = False
@@ -154,6 +169,145 @@ AWS_S3_FILE_OVERWRITE = False
 AWS_DEFAULT_ACL = None
 AWS_S3_VERIFY = True
 
+# DeepSeek
+DEEPSEEK_API_URL = os.getenv('DEEPSEEK_API_URL', 'https://api.deepseek.com/v1/chat/completions')
+# Conexiones simultáneas máximas del cliente HTTP asíncrono compartido hacia el LLM
+LLM_MAX_CONNECTIONS = int(os.getenv('LLM_MAX_CONNECTIONS', '100'))
+# Pool keep-alive del cliente síncrono: hosts distintos y conexiones por host
+LLM_POOL_HOSTS = int(os.getenv('LLM_POOL_HOSTS', '4'))
+LLM_MAX_CONNECTIONS_PER_HOST = int(os.getenv('LLM_MAX_CONNECTIONS_PER_HOST', '10'))
+# Timeouts en segundos: establecer la conexión y esperar datos de la respuesta
+LLM_CONNECT_TIMEOUT = float(os.getenv('LLM_CONNECT_TIMEOUT', '5'))
+LLM_READ_TIMEOUT = float(os.getenv('LLM_READ_TIMEOUT', '30'))
+# Governor de llamadas al LLM: como máximo MAX_CONCURRENCY a la vez por proceso
+# (o entre todos los workers si hay CONCURRENCY_DIR), esperando hueco hasta
+# QUEUE_TIMEOUT segundos; RATE_LIMIT peticiones/s por proceso (0 = sin límite,
+# reparte la cuota de la API entre los workers); reintentos con backoff y jitter
+# que respetan Retry-After; el circuito se abre tras BREAKER_THRESHOLD fallos
+# seguidos y prueba de nuevo pasados BREAKER_RESET segundos
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '16'))
+LLM_CONCURRENCY_DIR = os.getenv('LLM_CONCURRENCY_DIR', '')
+LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', '10'))
+LLM_RATE_LIMIT = float(os.getenv('LLM_RATE_LIMIT', '0'))
+LLM_RATE_BURST = int(os.getenv('LLM_RATE_BURST', '10'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '2'))
+LLM_RETRY_BASE_DELAY = float(os.getenv('LLM_RETRY_BASE_DELAY', '0.5'))
+LLM_RETRY_MAX_DELAY = float(os.getenv('LLM_RETRY_MAX_DELAY', '8'))
+LLM_BREAKER_THRESHOLD = int(os.getenv('LLM_BREAKER_THRESHOLD', '5'))
+LLM_BREAKER_RESET = float(os.getenv('LLM_BREAKER_RESET', '30'))
+# Proveedores de LLM (JSON). Vacío = solo DeepSeek con DEEPSEEK_API_URL. Ej.:
+# [{"name": "deepseek", "url": "https://api.deepseek.com/v1/chat/completions",
+#   "model": "deepseek-chat", "kind": "deepseek", "api_key_env": "DEEPSEEK_API_KEY"},
+#  {"name": "local", "url": "http://127.0.0.1:8080/v1/chat/completions",
+#   "model": "local", "kind": "llamacpp"}]
+# El router usa el más rápido y sano; con LLM_HEDGE, si tarda más que su p95
+# repite la petición en el siguiente y se queda con la primera respuesta
+LLM_PROVIDERS = json.loads(os.getenv('LLM_PROVIDERS', '[]'))
+LLM_HEDGE = os.getenv('LLM_HEDGE', 'False') == 'True'
+
+# Cola de trabajos en la base de datos (manage.py run_workers): reintentos con
+# backoff exponencial hasta MAX_ATTEMPTS y después quedan como 'dead'. Un
+# trabajo 'running' durante más de VISIBILITY_TIMEOUT vuelve a la cola
+CHATBOT_JOB_MAX_ATTEMPTS = int(os.getenv('CHATBOT_JOB_MAX_ATTEMPTS', '5'))
+CHATBOT_JOB_RETRY_DELAY = float(os.getenv('CHATBOT_JOB_RETRY_DELAY', '5'))
+CHATBOT_JOB_RETRY_MAX_DELAY = float(os.getenv('CHATBOT_JOB_RETRY_MAX_DELAY', '600'))
+CHATBOT_JOB_VISIBILITY_TIMEOUT = int(os.getenv('CHATBOT_JOB_VISIBILITY_TIMEOUT', '300'))
+CHATBOT_WORKERS = int(os.getenv('CHATBOT_WORKERS', '4'))
+CHATBOT_WORKER_POLL_INTERVAL = float(os.getenv('CHATBOT_WORKER_POLL_INTERVAL', '1.0'))
+# Título de cada conversación nueva generado por el LLM en un worker. Solo
+# con run_workers en marcha: sin workers los trabajos se acumulan en la tabla
+CHATBOT_LLM_TITLES = os.getenv('CHATBOT_LLM_TITLES', 'False') == 'True'
+# Guardar los mensajes desde los workers (por lotes) en lugar de en la petición
+CHATBOT_PERSIST_WITH_JOBS = os.getenv('CHATBOT_PERSIST_WITH_JOBS', 'False') == 'True'
+
+# Límite de mensajes por IP y por sesión (peticiones por minuto y ráfaga).
+# Sin CHATBOT_THROTTLE_CACHE cada worker cuenta por su cuenta; con un alias de
+# CACHES compartido (Redis/Memcached) el límite es global entre workers.
+# TRUST_FORWARDED solo detrás de un proxy que fije X-Forwarded-For
+CHATBOT_THROTTLE_ENABLED = os.getenv('CHATBOT_THROTTLE_ENABLED', 'True') == 'True'
+CHATBOT_THROTTLE_IP_RATE = int(os.getenv('CHATBOT_THROTTLE_IP_RATE', '60'))
+CHATBOT_THROTTLE_IP_BURST = int(os.getenv('CHATBOT_THROTTLE_IP_BURST', '20'))
+CHATBOT_THROTTLE_SESSION_RATE = int(os.getenv('CHATBOT_THROTTLE_SESSION_RATE', '20'))
+CHATBOT_THROTTLE_SESSION_BURST = int(os.getenv('CHATBOT_THROTTLE_SESSION_BURST', '5'))
+CHATBOT_THROTTLE_CACHE = os.getenv('CHATBOT_THROTTLE_CACHE', '')
+CHATBOT_THROTTLE_TRUST_FORWARDED = os.getenv('CHATBOT_THROTTLE_TRUST_FORWARDED', 'False') == 'True'
+# El historial y la búsqueda solo muestran las conversaciones creadas desde la
+# sesión del navegador; el personal (is_staff) o quien mande la cabecera
+# "Authorization: Bearer <OPERATOR_TOKEN>" ve todas, además de /stats/llm/ y /metrics
+CHATBOT_OPERATOR_TOKEN = os.getenv('CHATBOT_OPERATOR_TOKEN', '')
+
+# Historial enviado al LLM en cada turno: como máximo estos mensajes y tokens
+CHATBOT_HISTORY_MAX_MESSAGES = int(os.getenv('CHATBOT_HISTORY_MAX_MESSAGES', '20'))
+CHATBOT_HISTORY_TOKEN_BUDGET = int(os.getenv('CHATBOT_HISTORY_TOKEN_BUDGET', '3000'))
+# Prompt enviado al LLM: prompt de sistema fijo y presupuesto total de tokens
+# (sistema + resumen + historial + mensaje), por debajo del contexto del modelo
+# menos los max_tokens de la respuesta
+CHATBOT_SYSTEM_PROMPT = os.getenv('CHATBOT_SYSTEM_PROMPT', "Soy un asistente de Deepseek, estoy aquí para ayudarte.")
+CHATBOT_PROMPT_TOKEN_BUDGET = int(os.getenv('CHATBOT_PROMPT_TOKEN_BUDGET', '8000'))
+# Respuestas con fragmentos de documentos propios (manage.py index_documents):
+# TOP_K fragmentos por pregunta; PROBES listas IVF recorridas por segmento;
+# sin términos en común, un fragmento necesita similitud >= MIN_SCORE
+CHATBOT_RAG_ENABLED = os.getenv('CHATBOT_RAG_ENABLED', 'True') == 'True'
+CHATBOT_RAG_DIR = os.getenv('CHATBOT_RAG_DIR', os.path.join(BASE_DIR, 'var', 'rag'))
+CHATBOT_RAG_TOP_K = int(os.getenv('CHATBOT_RAG_TOP_K', '4'))
+CHATBOT_RAG_PROBES = int(os.getenv('CHATBOT_RAG_PROBES', '8'))
+CHATBOT_RAG_MIN_SCORE = float(os.getenv('CHATBOT_RAG_MIN_SCORE', '0.25'))
+CHATBOT_RAG_CHUNK_TOKENS = int(os.getenv('CHATBOT_RAG_CHUNK_TOKENS', '200'))
+CHATBOT_RAG_CHUNK_OVERLAP = int(os.getenv('CHATBOT_RAG_CHUNK_OVERLAP', '40'))
+CHATBOT_RAG_MAX_SEGMENTS = int(os.getenv('CHATBOT_RAG_MAX_SEGMENTS', '8'))
+# JSON del chat y del tráfico con el LLM (chatbot.fastjson): 'auto' usa orjson
+# si está instalado, 'json' fuerza la biblioteca estándar. Los mensajes de más
+# de MAX_REQUEST_BYTES se rechazan con 413 antes de leerlos y parsearlos
+CHATBOT_JSON_BACKEND = os.getenv('CHATBOT_JSON_BACKEND', 'auto')
+CHATBOT_MAX_REQUEST_BYTES = int(os.getenv('CHATBOT_MAX_REQUEST_BYTES', str(64 * 1024)))
+# Canal WebSocket (chatbot.ws): respuestas en curso a la vez por conexión,
+# frames en cola por conexión y segundos que un cliente que no lee puede
+# tener la cola llena antes de que se le cierre la conexión
+CHATBOT_WS_MAX_STREAMS = int(os.getenv('CHATBOT_WS_MAX_STREAMS', '4'))
+CHATBOT_WS_SEND_QUEUE = int(os.getenv('CHATBOT_WS_SEND_QUEUE', '64'))
+CHATBOT_WS_SEND_TIMEOUT = float(os.getenv('CHATBOT_WS_SEND_TIMEOUT', '10'))
+# Resumen incremental: cuando hay más de THRESHOLD mensajes sin resumir, los
+# antiguos se pliegan en el resumen y se conservan KEEP_RECENT literales
+CHATBOT_SUMMARY_THRESHOLD = int(os.getenv('CHATBOT_SUMMARY_THRESHOLD', '30'))
+CHATBOT_SUMMARY_KEEP_RECENT = int(os.getenv('CHATBOT_SUMMARY_KEEP_RECENT', '10'))
+# Caché de respuestas del LLM: LRU en memoria + backend opcional de CACHES
+# (alias, p. ej. 'default'); por encima de MAX_TEMPERATURE no se cachea
+CHATBOT_CACHE_ENABLED = os.getenv('CHATBOT_CACHE_ENABLED', 'True') == 'True'
+CHATBOT_CACHE_MAX_ENTRIES = int(os.getenv('CHATBOT_CACHE_MAX_ENTRIES', '1000'))
+CHATBOT_CACHE_TTL = int(os.getenv('CHATBOT_CACHE_TTL', '3600'))
+CHATBOT_CACHE_BACKEND = os.getenv('CHATBOT_CACHE_BACKEND', '')
+CHATBOT_CACHE_MAX_TEMPERATURE = float(os.getenv('CHATBOT_CACHE_MAX_TEMPERATURE', '1.0'))
+# Caché semántica: responde preguntas parecidas a otras ya contestadas
+# (solo en conversaciones nuevas) si la similitud coseno supera el umbral
+CHATBOT_SEMANTIC_CACHE_ENABLED = os.getenv('CHATBOT_SEMANTIC_CACHE_ENABLED', 'False') == 'True'
+CHATBOT_SEMANTIC_CACHE_DIR = os.getenv('CHATBOT_SEMANTIC_CACHE_DIR', os.path.join(BASE_DIR, 'var', 'semantic_cache'))
+CHATBOT_SEMANTIC_CACHE_THRESHOLD = float(os.getenv('CHATBOT_SEMANTIC_CACHE_THRESHOLD', '0.8'))
+CHATBOT_SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv('CHATBOT_SEMANTIC_CACHE_MAX_ENTRIES', '100000'))
+# Agrupa peticiones idénticas simultáneas en una sola llamada al LLM; entre
+# workers de gunicorn se coordinan con ficheros de lock en este directorio
+CHATBOT_COALESCE_ACROSS_WORKERS = os.getenv('CHATBOT_COALESCE_ACROSS_WORKERS', 'True') == 'True'
+CHATBOT_COALESCE_DIR = os.getenv('CHATBOT_COALESCE_DIR', os.path.join(BASE_DIR, 'var', 'coalesce'))
+# Persistencia write-behind de mensajes: journal en disco + inserciones por
+# lotes (BATCH_SIZE mensajes o cada INTERVAL segundos) fuera de la petición
+CHATBOT_WRITE_BEHIND = os.getenv('CHATBOT_WRITE_BEHIND', 'False') == 'True'
+CHATBOT_WRITE_BEHIND_DIR = os.getenv('CHATBOT_WRITE_BEHIND_DIR', os.path.join(BASE_DIR, 'var', 'journal'))
+CHATBOT_WRITE_BEHIND_BATCH_SIZE = int(os.getenv('CHATBOT_WRITE_BEHIND_BATCH_SIZE', '200'))
+CHATBOT_WRITE_BEHIND_INTERVAL = float(os.getenv('CHATBOT_WRITE_BEHIND_INTERVAL', '0.2'))
+CHATBOT_WRITE_BEHIND_FSYNC = os.getenv('CHATBOT_WRITE_BEHIND_FSYNC', 'False') == 'True'
+# Antes de leer el historial se espera hasta READ_TIMEOUT segundos a que los
+# otros workers del host guarden los mensajes de la conversación que tengan
+# en su journal (solo comparten el directorio los workers de una misma máquina)
+CHATBOT_WRITE_BEHIND_READ_TIMEOUT = float(os.getenv('CHATBOT_WRITE_BEHIND_READ_TIMEOUT', '2'))
+# Retención de mensajes: archive_messages exporta a JSONL comprimido y elimina
+# los meses más antiguos que RETENTION_DAYS (Conversation.retention_days
+# puede acortarlo por conversación) y crea las particiones de los próximos meses
+CHATBOT_MESSAGE_RETENTION_DAYS = int(os.getenv('CHATBOT_MESSAGE_RETENTION_DAYS', '365'))
+CHATBOT_ARCHIVE_DIR = os.getenv('CHATBOT_ARCHIVE_DIR', os.path.join(BASE_DIR, 'var', 'archive'))
+CHATBOT_PARTITION_MONTHS_AHEAD = int(os.getenv('CHATBOT_PARTITION_MONTHS_AHEAD', '3'))
+
+# manage.py test: los directorios de var/ se sustituyen por uno temporal
+TEST_RUNNER = 'chatbot.test_runner.TestRunner'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
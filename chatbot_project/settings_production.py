@@ -0,0 +1,75 @@
+"""
+Perfil de producción: se selecciona con
+DJANGO_SETTINGS_MODULE=chatbot_project.settings_production (gunicorn.conf.py
+lo hace por defecto). Parte de settings.py y cambia solo lo que afecta al
+rendimiento y a la seguridad básica en producción.
+"""
+
+import copy
+
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASES, LOGGING, MIDDLEWARE, TEMPLATES, os
+
+# Copias: importar este módulo no debe cambiar los ajustes de desarrollo
+DATABASES, LOGGING, TEMPLATES = copy.deepcopy((DATABASES, LOGGING, TEMPLATES))
+
+DEBUG = os.getenv('DEBUG', 'False') == 'True'
+SECRET_KEY = os.getenv('DJANGO_SECRET_KEY', SECRET_KEY)  # noqa: F405
+ALLOWED_HOSTS = os.getenv('ALLOWED_HOSTS', 'localhost,127.0.0.1').split(',')
+
+# Conexiones persistentes: sin esto cada petición abre y cierra su conexión
+# con PostgreSQL. Las comprobaciones de salud descartan las que se cayeron
+DATABASES['default']['CONN_MAX_AGE'] = int(os.getenv('DB_CONN_MAX_AGE', '600'))
+DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+
+# Redis compartido entre workers si hay REDIS_URL (requiere el paquete redis);
+# si no, una caché en memoria por proceso
+REDIS_URL = os.getenv('REDIS_URL', '')
+if REDIS_URL:
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': REDIS_URL}}
+else:
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+# Con una caché compartida, la de respuestas del LLM y el limitador la usan
+CHATBOT_CACHE_BACKEND = os.getenv('CHATBOT_CACHE_BACKEND', 'default' if REDIS_URL else '')
+CHATBOT_THROTTLE_CACHE = os.getenv('CHATBOT_THROTTLE_CACHE', 'default' if REDIS_URL else '')
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# El admin necesita sesión, autenticación y mensajes en cada petición; sin él
+# los endpoints JSON recorren menos middleware
+ADMIN_ENABLED = os.getenv('DJANGO_ADMIN', 'False') == 'True'
+if not ADMIN_ENABLED:
+    INSTALLED_APPS = [app for app in INSTALLED_APPS if app != 'django.contrib.admin']  # noqa: F405
+    MIDDLEWARE = [
+        middleware for middleware in MIDDLEWARE
+        if middleware not in (
+            'django.contrib.auth.middleware.AuthenticationMiddleware',
+            'django.contrib.messages.middleware.MessageMiddleware',
+        )
+    ]
+
+# WhiteNoise sirve los estáticos desde el propio worker, comprimidos y con
+# nombre con hash (caché permanente en el navegador); requiere collectstatic.
+# Se usa una subclase asíncrona para no sacar a ASGI de su event loop
+MIDDLEWARE = list(MIDDLEWARE)
+MIDDLEWARE.insert(MIDDLEWARE.index('django.middleware.security.SecurityMiddleware') + 1,
+                  'chatbot.middleware.AsyncWhiteNoiseMiddleware')
+del DEFAULT_FILE_STORAGE  # noqa: F821 (STORAGES lo sustituye)
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage'},
+}
+
+# Plantillas compiladas una vez por proceso
+TEMPLATES[0]['APP_DIRS'] = False
+TEMPLATES[0]['OPTIONS']['loaders'] = [
+    ('django.template.loaders.cached.Loader', [
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+    ]),
+]
+TEMPLATES[0]['OPTIONS']['context_processors'] = [
+    processor for processor in TEMPLATES[0]['OPTIONS']['context_processors']
+    if processor != 'django.template.context_processors.debug'
+]
+
+LOGGING['loggers']['django.db.backends']['level'] = os.getenv('DB_LOG_LEVEL', 'WARNING')
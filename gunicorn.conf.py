@@ -0,0 +1,39 @@
+"""
+Configuración de gunicorn para producción:
+
+    gunicorn chatbot_project.wsgi:application          # endpoint síncrono
+    GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker \\
+        gunicorn chatbot_project.asgi:application      # endpoint asíncrono
+
+Todo se puede ajustar con variables de entorno.
+"""
+import multiprocessing
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatbot_project.settings_production')
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+
+# Las peticiones pasan casi todo el tiempo esperando a DeepSeek: con gthread
+# cada worker atiende varias a la vez y (2 × CPU) + 1 procesos aprovechan los
+# núcleos para la parte de CPU (JSON, plantillas, ORM)
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+
+# Por encima del timeout de lectura del LLM (LLM_READ_TIMEOUT) más los reintentos
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+
+# Reciclar workers de vez en cuando acota cualquier crecimiento de memoria;
+# el jitter evita que se reinicien todos a la vez
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '5000'))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', '500'))
+
+# Heartbeat de los workers en memoria en lugar de en disco
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')